@@ -3,6 +3,10 @@
 #include <omp.h>
 #include <stdlib.h>
 
+#ifndef M_PI
+#define M_PI 3.14159265358979323846
+#endif
+
 //gcc-4.9 -fopenmp -std=c99 -O3 -shared -fPIC -o libminkasi.so minkasi.c  -lm -lgomp     
 //gcc-9 -fopenmp -O3 -shared -fPIC -o libminkasi.so minkasi.c  -lm -lgomp
 
@@ -65,21 +69,18 @@ void tod2map_atomic(double *map, double *dat, int ndet, int ndata, int *pix)
     map[pix[i]]+=dat[i];
 }
 /*--------------------------------------------------------------------------------*/
-void tod2map_everyone(double *map, double *dat, int ndet, int ndata, int *ipix, int npix, int *edge,int nedge)
-//do tod2map where all threads loop over all data, but only assign a region they are responsible for
+void tod2map_everyone(double *map, double *dat, int *ipix, int *perm, long *offsets, int npart)
+//do tod2map where each thread owns a range of pixels.  perm lists the samples grouped by owning
+//range (in time order within a range), with range j covering perm[offsets[j]] to perm[offsets[j+1]-1].
+//Ranges never share pixels, so threads can add straight into the map, and between them they read
+//each sample once.
 {
-#pragma omp parallel
-  {    
-    int mythread=omp_get_thread_num();
-    if (omp_get_num_threads()<nedge) {  //safety check to make sure # of threads hasn't changed in a bad way
-      int itop=edge[mythread+1];
-      int ibot=edge[mythread];
-      for (int i=0;i<ndet*ndata;i++)
-	if ((ipix[i]<itop)&&(ipix[i]>=ibot))
-	  map[ipix[i]]+=dat[i];
+#pragma omp parallel for schedule(dynamic,1)
+  for (int j=0;j<npart;j++)
+    for (long i=offsets[j];i<offsets[j+1];i++) {
+      long ii=perm[i];
+      map[ipix[ii]]+=dat[ii];
     }
-    
-  }
 }
 /*--------------------------------------------------------------------------------*/
 void tod2map_cached(double *maps, double *dat, int ndet, int ndata, int *ipix, int npix)
@@ -111,6 +112,363 @@ void tod2map_omp(double *map, double *dat, int ndet, int ndata, int *pix, int np
   }
 }
 
+/*--------------------------------------------------------------------------------*/
+void tod2map_sorted(double *map, double *dat, int *perm, int *upix, long *segs, long nseg)
+//do tod2map using a pixel-sorted index of the data.  perm puts samples in pixel order, and
+//segment k covers samples segs[k] to segs[k+1]-1, all of which land in pixel upix[k].  Each
+//thread owns whole segments, so there are no write conflicts, no map copies, and the work 
+//scales with the number of samples plus the number of pixels hit rather than the map size.
+{
+#pragma omp parallel for schedule(guided)
+  for (long k=0;k<nseg;k++) {
+    double tot=0;
+    for (long i=segs[k];i<segs[k+1];i++)
+      tot+=dat[perm[i]];
+    map[upix[k]]+=tot;
+  }
+}
+
+/*--------------------------------------------------------------------------------*/
+//pointing can be stored compressed as each detector's first pixel (base) plus the sample-to-sample
+//pixel differences as 1 or 2 byte ints (delta, with delta[det*ndata] unused).  These kernels rebuild
+//the pixel with a running sum as they walk each detector, so the full int32 ipix is never formed.
+void map2tod_delta(double *dat, double *map, int ndet, int ndata, int *base, void *delta, int nbyte, int do_add)
+{
+#pragma omp parallel for
+  for (int det=0;det<ndet;det++) {
+    long ii=det*(long)ndata;
+    double *mydat=dat+ii;
+    int pix=base[det];
+    if (nbyte==1) {
+      signed char *dd=(signed char *)delta+ii;
+      if (do_add) {
+	mydat[0]+=map[pix];
+	for (int i=1;i<ndata;i++) {
+	  pix+=dd[i];
+	  mydat[i]+=map[pix];
+	}
+      }
+      else {
+	mydat[0]=map[pix];
+	for (int i=1;i<ndata;i++) {
+	  pix+=dd[i];
+	  mydat[i]=map[pix];
+	}
+      }
+    }
+    else {
+      short *dd=(short *)delta+ii;
+      if (do_add) {
+	mydat[0]+=map[pix];
+	for (int i=1;i<ndata;i++) {
+	  pix+=dd[i];
+	  mydat[i]+=map[pix];
+	}
+      }
+      else {
+	mydat[0]=map[pix];
+	for (int i=1;i<ndata;i++) {
+	  pix+=dd[i];
+	  mydat[i]=map[pix];
+	}
+      }
+    }
+  }
+}
+/*--------------------------------------------------------------------------------*/
+static void decode_delta(int *pix, int base, void *delta, int nbyte, int ndata)
+//rebuild one detector's pixels from its delta-compressed pointing
+{
+  pix[0]=base;
+  if (nbyte==1) {
+    signed char *dd=(signed char *)delta;
+    for (int i=1;i<ndata;i++)
+      pix[i]=pix[i-1]+dd[i];
+  }
+  else {
+    short *dd=(short *)delta;
+    for (int i=1;i<ndata;i++)
+      pix[i]=pix[i-1]+dd[i];
+  }
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_delta(double *map, double *dat, int ndet, int ndata, int *base, void *delta, int nbyte, int npix, int do_omp)
+//tod2map from delta-compressed pointing.  Each thread decodes a detector at a time into its own
+//ndata-long pixel buffer and adds into its own copy of the map, as in tod2map_omp, so the full ipix
+//is never formed and there are no atomics.
+{
+  if (!do_omp) {
+    int *pix=(int *)malloc(ndata*sizeof(int));
+    for (int det=0;det<ndet;det++) {
+      long ii=det*(long)ndata;
+      double *mydat=dat+ii;
+      decode_delta(pix,base[det],(char *)delta+ii*nbyte,nbyte,ndata);
+      for (int i=0;i<ndata;i++)
+	map[pix[i]]+=mydat[i];
+    }
+    free(pix);
+    return;
+  }
+#pragma omp parallel
+  {
+    double *mymap=(double *)calloc(npix,sizeof(double));
+    int *pix=(int *)malloc(ndata*sizeof(int));
+#pragma omp for
+    for (int det=0;det<ndet;det++) {
+      long ii=det*(long)ndata;
+      double *mydat=dat+ii;
+      decode_delta(pix,base[det],(char *)delta+ii*nbyte,nbyte,ndata);
+      for (int i=0;i<ndata;i++)
+	mymap[pix[i]]+=mydat[i];
+    }
+#pragma omp critical
+    for (long i=0;i<npix;i++)
+      map[i]+=mymap[i];
+    free(pix);
+    free(mymap);
+  }
+}
+
+/*--------------------------------------------------------------------------------*/
+void map2tod_delta_float(float *dat, double *map, int ndet, int ndata, int *base, void *delta, int nbyte, int do_add)
+//single precision TOD version of map2tod_delta
+{
+#pragma omp parallel
+  {
+    int *pix=(int *)malloc(ndata*sizeof(int));
+#pragma omp for
+    for (int det=0;det<ndet;det++) {
+      long ii=det*(long)ndata;
+      float *mydat=dat+ii;
+      decode_delta(pix,base[det],(char *)delta+ii*nbyte,nbyte,ndata);
+      if (do_add)
+	for (int i=0;i<ndata;i++)
+	  mydat[i]+=map[pix[i]];
+      else
+	for (int i=0;i<ndata;i++)
+	  mydat[i]=map[pix[i]];
+    }
+    free(pix);
+  }
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_delta_float(double *map, float *dat, int ndet, int ndata, int *base, void *delta, int nbyte, int npix, int do_omp)
+//single precision TOD version of tod2map_delta
+{
+  if (!do_omp) {
+    int *pix=(int *)malloc(ndata*sizeof(int));
+    for (int det=0;det<ndet;det++) {
+      long ii=det*(long)ndata;
+      float *mydat=dat+ii;
+      decode_delta(pix,base[det],(char *)delta+ii*nbyte,nbyte,ndata);
+      for (int i=0;i<ndata;i++)
+	map[pix[i]]+=mydat[i];
+    }
+    free(pix);
+    return;
+  }
+#pragma omp parallel
+  {
+    double *mymap=(double *)calloc(npix,sizeof(double));
+    int *pix=(int *)malloc(ndata*sizeof(int));
+#pragma omp for
+    for (int det=0;det<ndet;det++) {
+      long ii=det*(long)ndata;
+      float *mydat=dat+ii;
+      decode_delta(pix,base[det],(char *)delta+ii*nbyte,nbyte,ndata);
+      for (int i=0;i<ndata;i++)
+	mymap[pix[i]]+=mydat[i];
+    }
+#pragma omp critical
+    for (long i=0;i<npix;i++)
+      map[i]+=mymap[i];
+    free(pix);
+    free(mymap);
+  }
+}
+
+/*--------------------------------------------------------------------------------*/
+//single precision TOD versions of the basic projection kernels.  Maps stay double, so everything
+//accumulated into a map is summed in double.
+void tod2map_simple_float(double *map, float *dat, int ndet, int ndata, int *pix)
+{
+  long nn=ndet*(long)ndata;
+  for (long i=0;i<nn;i++)
+    map[pix[i]]+=dat[i];
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_atomic_float(double *map, float *dat, int ndet, int ndata, int *pix)
+{
+  long nn=ndet*(long)ndata;
+#pragma omp parallel for
+  for (long i=0;i<nn;i++)
+#pragma omp atomic
+    map[pix[i]]+=dat[i];
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_omp_float(double *map, float *dat, int ndet, int ndata, int *pix, int npix)
+{
+  long nn=ndet*(long)ndata;
+#pragma omp parallel 
+  {
+    double *mymap=(double *)calloc(npix,sizeof(double));
+    #pragma omp for
+    for (long i=0;i<nn;i++)
+      mymap[pix[i]]+=dat[i];
+    #pragma omp critical
+    for (long i=0;i<npix;i++)
+      map[i]+=mymap[i];
+    free(mymap);
+  }
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_sorted_float(double *map, float *dat, int *perm, int *upix, long *segs, long nseg)
+{
+#pragma omp parallel for schedule(guided)
+  for (long k=0;k<nseg;k++) {
+    double tot=0;
+    for (long i=segs[k];i<segs[k+1];i++)
+      tot+=dat[perm[i]];
+    map[upix[k]]+=tot;
+  }
+}
+/*--------------------------------------------------------------------------------*/
+void map2tod_simple_float(float *dat, double *map, int ndet, int ndata, int *pix, int do_add)
+{
+  long nn=ndet*(long)ndata;
+  if (do_add)
+    for (long i=0;i<nn;i++)
+      dat[i]+=map[pix[i]];
+  else
+    for (long i=0;i<nn;i++)
+      dat[i]=map[pix[i]];
+}
+/*--------------------------------------------------------------------------------*/
+void map2tod_omp_float(float *dat, double *map, int ndet, int ndata, int *pix, int do_add)
+{
+  long nn=ndet*(long)ndata;
+  if (do_add)
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]+=map[pix[i]];
+  else
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]=map[pix[i]];
+}
+
+/*--------------------------------------------------------------------------------*/
+static inline int radec2pix_one(double ra, double dec, double *pp, int ny)
+//pixel index of one ra/dec (radians) sample.  pp comes from get_wcs_pix_params/get_pix_params in minkasi.py.
+//pp[0] is 0 for CAR, 1 for TAN, 2 for a plain linear ra/dec->pixel map, 3 for a CAR map whose native and
+//celestial poles line up.  Linear maps have x=pp[1]*ra+pp[2], y=pp[3]*dec+pp[4].  Pole-aligned CAR maps have
+//native longitude phi=pp[1]*ra+pp[2] wrapped into (-pi,pi], x=pp[3]*phi+pp[4], y=pp[5]*dec+pp[6].  Otherwise pp[1..4] are the celestial longitude, sin/cos of the latitude,
+//and the native longitude of the native pole, pp[5..6] are the zero-offset reference pixel, pp[7..10]
+//convert intermediate coordinates (radians) to pixels, and pp[11..12] are cos/sin of the native pole longitude.
+//See Calabretta & Greisen (2002).
+{
+  double x,y;
+  if (pp[0]==2) {
+    x=pp[1]*ra+pp[2];
+    y=pp[3]*dec+pp[4];
+  }
+  else if (pp[0]==3) {
+    double u=pp[1]*ra+pp[2];
+    u-=2*M_PI*ceil((u-M_PI)/(2*M_PI));
+    x=pp[3]*u+pp[4];
+    y=pp[5]*dec+pp[6];
+  }
+  else {
+    double da=ra-pp[1];
+    double cd=cos(dec);
+    double sd=sin(dec);
+    double cda=cos(da);
+    double a=-cd*sin(da);             //cos(theta)*sin(phi-phi_p)
+    double b=sd*pp[3]-cd*pp[2]*cda;   //cos(theta)*cos(phi-phi_p)
+    double st=sd*pp[2]+cd*pp[3]*cda;  //sin(theta)
+    double u,v;
+    if (pp[0]==0) {
+      u=pp[4]+atan2(a,b);
+      if (u>M_PI)
+	u-=2*M_PI;
+      if (u<=-M_PI)
+	u+=2*M_PI;
+      v=asin(st);
+    }
+    else {
+      //TAN has R=cot(theta), so we never need the angles themselves
+      u=(a*pp[11]+b*pp[12])/st;
+      v=(a*pp[12]-b*pp[11])/st;
+    }
+    x=pp[5]+pp[7]*u+pp[8]*v;
+    y=pp[6]+pp[9]*u+pp[10]*v;
+  }
+  return ((int)floor(x+0.5))*ny+(int)floor(y+0.5);
+}
+
+/*--------------------------------------------------------------------------------*/
+void radec2pix(int *ipix, double *ra, double *dec, long n, double *pp, int ny)
+//fill ipix with the pixels of n ra/dec samples, replacing the astropy wcs_world2pix path
+{
+#pragma omp parallel for
+  for (long i=0;i<n;i++)
+    ipix[i]=radec2pix_one(ra[i],dec[i],pp,ny);
+}
+
+/*--------------------------------------------------------------------------------*/
+void map2tod_onthefly(double *dat, double *map, int ndet, int ndata, double *ra, double *dec, double *pp, int ny, int do_add)
+//map2tod computing pixels straight from the pointing, so no ipix is ever stored.
+{
+  long nn=ndet*(long)ndata;
+  if (do_add)
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]+=map[radec2pix_one(ra[i],dec[i],pp,ny)];
+  else
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]=map[radec2pix_one(ra[i],dec[i],pp,ny)];
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_onthefly(double *map, double *dat, int ndet, int ndata, double *ra, double *dec, double *pp, int ny, int do_omp)
+//tod2map computing pixels straight from the pointing.  Threads can collide in the map, so adds are atomic.
+{
+  long nn=ndet*(long)ndata;
+#pragma omp parallel for if(do_omp)
+  for (long i=0;i<nn;i++) {
+    int pix=radec2pix_one(ra[i],dec[i],pp,ny);
+#pragma omp atomic
+    map[pix]+=dat[i];
+  }
+}
+
+/*--------------------------------------------------------------------------------*/
+void map2tod_onthefly_float(float *dat, double *map, int ndet, int ndata, double *ra, double *dec, double *pp, int ny, int do_add)
+//single precision TOD version of map2tod_onthefly
+{
+  long nn=ndet*(long)ndata;
+  if (do_add)
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]+=map[radec2pix_one(ra[i],dec[i],pp,ny)];
+  else
+#pragma omp parallel for
+    for (long i=0;i<nn;i++)
+      dat[i]=map[radec2pix_one(ra[i],dec[i],pp,ny)];
+}
+/*--------------------------------------------------------------------------------*/
+void tod2map_onthefly_float(double *map, float *dat, int ndet, int ndata, double *ra, double *dec, double *pp, int ny, int do_omp)
+//single precision TOD version of tod2map_onthefly
+{
+  long nn=ndet*(long)ndata;
+#pragma omp parallel for if(do_omp)
+  for (long i=0;i<nn;i++) {
+    int pix=radec2pix_one(ra[i],dec[i],pp,ny);
+#pragma omp atomic
+    map[pix]+=dat[i];
+  }
+}
+
 /*--------------------------------------------------------------------------------*/
 //project a map into a tod, adding or replacing the map contents.  Add map to tod if do_add is true
 void map2tod_simple(double *dat, double *map, int ndet, int ndata, int *pix, int do_add)
@@ -447,3 +805,69 @@ void outer_block(double *A,double *fitp,double *vec,double *out,int n,int ndet,i
 	}
     }
 }
+
+/*--------------------------------------------------------------------------------*/
+//in-place y+=a*x, used by the PCG solver to update maps without making copies
+void axpy_omp(double *y, double *x, double a, long n)
+{
+#pragma omp parallel for
+  for (long i=0;i<n;i++)
+    y[i]+=a*x[i];
+}
+
+/*--------------------------------------------------------------------------------*/
+//in-place y=x+a*y, the search direction update in PCG
+void aypx_omp(double *y, double *x, double a, long n)
+{
+#pragma omp parallel for
+  for (long i=0;i<n;i++)
+    y[i]=x[i]+a*y[i];
+}
+
+/*--------------------------------------------------------------------------------*/
+double dot_omp(double *x, double *y, long n)
+{
+  double tot=0;
+#pragma omp parallel for reduction(+:tot)
+  for (long i=0;i<n;i++)
+    tot+=x[i]*y[i];
+  return tot;
+}
+
+/*--------------------------------------------------------------------------------*/
+//fused PCG residual update.  r+=a*x, then z=w*r (diagonal preconditioner), and return r.z
+//in a single pass.  If w is NULL, there's no preconditioner and z is set to r (skipped if
+//z and r are the same array).
+double axpy_precon_dot_omp(double *r, double *x, double a, double *w, double *z, long n)
+{
+  double tot=0;
+  if (w) {
+#pragma omp parallel for reduction(+:tot)
+    for (long i=0;i<n;i++) {
+      double rr=r[i]+a*x[i];
+      r[i]=rr;
+      z[i]=w[i]*rr;
+      tot+=rr*z[i];
+    }
+  }
+  else {
+    if (z==r) {
+#pragma omp parallel for reduction(+:tot)
+      for (long i=0;i<n;i++) {
+	double rr=r[i]+a*x[i];
+	r[i]=rr;
+	tot+=rr*rr;
+      }
+    }
+    else {
+#pragma omp parallel for reduction(+:tot)
+      for (long i=0;i<n;i++) {
+	double rr=r[i]+a*x[i];
+	r[i]=rr;
+	z[i]=rr;
+	tot+=rr*rr;
+      }
+    }
+  }
+  return tot;
+}
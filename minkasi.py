@@ -11,6 +11,13 @@ from astropy.cosmology import WMAP9 as cosmo #choose your cosmology here
 import scipy
 import copy
 import sys
+import os
+import pickle
+import hashlib
+import tracemalloc
+import concurrent.futures
+import threading
+import queue
 try:
     import healpy
     have_healpy=True
@@ -23,6 +30,12 @@ try:
 except:
     have_numba=False
 
+try:
+    from threadpoolctl import threadpool_limits
+    have_threadpoolctl=True
+except:
+    have_threadpoolctl=False
+
 try:
     import qpoint as qp
     have_qp=True
@@ -57,21 +70,69 @@ tod2map_simple_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c
 tod2map_atomic_c=mylib.tod2map_atomic
 tod2map_atomic_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p]
 
-#tod2map_everyone_c=mylib.tod2map_everyone
-#tod2map_everyone_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
+tod2map_everyone_c=mylib.tod2map_everyone
+tod2map_everyone_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int]
 
 tod2map_omp_c=mylib.tod2map_omp
 tod2map_omp_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
 
+tod2map_simple_float_c=mylib.tod2map_simple_float
+tod2map_simple_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p]
+
+tod2map_atomic_float_c=mylib.tod2map_atomic_float
+tod2map_atomic_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p]
+
+tod2map_omp_float_c=mylib.tod2map_omp_float
+tod2map_omp_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
+
+tod2map_sorted_float_c=mylib.tod2map_sorted_float
+tod2map_sorted_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_long]
+
+map2tod_simple_float_c=mylib.map2tod_simple_float
+map2tod_simple_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
+
+map2tod_omp_float_c=mylib.map2tod_omp_float
+map2tod_omp_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
+
 tod2map_cached_c=mylib.tod2map_cached
 tod2map_cached_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
 
+tod2map_sorted_c=mylib.tod2map_sorted
+tod2map_sorted_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_long]
+
 map2tod_simple_c=mylib.map2tod_simple
 map2tod_simple_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
 
 map2tod_omp_c=mylib.map2tod_omp
 map2tod_omp_c.argtypes=[ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p,ctypes.c_int]
 
+map2tod_delta_c=mylib.map2tod_delta
+map2tod_delta_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
+tod2map_delta_c=mylib.tod2map_delta
+tod2map_delta_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int]
+
+map2tod_delta_float_c=mylib.map2tod_delta_float
+map2tod_delta_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
+tod2map_delta_float_c=mylib.tod2map_delta_float
+tod2map_delta_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int]
+
+radec2pix_c=mylib.radec2pix
+radec2pix_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_long,ctypes.c_void_p,ctypes.c_int]
+
+map2tod_onthefly_c=mylib.map2tod_onthefly
+map2tod_onthefly_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
+tod2map_onthefly_c=mylib.tod2map_onthefly
+tod2map_onthefly_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
+map2tod_onthefly_float_c=mylib.map2tod_onthefly_float
+map2tod_onthefly_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
+tod2map_onthefly_float_c=mylib.tod2map_onthefly_float
+tod2map_onthefly_float_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int]
+
 map2tod_iqu_omp_c=mylib.map2tod_iqu_omp
 map2tod_iqu_omp_c.argtypes=[ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_int]
 
@@ -120,6 +181,20 @@ fill_gauss_src_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctype
 outer_c=mylib.outer_block
 outer_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int]
 
+axpy_omp_c=mylib.axpy_omp
+axpy_omp_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_double,ctypes.c_long]
+
+aypx_omp_c=mylib.aypx_omp
+aypx_omp_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_double,ctypes.c_long]
+
+dot_omp_c=mylib.dot_omp
+dot_omp_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_long]
+dot_omp_c.restype=ctypes.c_double
+
+axpy_precon_dot_omp_c=mylib.axpy_precon_dot_omp
+axpy_precon_dot_omp_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_double,ctypes.c_void_p,ctypes.c_void_p,ctypes.c_long]
+axpy_precon_dot_omp_c.restype=ctypes.c_double
+
 
 
 def y2rj(freq=90):
@@ -165,33 +240,213 @@ def invsafe(mat,thresh=1e-14):
     tmp=np.dot(np.diag(s_inv),u.transpose())
     return np.dot(v.transpose(),tmp)
 
+def _is_single(dat):
+    return dat.dtype==np.dtype('float32')
+def _as_double(dat):
+    #for kernels that only come in double.  This copies single-precision TODs, so the float32
+    #versions of the common kernels should be preferred.
+    return np.ascontiguousarray(dat,dtype='float64')
+
 def tod2map_simple(map,dat,ipix):
     ndet=dat.shape[0]
     ndata=dat.shape[1]
     if not(ipix.dtype=='int32'):
         print("Warning - ipix is not int32 in tod2map_simple.  this is likely to produce garbage results.")
-    tod2map_simple_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data)
-def tod2map_everyone(map,dat,ipix,edges):
-    assert(len(edges)==get_nthread()+1)
-    tod2map_everyone_c(map.ctypes.data,dat.ctypes.data,dat.shape[0],dat.shape[1],ipix.ctypes.data,map.size,edges.ctypes.data,len(edges))
+    if _is_single(dat):
+        tod2map_simple_float_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data)
+    else:
+        tod2map_simple_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data)
+def get_everyone_pix(ipix,nthread=None):
+    """Split the pixels hit by ipix into nthread contiguous ranges holding roughly equal numbers of samples,
+    and group the samples by range.  Returns the grouped sample indices, offsets of each range's samples,
+    and the pixel edges of the ranges, for use by tod2map_everyone."""
+    if nthread is None:
+        nthread=get_nthread()
+    ipix=np.ravel(ipix)
+    assert(ipix.size<2**31) #sample indices are stored as int32
+    spix=np.sort(ipix)
+    edges=np.zeros(nthread+1,dtype='int64')
+    edges[1:-1]=spix[(len(spix)*np.arange(1,nthread))//nthread]
+    edges[-1]=spix[-1]+1
+    owner=np.searchsorted(edges,ipix,side='right')-1
+    perm=np.asarray(np.argsort(owner,kind='stable'),dtype='int32')
+    offsets=np.zeros(nthread+1,dtype='int64')
+    offsets[1:]=np.cumsum(np.bincount(owner,minlength=nthread))
+    return perm,offsets,edges
+
+def tod2map_everyone(map,dat,ipix,perm,offsets):
+    dat=_as_double(dat)
+    assert(dat.flags.c_contiguous)
+    if not(ipix.dtype=='int32'):
+        print("Warning - ipix is not int32 in tod2map_everyone.  this is likely to produce garbage results.")
+    tod2map_everyone_c(map.ctypes.data,dat.ctypes.data,ipix.ctypes.data,perm.ctypes.data,offsets.ctypes.data,len(offsets)-1)
 
 def tod2map_omp(map,dat,ipix,atomic=False):
     ndet=dat.shape[0]
     ndata=dat.shape[1]
     if not(ipix.dtype=='int32'):
         print("Warning - ipix is not int32 in tod2map_omp.  this is likely to produce garbage results.")
-    if atomic:
+    if _is_single(dat):
+        if atomic:
+            tod2map_atomic_float_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data)
+        else:
+            tod2map_omp_float_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data,map.size)
+    elif atomic:
         tod2map_atomic_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data,map.size)
     else:
         tod2map_omp_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data,map.size)
 
 def tod2map_cached(map,dat,ipix):
+    dat=_as_double(dat)
     ndet=dat.shape[0]
     ndata=dat.shape[1]
     if not(ipix.dtype=='int32'):
         print("Warning - ipix is not int32 in tod2map_cached.  this is likely to produce garbage results.")
     tod2map_cached_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ipix.ctypes.data,map.shape[1])
     
+def get_sorted_pix(ipix):
+    """Build the pixel-sorted index used by tod2map_sorted.  Returns the permutation that puts samples
+    in pixel order, the pixels that get hit, and the start/stop of each pixel's run of samples.  The sort
+    is stable, so samples in a pixel are always summed in the same order regardless of thread count."""
+    ipix=np.ravel(ipix)
+    assert(ipix.size<2**31) #permutation is stored as int32
+    perm=np.argsort(ipix,kind='stable')
+    spix=ipix[perm]
+    edges=np.flatnonzero(np.diff(spix))+1
+    segs=np.zeros(len(edges)+2,dtype='int64')
+    segs[1:-1]=edges
+    segs[-1]=len(spix)
+    upix=np.asarray(spix[segs[:-1]],dtype='int32')
+    perm=np.asarray(perm,dtype='int32')
+    return perm,upix,segs
+
+def tod2map_sorted(map,dat,perm,upix,segs):
+    assert(dat.flags.c_contiguous)
+    if _is_single(dat):
+        tod2map_sorted_float_c(map.ctypes.data,dat.ctypes.data,perm.ctypes.data,upix.ctypes.data,segs.ctypes.data,len(upix))
+        return
+    dat=_as_double(dat)
+    tod2map_sorted_c(map.ctypes.data,dat.ctypes.data,perm.ctypes.data,upix.ctypes.data,segs.ctypes.data,len(upix))
+
+class DeltaPix:
+    """Compressed pixellization: each detector's first pixel, plus the sample-to-sample pixel differences
+    stored as int8 or int16.  Scanning detectors mostly step to a neighbouring pixel, so this takes 2-4x
+    less memory than an int32 ipix.  Use compress_pix to build one, since not every ipix fits."""
+    def __init__(self,ipix,dtype):
+        self.shape=ipix.shape
+        self.base=np.ascontiguousarray(ipix[:,0],dtype='int32')
+        self.delta=np.zeros(ipix.shape,dtype=dtype)
+        self.delta[:,1:]=np.diff(ipix,axis=1)
+        self.nbyte=self.delta.itemsize
+    def get_ipix(self):
+        ipix=np.cumsum(self.delta,axis=1,dtype='int32')
+        ipix+=np.reshape(self.base,[len(self.base),1])
+        return ipix
+    def nbytes(self):
+        return self.base.nbytes+self.delta.nbytes
+
+def compress_pix(ipix):
+    """Return a DeltaPix for ipix with the smallest delta type that holds every step, or ipix itself
+    if some step is too big for an int16."""
+    if ipix.ndim!=2 or ipix.shape[1]<2:
+        return ipix
+    dmax=np.abs(np.diff(np.asarray(ipix,dtype='int64'),axis=1)).max()
+    if dmax<2**7:
+        return DeltaPix(ipix,'int8')
+    if dmax<2**15:
+        return DeltaPix(ipix,'int16')
+    return ipix
+
+def map2tod_delta(dat,map,dpix,do_add=False):
+    ndet=dat.shape[0]
+    ndata=dat.shape[1]
+    assert(dpix.shape==dat.shape)
+    if _is_single(dat):
+        map2tod_delta_float_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,dpix.base.ctypes.data,dpix.delta.ctypes.data,dpix.nbyte,do_add)
+        return
+    map2tod_delta_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,dpix.base.ctypes.data,dpix.delta.ctypes.data,dpix.nbyte,do_add)
+
+def tod2map_delta(map,dat,dpix,do_omp=True):
+    ndet=dat.shape[0]
+    ndata=dat.shape[1]
+    assert(dpix.shape==dat.shape)
+    if _is_single(dat):
+        tod2map_delta_float_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,dpix.base.ctypes.data,dpix.delta.ctypes.data,dpix.nbyte,map.size,do_omp)
+        return
+    dat=_as_double(dat)
+    tod2map_delta_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,dpix.base.ctypes.data,dpix.delta.ctypes.data,dpix.nbyte,map.size,do_omp)
+
+def get_wcs_pix_params(w):
+    """Pack a CAR or TAN wcs into the parameter array the C pixelizers (radec2pix_one in minkasi.c) use
+    to reproduce wcs_world2pix.  Returns None for projections they don't know."""
+    proj=w.wcs.ctype[0][-3:]
+    if proj=='CAR':
+        code=0
+        theta0=0.0
+    elif proj=='TAN':
+        code=1
+        theta0=np.pi/2
+    else:
+        return None
+    w.wcs.set()
+    ra0,dec0=np.asarray(w.wcs.crval)*np.pi/180
+    phip=w.wcs.lonpole*np.pi/180
+    if code==1:
+        decp=dec0 #zenithal projections have the native pole at the reference point
+    else:
+        decp=w.wcs.latpole*np.pi/180
+    #celestial longitude of the native pole, eq. 10 of Calabretta & Greisen (2002) with phi0=0
+    if np.abs(np.cos(decp))<1e-12:
+        if decp>0:
+            rap=ra0+phip-np.pi
+        else:
+            rap=ra0-phip
+    else:
+        rap=ra0-np.arctan2(np.sin(phip)*np.cos(theta0),(np.sin(theta0)-np.sin(dec0)*np.sin(decp))/np.cos(decp))
+    cd=np.dot(np.diag(w.wcs.get_cdelt()),w.wcs.get_pc())
+    icd=np.linalg.inv(cd)*180/np.pi
+    crpix=np.asarray(w.wcs.crpix)-1
+    if code==0 and np.abs(np.cos(decp))<1e-12 and icd[0,1]==0 and icd[1,0]==0:
+        #native and celestial poles line up, so CAR is linear in ra/dec and we can skip the trig.  The native
+        #longitude still gets wrapped into (-pi,pi] per sample so maps crossing ra=0 agree with wcs_world2pix.
+        sgn=np.sign(decp)
+        return np.asarray([3,sgn,phip-sgn*rap+(np.pi if sgn>0 else 0),icd[0,0],crpix[0],sgn*icd[1,1],crpix[1]],dtype='float64')
+    return np.asarray([code,rap,np.sin(decp),np.cos(decp),phip,crpix[0],crpix[1],icd[0,0],icd[0,1],icd[1,0],icd[1,1],np.cos(phip),np.sin(phip)],dtype='float64')
+
+def radec2pix(ra,dec,params,ny):
+    """int32 pixel indices of ra/dec (radians) for a map with ny pixels along dec, using params from get_wcs_pix_params."""
+    ra=np.ascontiguousarray(ra,dtype='float64')
+    dec=np.ascontiguousarray(dec,dtype='float64')
+    assert(ra.shape==dec.shape)
+    ipix=np.empty(ra.shape,dtype='int32')
+    radec2pix_c(ipix.ctypes.data,ra.ctypes.data,dec.ctypes.data,ra.size,params.ctypes.data,ny)
+    return ipix
+
+def map2tod_onthefly(dat,map,ra,dec,params,ny,do_add=False):
+    ndet=dat.shape[0]
+    ndata=dat.shape[1]
+    ra=np.ascontiguousarray(ra,dtype='float64')
+    dec=np.ascontiguousarray(dec,dtype='float64')
+    assert(ra.shape==dat.shape)
+    assert(dec.shape==dat.shape)
+    if _is_single(dat):
+        map2tod_onthefly_float_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,ra.ctypes.data,dec.ctypes.data,params.ctypes.data,ny,do_add)
+        return
+    map2tod_onthefly_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,ra.ctypes.data,dec.ctypes.data,params.ctypes.data,ny,do_add)
+
+def tod2map_onthefly(map,dat,ra,dec,params,ny,do_omp=True):
+    ndet=dat.shape[0]
+    ndata=dat.shape[1]
+    ra=np.ascontiguousarray(ra,dtype='float64')
+    dec=np.ascontiguousarray(dec,dtype='float64')
+    assert(ra.shape==dat.shape)
+    assert(dec.shape==dat.shape)
+    if _is_single(dat):
+        tod2map_onthefly_float_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ra.ctypes.data,dec.ctypes.data,params.ctypes.data,ny,do_omp)
+        return
+    dat=_as_double(dat)
+    tod2map_onthefly_c(map.ctypes.data,dat.ctypes.data,ndet,ndata,ra.ctypes.data,dec.ctypes.data,params.ctypes.data,ny,do_omp)
+
 def tod2polmap(map,dat,poltag,twogamma,ipix):
     ndet=dat.shape[0]
     ndata=dat.shape[1]
@@ -212,7 +467,12 @@ def tod2polmap(map,dat,poltag,twogamma,ipix):
 def map2tod(dat,map,ipix,do_add=False,do_omp=True):
     ndet=dat.shape[0]
     ndata=dat.shape[1]
-    if do_omp:
+    if _is_single(dat):
+        if do_omp:
+            map2tod_omp_float_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,ipix.ctypes.data,do_add)
+        else:
+            map2tod_simple_float_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,ipix.ctypes.data,do_add)
+    elif do_omp:
         map2tod_omp_c(dat.ctypes.data, map.ctypes.data, ndet, ndata, ipix.ctypes.data, do_add)
     else:
         map2tod_simple_c(dat.ctypes.data,map.ctypes.data,ndet,ndata,ipix.ctypes.data,do_add)
@@ -234,7 +494,50 @@ def polmap2tod(dat,map,poltag,twogamma,ipix,do_add=False,do_omp=True):
         return
     #print('calling ' + repr(fun))
     fun(dat.ctypes.data,map.ctypes.data,twogamma.ctypes.data,ndet,ndata,ipix.ctypes.data,do_add)
-    
+
+def _is_fast_vec(*arrs):
+    #the C vector kernels want contiguous doubles of the same size
+    for arr in arrs:
+        if not(arr is None):
+            if not(arr.dtype==np.dtype('float64')) or not(arr.flags.c_contiguous) or not(arr.size==arrs[0].size):
+                return False
+    return True
+
+def axpy_inplace(y,x,a):
+    """y+=a*x in place, with no temporary arrays."""
+    if _is_fast_vec(y,x):
+        axpy_omp_c(y.ctypes.data,x.ctypes.data,a,y.size)
+    else:
+        y+=a*x
+
+def aypx_inplace(y,x,a):
+    """y=x+a*y in place, with no temporary arrays."""
+    if _is_fast_vec(y,x):
+        aypx_omp_c(y.ctypes.data,x.ctypes.data,a,y.size)
+    else:
+        y*=a
+        y+=x
+
+def dot_inplace(x,y):
+    if _is_fast_vec(x,y):
+        return dot_omp_c(x.ctypes.data,y.ctypes.data,x.size)
+    return np.vdot(x,y)
+
+def axpy_precon_dot(r,x,a,w,z):
+    """Fused PCG residual update:  r+=a*x, z=w*r, return r.z.  w=None means no preconditioner, in
+    which case z can be the same array as r."""
+    if _is_fast_vec(r,x,w,z):
+        if w is None:
+            return axpy_precon_dot_omp_c(r.ctypes.data,x.ctypes.data,a,None,z.ctypes.data,r.size)
+        return axpy_precon_dot_omp_c(r.ctypes.data,x.ctypes.data,a,w.ctypes.data,z.ctypes.data,r.size)
+    r+=a*x
+    if w is None:
+        if not(z is r):
+            z[:]=r
+    else:
+        np.multiply(w,r,out=z)
+    return np.vdot(r,z)
+
 def read_fits_map(fname,hdu=0,do_trans=True):
     f=fits.open(fname)
     raw=f[hdu].data
@@ -257,8 +560,51 @@ def get_ft_vec(n):
     return x
 
 
-def set_nthread(nthread):
+def set_nthread(nthread=None,fftw=True,numba=True,pin=False):
+    """Set the thread count for everything that threads: OpenMP in libminkasi, FFTW (mkfftw.set_threaded, which also
+    sets how many blocks the batched r2r transforms get split into) and numba's pool.  With pin set, each MPI
+    process gets its own share of the cores on its node (see get_rank_cores), and nthread defaults to the size
+    of that share.  Threads keep the affinity they started with, so pin before doing anything threaded.  Use
+    set_local_nthread for a thread count that only applies to the calling thread."""
+    if pin:
+        cores=get_rank_cores()
+        os.sched_setaffinity(0,cores)
+        if nthread is None:
+            nthread=len(cores)
+    if nthread is None:
+        try:
+            nthread=len(os.sched_getaffinity(0))
+        except:
+            nthread=os.cpu_count()
     set_nthread_c(nthread)
+    if fftw:
+        mkfftw.set_threaded(nthread)
+    if numba and have_numba:
+        nb.set_num_threads(int(min(nthread,nb.config.NUMBA_NUM_THREADS)))
+
+def set_local_nthread(nthread):
+    """OpenMP and FFTW thread counts for work done from the calling thread only, e.g. a worker in a thread pool.
+    For FFTW, 0 goes back to the process-wide count."""
+    if nthread>0:
+        set_nthread_c(nthread)
+    mkfftw.set_local_nthread(nthread)
+
+def get_rank_cores():
+    """The cores this process should use if the processes on a node split its cores between them.  If the
+    processes were already started with different affinities (e.g. by mpirun), keep what we were given."""
+    cores=sorted(os.sched_getaffinity(0))
+    if not(have_mpi):
+        return cores
+    local=comm.Split_type(MPI.COMM_TYPE_SHARED)
+    nlocal=local.Get_size()
+    ilocal=local.Get_rank()
+    all_cores=local.allgather(cores)
+    local.Free()
+    if not(np.all([cc==cores for cc in all_cores])):
+        return cores
+    nper=max(len(cores)//nlocal,1)
+    i0=(ilocal*nper)%len(cores)
+    return cores[i0:i0+nper]
 
 def get_nthread():
     nthread=np.zeros([1,1],dtype='int32')
@@ -676,60 +1022,83 @@ def read_octave_struct(fname):
 
 
 
-def nsphere_vol(npp):
-    iseven=(npp%2)==0
-    if iseven:
-        nn=npp/2
-        vol=(np.pi**nn)/np.prod(np.arange(1,nn+1))
-    else:
-        nn=(npp-1)/2
-        vol=2**(nn+1)*np.pi**nn/np.prod(np.arange(1,npp+1,2))
-    return vol
-
-
-def _prime_loop(ln,lp,icur,lcur,vals):
-    facs=np.arange(lcur,ln+1e-3,lp[0])
-    if len(lp)==1:
-        nfac=len(facs)
-        if (nfac>0):
-            vals[icur:(icur+nfac)]=facs
-            icur=icur+nfac
-            #print 2**vals[:icur]
-        else:
-            print('bad facs came from ' + repr([2**lcur,2**ln,2**lp[0]]))
-        #print icur
-        return icur
-    else:
-        facs=np.arange(lcur,ln,lp[0])
-        for fac in facs:
-            icur=_prime_loop(ln,lp[1:],icur,fac,vals)
-        return icur
-    print('I don''t think I should have gotten here.')
-    return icur
-                             
-        
+_smooth_tables={}
+
+def get_smooth_table(n,primes=[2,3,5,7]):
+    """Sorted table of every number up to at least n with no prime factors outside primes.  Tables are built
+    with exact integer products, cached per set of primes, and regrown (to the next power of two) when
+    someone asks for a bigger n."""
+    key=tuple(sorted(primes))
+    table=_smooth_tables.get(key)
+    if not(table is None) and table[-1]>=n:
+        return table
+    nmax=int(2**np.ceil(np.log2(max(n,2))))
+    vals=np.ones(1,dtype='int64')
+    for p in key:
+        pows=[1]
+        while pows[-1]*p<=nmax:
+            pows.append(pows[-1]*p)
+        vals=np.ravel(np.outer(vals,np.asarray(pows,dtype='int64')))
+        vals=vals[vals<=nmax]
+    table=np.sort(vals)
+    _smooth_tables[key]=table
+    return table
 
 def find_good_fft_lens(n,primes=[2,3,5,7]):
-    lmax=np.log(n+0.5)
-    npr=len(primes)
-    vol=nsphere_vol(npr)
-
-    r=np.log2(n+0.5)
-    lp=np.log2(primes)
-    npoint_max=(vol/2**npr)*np.prod(r/lp)+30 #add a bit just to make sure we don't act up for small n
-    #print 'npoint max is ',npoint max
-    npoint_max=np.int(npoint_max)
-
-    #vals=np.zeros(npoint_max,dtype='int')
-    vals=np.zeros(npoint_max)
-    icur=0
-    icur=_prime_loop(r,lp,icur,0.0,vals)
-    assert(icur<=npoint_max)
-    myvals=np.asarray(np.round(2**vals[:icur]),dtype='int')
-    myvals=np.sort(myvals)
-    return myvals
-    
-    
+    """All the lengths up to n with no prime factors outside primes, in increasing order."""
+    table=get_smooth_table(n,primes)
+    return table[:np.searchsorted(table,n,side='right')].copy()
+
+def get_good_fft_len(n,primes=[2,3,5,7],below=True):
+    """The largest length <=n (or with below=False, the smallest length >=n) with no prime factors outside primes."""
+    table=get_smooth_table(n,primes)
+    if below:
+        return int(table[np.searchsorted(table,n,side='right')-1])
+    return int(table[np.searchsorted(table,n,side='left')])
+
+_dct_timings={}
+_fast_dct_lens={}
+
+def time_dct_len(n,nrow=16,dtype='float64',ntry=3):
+    """Best-of-ntry time per sample for an nrow-batch DCT-I of length n in dtype, cached for the life of the process."""
+    dtype=np.dtype(dtype)
+    key=(n,nrow,dtype.str)
+    if not(key in _dct_timings):
+        dat=np.asarray(np.random.randn(nrow,n),dtype=dtype)
+        trans=np.empty_like(dat)
+        mkfftw.fft_r2r(dat,trans) #plan first so we don't time the planner
+        best=None
+        for i in range(ntry):
+            t1=time.time()
+            mkfftw.fft_r2r(dat,trans)
+            dt=time.time()-t1
+            if best is None or dt<best:
+                best=dt
+        _dct_timings[key]=best/(n*nrow)
+    return _dct_timings[key]
+
+def find_fastest_dct_len(n,primes=[2,3,5,7,11],max_loss=0.02,ncand=8,nrow=16,dtype='float64'):
+    """Time nrow-row DCT-Is in dtype for the lengths m+1<=n with m smooth in primes that keep at least 1-max_loss
+    of the samples (the ncand longest of them), and return the one with the lowest time per sample on this
+    machine.  The answer is remembered, so TODs of the same shape get the same length.  Timings taken while
+    other threads are busy are meaningless, so outside the main thread we only use remembered answers and
+    otherwise fall back to the longest smooth length; call this (or truncate_tod) from the main thread
+    before starting any worker pools if you want benchmarked lengths there."""
+    key=(n,tuple(sorted(primes)),max_loss,ncand,nrow,np.dtype(dtype).str)
+    if key in _fast_dct_lens:
+        return _fast_dct_lens[key]
+    if not(threading.current_thread() is threading.main_thread()):
+        return get_good_fft_len(n-1,primes)+1
+    table=get_smooth_table(n,primes)
+    cands=table[:np.searchsorted(table,n-1,side='right')]
+    cands=cands[cands+1>=(1-max_loss)*n][-ncand:]+1
+    if len(cands)==0:
+        n_new=get_good_fft_len(n-1,primes)+1
+    else:
+        times=[time_dct_len(int(m),nrow,dtype) for m in cands]
+        n_new=int(cands[np.argmin(times)])
+    _fast_dct_lens[key]=n_new
+    return n_new
 
 def _linfit_2mat(dat,mat1,mat2):
     np1=mat1.shape[1]
@@ -881,165 +1250,442 @@ def __run_pcg_old(b,x0,tods,mapset,precon):
         x=x_new
     return x
 
-def run_pcg(b,x0,tods,precon=None,maxiter=25,outroot='map',save_iters=[-1],save_ind=0,save_tail='.fits',plot_iters=[],plot_info=None,plot_ind=0):
-    
-    t1=time.time()
-    Ax=tods.dot(x0)
+def _pcg_residual_update(r,Ap,alpha,precon,z):
+    #r-=alpha*Ap, z=precon*r, and return r.z (and z, in case we had to make a new one).
+    #Mapsets do this in a single pass where the maps support it.  Pick the path up front rather than
+    #catching AttributeError, which could come from inside a fused call that had already updated r.
+    if hasattr(r,'axpy_precon_dot'):
+        zr=r.axpy_precon_dot(Ap,-alpha,precon,z)
+    else:
+        r.axpy(Ap,-alpha)
+        if precon is None:
+            z=r
+        else:
+            z=precon*r
+        zr=r.dot(z)
+    return zr,z
+
+def _pcg_direction_update(p,z,beta):
+    #p=z+beta*p, in place if we can
+    if hasattr(p,'aypx'):
+        p.aypx(z,beta)
+    else:
+        p_new=z.copy()
+        p_new.axpy(p,beta)
+        p=p_new
+    return p
 
+def _pcg_checkpoint_name(checkpoint):
+    #every process writes its own file, since timestream models live on the process that owns the TOD
+    if nproc>1:
+        return checkpoint+'_'+repr(myrank)+'.pkl'
+    return checkpoint+'.pkl'
+
+def get_pcg_fingerprint(b,tods):
+    """Summary of the problem a PCG run is solving (map types and shapes, |b|^2, and the TODs), stored
+    in checkpoints so we don't resume one written for a different right-hand side or TOD set."""
+    shapes=[]
+    for m in getattr(b,'maps',[]):
+        mm=getattr(m,'map',None)
+        shapes.append((type(m).__name__,None if mm is None else tuple(np.shape(mm))))
     try:
-        r=b.copy()
-        r.axpy(Ax,-1)
+        bnorm=float(b.dot(b))
     except:
-        r=b-Ax
-    if not(precon is None):
-        #print('applying precon')
-        z=precon*r
+        bnorm=None
+    names=[str(tod.info.get('fname',i)) for i,tod in enumerate(tods.tods)]
+    return {'maps':shapes,'bnorm':bnorm,'ntod':tods.ntod,'tods':hashlib.sha1(repr(names).encode()).hexdigest()}
+
+def _pcg_fingerprints_match(fp1,fp2,rtol=1e-8):
+    if fp1 is None or fp2 is None:
+        return False
+    for key in ['maps','ntod','tods']:
+        if fp1[key]!=fp2[key]:
+            return False
+    if fp1['bnorm'] is None or fp2['bnorm'] is None:
+        return fp1['bnorm']==fp2['bnorm']
+    return np.abs(fp1['bnorm']-fp2['bnorm'])<=rtol*np.abs(fp2['bnorm'])
+
+def save_pcg_checkpoint(checkpoint,iter,x,r,p,zr,zr0,conv_log,fingerprint=None):
+    """Save the PCG state after iteration iter so that run_pcg can pick up where it left off.
+    The file is written to a temporary name and moved into place, so a crash while writing 
+    leaves the previous checkpoint intact."""
+    fname=_pcg_checkpoint_name(checkpoint)
+    state={'iter':iter,'x':x,'r':r,'p':p,'zr':zr,'zr0':zr0,'conv_log':conv_log,'nproc':nproc,'fingerprint':fingerprint}
+    f=open(fname+'.tmp','wb')
+    pickle.dump(state,f,protocol=pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(fname+'.tmp',fname)
+
+def load_pcg_checkpoint(checkpoint,fingerprint=None):
+    """Read PCG state written by save_pcg_checkpoint.  Returns None unless every process 
+    has a checkpoint written under the same number of processes and, if fingerprint (from
+    get_pcg_fingerprint) is given, for the same problem."""
+    fname=_pcg_checkpoint_name(checkpoint)
+    state=None
+    if os.path.isfile(fname):
+        f=open(fname,'rb')
+        state=pickle.load(f)
+        f.close()
+        if state['nproc']!=nproc:
+            print('checkpoint ',fname,' was written with ',state['nproc'],' processes, not ',nproc,'.  Ignoring it.')
+            state=None
+        elif not(fingerprint is None) and not(_pcg_fingerprints_match(state.get('fingerprint'),fingerprint)):
+            print('checkpoint ',fname,' was written for a different map, right-hand side or set of TODs.  Ignoring it.')
+            state=None
+    isok=not(state is None)
+    if have_mpi:
+        isok=comm.allreduce(isok,op=MPI.LAND)
+    if isok:
+        return state
+    return None
+
+def _pcg_restore(checkpoint,precon,fingerprint=None):
+    #restore x,r,p,z,zr,zr0,conv_log from a checkpoint if there's a usable one.
+    if checkpoint is None:
+        return None
+    state=load_pcg_checkpoint(checkpoint,fingerprint)
+    if state is None:
+        return None
+    if myrank==0:
+        print('resuming PCG from ',checkpoint,' after iteration ',state['iter'])
+    r=state['r']
+    if precon is None:
+        z=r
     else:
-        z=r.copy()
-    p=z.copy()
-    k=0.0
+        z=precon*r
+    return state['iter']+1,state['x'],r,z,state['p'],state['zr'],state['zr0'],state['conv_log']
+
+def run_pcg(b,x0,tods,precon=None,maxiter=25,outroot='map',save_iters=[-1],save_ind=0,save_tail='.fits',plot_iters=[],plot_info=None,plot_ind=0,tol=None,checkpoint=None,checkpoint_every=10,full_out=False):
+    """Solve tods.dot(x)=b with preconditioned conjugate gradient, starting from x0.
+    If tol is set, stop once the relative preconditioned residual sqrt(r.z/r0.z0) drops below it.
+    If checkpoint is set, write the solver state to checkpoint(_rank).pkl every checkpoint_every 
+    iterations, and if a checkpoint is already there, resume from it rather than from x0.
+    With full_out, also return the convergence log, an array of [iteration,r.z,relative residual,time]."""
+    #the work vectors (x,r,z,p,Ap) are allocated once here and then updated in place, so 
+    #iterating doesn't keep copying potentially enormous mapsets.  With no preconditioner,
+    #z is just r, saving another vector.
+    if isinstance(precon,null_precon):
+        precon=None
+    t1=time.time()
+    fingerprint=None
+    if not(checkpoint is None):
+        fingerprint=get_pcg_fingerprint(b,tods)
+    restored=_pcg_restore(checkpoint,precon,fingerprint)
+    if restored is None:
+        Ap=tods.dot(x0)
 
-    zr=r.dot(z)
-    x=x0.copy()
+        try:
+            r=b.copy()
+            r.axpy(Ap,-1)
+        except:
+            r=b-Ap
+        if not(precon is None):
+            #print('applying precon')
+            z=precon*r
+        else:
+            z=r
+        p=z.copy()
+        k=0.0
+
+        zr=r.dot(z)
+        x=x0.copy()
+        zr0=zr
+        conv_log=[]
+        start_iter=0
+    else:
+        start_iter,x,r,z,p,zr,zr0,conv_log=restored
+        Ap=p.copy()
     t2=time.time()
     nsamp=tods.get_nsamp()
     tloop=time.time()
-    for iter in range(maxiter):
+    iter=start_iter-1
+    for iter in range(start_iter,maxiter):
         if myrank==0:
-            if iter>0:
+            if iter>start_iter:
                 print(iter,zr,alpha,t2-t1,t3-t2,t3-t1,nsamp/(t2-t1)/1e6)
             else:
                 print(iter,zr,t2-t1)
         t1=time.time()
-        Ap=tods.dot(p)
+        Ap.clear()
+        Ap=tods.dot(p,Ap)
         t2=time.time()
         pAp=p.dot(Ap)
         alpha=zr/pAp
         #print('alpha,pAp, and zr  are ' + repr(alpha) + '  ' + repr(pAp) + '  ' + repr(zr))
-        try:
-            x_new=x.copy()
-            x_new.axpy(p,alpha)
-        except:
-            x_new=x+p*alpha
-
-        try:
-            r_new=r.copy()
-            r_new.axpy(Ap,-alpha)
-        except:
-            r_new=r-Ap*alpha
-        if not(precon is None):
-            #print('applying precon')
-            z_new=precon*r_new
-        else:
-            z_new=r_new.copy()
-        zr_new=r_new.dot(z_new)
+        x.axpy(p,alpha)
+        zr_new,z=_pcg_residual_update(r,Ap,alpha,precon,z)
         beta=zr_new/zr
-        try:
-            p_new=z_new.copy()
-            p_new.axpy(p,beta)
-        except:
-            p_new=z_new+p*beta
-        
-        p=p_new
-        z=z_new
-        r=r_new
+        p=_pcg_direction_update(p,z,beta)
         zr=zr_new
-        x=x_new
         t3=time.time()
+        rel=np.sqrt(np.abs(zr/zr0))
+        conv_log.append([iter,zr,rel,t3-t1])
+        converged=not(tol is None) and rel<tol
+        if not(checkpoint is None):
+            if ((iter+1)%checkpoint_every==0) or converged or (iter==maxiter-1):
+                save_pcg_checkpoint(checkpoint,iter,x,r,p,zr,zr0,conv_log,fingerprint)
         if iter in save_iters:
             if myrank==0:
                 x.maps[save_ind].write(outroot+'_'+repr(iter)+save_tail)
         if iter in plot_iters:
             print('plotting on iteration ',iter)
             x.maps[plot_ind].plot(plot_info)
+        if converged:
+            if myrank==0:
+                print('PCG converged on iteration ',iter,' with relative residual ',rel)
+            break
 
-    tave=(time.time()-tloop)/maxiter
-    print('average time per iteration was ',tave,' with effective throughput ',nsamp/tave/1e6,' Msamp/s')
+    niter=iter+1-start_iter
+    if niter>0:
+        tave=(time.time()-tloop)/niter
+        print('average time per iteration was ',tave,' with effective throughput ',nsamp/tave/1e6,' Msamp/s')
     if iter in plot_iters:
         print('plotting on iteration ',iter)
         x.maps[plot_ind].plot(plot_info)
     else:
         print('skipping plotting on iter ',iter)
+    if full_out:
+        return x,np.asarray(conv_log)
     return x
 
-def run_pcg_wprior(b,x0,tods,prior=None,precon=None,maxiter=25,outroot='map',save_iters=[-1],save_ind=0,save_tail='.fits'):
+def run_pcg_wprior(b,x0,tods,prior=None,precon=None,maxiter=25,outroot='map',save_iters=[-1],save_ind=0,save_tail='.fits',tol=None,checkpoint=None,checkpoint_every=10,full_out=False):
     #least squares equations in the presence of a prior - chi^2 = (d-Am)^T N^-1 (d-Am) + (p-m)^T Q^-1 (p-m)
     #where p is the prior target for parameters, and Q is the variance.  The ensuing equations are
     #(A^T N-1 A + Q^-1)m = A^T N^-1 d + Q^-1 p.  For non-zero p, it is assumed you have done this already and that 
     #b=A^T N^-1 d + Q^-1 p
     #to have a prior then, whenever we call Ax, just a Q^-1 x to Ax.
+    #As in run_pcg, work vectors are allocated once and updated in place, and tol/checkpoint/full_out
+    #behave the same way.
+    if isinstance(precon,null_precon):
+        precon=None
     t1=time.time()
-    Ax=tods.dot(x0)    
-    if not(prior is None):
-        #print('applying prior')
-        prior.apply_prior(x0,Ax) 
-    try:
-        r=b.copy()
-        r.axpy(Ax,-1)
-    except:
-        r=b-Ax
-    if not(precon is None):
-        z=precon*r
+    fingerprint=None
+    if not(checkpoint is None):
+        fingerprint=get_pcg_fingerprint(b,tods)
+    restored=_pcg_restore(checkpoint,precon,fingerprint)
+    if restored is None:
+        Ap=tods.dot(x0)    
+        if not(prior is None):
+            #print('applying prior')
+            prior.apply_prior(x0,Ap) 
+        try:
+            r=b.copy()
+            r.axpy(Ap,-1)
+        except:
+            r=b-Ap
+        if not(precon is None):
+            z=precon*r
+        else:
+            z=r
+        p=z.copy()
+        k=0.0
+
+        zr=r.dot(z)
+        x=x0.copy()
+        zr0=zr
+        conv_log=[]
+        start_iter=0
     else:
-        z=r.copy()
-    p=z.copy()
-    k=0.0
-
-    zr=r.dot(z)
-    x=x0.copy()
+        start_iter,x,r,z,p,zr,zr0,conv_log=restored
+        Ap=p.copy()
     t2=time.time()
-    for iter in range(maxiter):
+    for iter in range(start_iter,maxiter):
         if myrank==0:
-            if iter>0:
+            if iter>start_iter:
                 print(iter,zr,alpha,t2-t1,t3-t2,t3-t1)
             else:
                 print(iter,zr,t2-t1)
             sys.stdout.flush()
         t1=time.time()
-        Ap=tods.dot(p)
+        Ap.clear()
+        Ap=tods.dot(p,Ap)
         if not(prior is None):
             #print('applying prior')
             prior.apply_prior(p,Ap)
         t2=time.time()
         pAp=p.dot(Ap)
         alpha=zr/pAp
-        try:
-            x_new=x.copy()
-            x_new.axpy(p,alpha)
-        except:
-            x_new=x+p*alpha
-
-        try:
-            r_new=r.copy()
-            r_new.axpy(Ap,-alpha)
-        except:
-            r_new=r-Ap*alpha
-        if not(precon is None):
-            z_new=precon*r_new
-        else:
-            z_new=r_new.copy()
-        zr_new=r_new.dot(z_new)
+        x.axpy(p,alpha)
+        zr_new,z=_pcg_residual_update(r,Ap,alpha,precon,z)
         beta=zr_new/zr
-        try:
-            p_new=z_new.copy()
-            p_new.axpy(p,beta)
-        except:
-            p_new=z_new+p*beta
-        
-        p=p_new
-        z=z_new
-        r=r_new
+        p=_pcg_direction_update(p,z,beta)
         zr=zr_new
-        x=x_new
         t3=time.time()
+        rel=np.sqrt(np.abs(zr/zr0))
+        conv_log.append([iter,zr,rel,t3-t1])
+        converged=not(tol is None) and rel<tol
+        if not(checkpoint is None):
+            if ((iter+1)%checkpoint_every==0) or converged or (iter==maxiter-1):
+                save_pcg_checkpoint(checkpoint,iter,x,r,p,zr,zr0,conv_log,fingerprint)
         if iter in save_iters:
             if myrank==0:
                 x.maps[save_ind].write(outroot+'_'+repr(iter)+save_tail)
+        if converged:
+            if myrank==0:
+                print('PCG converged on iteration ',iter,' with relative residual ',rel)
+            break
 
+    if full_out:
+        return x,np.asarray(conv_log)
     return x
 
     
 
+def _dot_split(a,b):
+    if hasattr(a,'dot_split'):
+        return a.dot_split(b)
+    return np.asarray([a.dot(b),0.0])
+
+def run_pcg_pipelined(b,x0,tods,precon=None,prior=None,maxiter=25,tol=None,outroot='map',save_iters=[-1],save_ind=0,save_tail='.fits',full_out=False,checkpoint=None):
+    """Pipelined PCG (Ghysels & Vanroose 2014) for big MPI runs.  Mathematically the same as run_pcg/run_pcg_wprior,
+    but rearranged so the two scalar products needed each iteration go out in a single non-blocking allreduce
+    that runs while we apply the preconditioner and do the next tods.dot.  The price is more work vectors 
+    (10 instead of 5), and somewhat worse round-off, so convergence can stall a bit earlier than plain PCG.
+    Prints how long we actually spent waiting on the reductions, next to how long blocking ones would have taken.
+    tol and full_out behave as in run_pcg.  r.u for the updated residual only comes back with the next iteration's
+    reduction, so that's where we log it and test it against tol; if we stop there, the tods.dot already done for
+    the next step is thrown away.  Checkpointing isn't supported (the state is the whole pipeline, not just x, r
+    and p), so use run_pcg/run_pcg_wprior for that."""
+    if not(checkpoint is None):
+        raise ValueError('run_pcg_pipelined does not support checkpoint, use run_pcg or run_pcg_wprior')
+    if isinstance(precon,null_precon):
+        precon=None
+    def apply_A(vec,out):
+        out.clear()
+        out=tods.dot(vec,out)
+        if not(prior is None):
+            prior.apply_prior(vec,out)
+        return out
+    def apply_M(vec,out):
+        if precon is None:
+            return vec
+        if hasattr(precon,'multiply'):
+            precon.multiply(vec,out)
+        else:
+            out=precon*vec
+        return out
+
+    t1=time.time()
+    x=x0.copy()
+    w=tods.dot(x0)
+    if not(prior is None):
+        prior.apply_prior(x0,w)
+    r=b.copy()
+    r.axpy(w,-1)
+    #with no preconditioner u=r, m=w, and q=s, so don't keep (or update) separate copies
+    if precon is None:
+        u=r
+    else:
+        u=precon*r
+    w=apply_A(u,w)
+    if precon is None:
+        m=w
+    else:
+        m=precon*w
+    n=w.copy()
+    z=n.copy()
+    z.clear()
+    p=z.copy()
+    s=z.copy()
+    if precon is None:
+        q=s
+    else:
+        q=z.copy()
+
+    #time a blocking reduction of the same size, so we can say how much we saved
+    t_blocking=0.0
+    if have_mpi:
+        tmp=np.zeros(2)
+        for i in range(5):
+            tt=time.time()
+            comm.Allreduce(np.zeros(2),tmp,op=MPI.SUM)
+            t_blocking=t_blocking+(time.time()-tt)/5
+    t_wait=0.0
+    conv_log=[]
+    gamma0=None
+    recv=np.zeros(2)
+    t2=time.time()
+    nsamp=tods.get_nsamp()
+    def log_iter(iter,gamma,alpha,tt):
+        #tt is the times at the start, after the reduction and after the updates of iteration iter
+        rel=np.sqrt(np.abs(gamma/gamma0))
+        conv_log.append([iter,gamma,rel,tt[2]-tt[0]])
+        if myrank==0:
+            print(iter,gamma,alpha,tt[1]-tt[0],tt[2]-tt[1],tt[2]-tt[0],nsamp/(tt[1]-tt[0])/1e6)
+            sys.stdout.flush()
+        converged=not(tol is None) and rel<tol
+        if converged and myrank==0:
+            print('pipelined PCG converged on iteration ',iter,' with relative residual ',rel)
+        return converged
+    tloop=time.time()
+    niter=0
+    converged=False
+    for iter in range(maxiter):
+        t1=time.time()
+        ru=_dot_split(r,u)
+        wu=_dot_split(w,u)
+        send=np.asarray([ru[1],wu[1]])
+        if have_mpi:
+            req=comm.Iallreduce(send,recv,op=MPI.SUM)
+        else:
+            recv[:]=send
+        m=apply_M(w,m)
+        n=apply_A(m,n)
+        if have_mpi:
+            tt=time.time()
+            req.Wait()
+            t_wait=t_wait+time.time()-tt
+        gamma=ru[0]+recv[0]
+        delta=wu[0]+recv[1]
+        if gamma0 is None:
+            gamma0=gamma
+        else:
+            converged=log_iter(iter-1,gamma,alpha_old,times)
+            if converged:
+                break
+        if iter>0:
+            beta=gamma/gamma_old
+            alpha=gamma/(delta-beta*gamma/alpha_old)
+        else:
+            beta=0.0
+            alpha=gamma/delta
+        t2=time.time()
+        z=_pcg_direction_update(z,n,beta)
+        if not(q is s):
+            q=_pcg_direction_update(q,m,beta)
+        s=_pcg_direction_update(s,w,beta)
+        p=_pcg_direction_update(p,u,beta)
+        x.axpy(p,alpha)
+        r.axpy(s,-alpha)
+        if not(u is r):
+            u.axpy(q,-alpha)
+        w.axpy(z,-alpha)
+        gamma_old=gamma
+        alpha_old=alpha
+        t3=time.time()
+        times=[t1,t2,t3]
+        niter=iter+1
+        if iter in save_iters:
+            if myrank==0:
+                x.maps[save_ind].write(outroot+'_'+repr(iter)+save_tail)
+    if niter>0 and not(converged):
+        #the last update's residual hasn't been reduced yet, so do that one blocking
+        ru=_dot_split(r,u)
+        gamma=ru[0]
+        if have_mpi:
+            gamma=gamma+comm.allreduce(ru[1],op=MPI.SUM)
+        else:
+            gamma=gamma+ru[1]
+        log_iter(niter-1,gamma,alpha_old,times)
+    if niter>0:
+        tave=(time.time()-tloop)/niter
+        print('average time per iteration was ',tave,' with effective throughput ',nsamp/tave/1e6,' Msamp/s')
+    if have_mpi and myrank==0:
+        print('pipelined PCG waited ',t_wait,' seconds on reductions, compared to ',t_blocking*niter,' for blocking ones.  Hid ',max(t_blocking*niter-t_wait,0.0),' seconds.')
+    if full_out:
+        return x,np.asarray(conv_log)
+    return x
+
 def run_pcg_wprior_old(b,x0,tods,prior,precon=None,maxiter=25):
     t1=time.time()
     Ax=tods.dot(x0)
@@ -1189,6 +1835,10 @@ class tsGeneric:
             return np.sum(self.params*common.params)
     def axpy(self,common,a):
         self.params=self.params+a*common.params
+    def aypx(self,common,a):
+        aypx_inplace(self.params,common.params,a)
+    def multiply(self,to_mul,out):
+        np.multiply(self.params,to_mul.params,out=out.params)
     def apply_prior(self,x,Ax):
         Ax.params=Ax.params+self.params*x.params
     def copy(self):
@@ -1839,6 +2489,7 @@ class tsCalib:
     
     
 class tsModel:
+    mpi_distributed=True #each process only holds the models for its own TODs
     def __init__(self,todvec=None,modelclass=None,*args,**kwargs):
         self.data={}
         if todvec is None:
@@ -1866,7 +2517,7 @@ class tsModel:
     def apply_prior(self,x,Ax):
         for nm in self.data.keys():
             self.data[nm].apply_prior(x.data[nm],Ax.data[nm])
-    def dot(self,tsmodels=None):
+    def dot(self,tsmodels=None,do_reduce=True):
         tot=0.0
         for nm in self.data.keys():
             if tsmodels is None:
@@ -1878,7 +2529,7 @@ class tsModel:
                 else:
                     print('error in tsModel.dot - missing key ',nm)
                     assert(1==0)  #pretty sure we want to crash if missing names
-        if have_mpi:
+        if have_mpi and do_reduce:
             tot=comm.allreduce(tot)
         return tot
     def clear(self):
@@ -1887,6 +2538,31 @@ class tsModel:
     def axpy(self,tsmodel,a):
         for nm in self.data.keys():
             self.data[nm].axpy(tsmodel.data[nm],a)
+    def aypx(self,tsmodel,a):
+        for nm in self.data.keys():
+            if hasattr(self.data[nm],'aypx'):
+                self.data[nm].aypx(tsmodel.data[nm],a)
+            else:
+                tmp=tsmodel.data[nm].copy()
+                tmp.axpy(self.data[nm],a)
+                self.data[nm]=tmp
+    def multiply(self,tsmodel,out):
+        for nm in self.data.keys():
+            if hasattr(self.data[nm],'multiply'):
+                self.data[nm].multiply(tsmodel.data[nm],out.data[nm])
+            else:
+                out.data[nm]=self.data[nm]*tsmodel.data[nm]
+    def axpy_precon_dot(self,tsmodel,a,precon,out):
+        #timestream parameters are tiny next to maps, so don't bother fusing.  Going
+        #through self.dot also keeps the MPI reduction right for subclasses.
+        self.axpy(tsmodel,a)
+        if precon is None:
+            if not(out is self):
+                for nm in self.data.keys():
+                    out.data[nm]=self.data[nm].copy()
+        else:
+            precon.multiply(self,out)
+        return self.dot(out)
     def __mul__(self,tsmodel): #this is used in preconditioning - need to fix if ts-based preconditioning is desired        
         tt=self.copy()
         for nm in self.data.keys():
@@ -1913,6 +2589,7 @@ class tsModel:
 
 class tsMultiModel(tsModel):
     """A class to hold timestream models that are shared between groups of TODs."""
+    mpi_distributed=False #dot doesn't reduce over processes, so don't let PCG do it either
     def __init__(self,todvec=None,todtags=None,modelclass=None,tag='ts_multi_model',*args,**kwargs):        
         self.data={}
         self.tag=tag
@@ -1957,16 +2634,64 @@ class Mapset:
     def copy(self):
         new_mapset=Mapset()
         for i in range(self.nmap):
-            new_mapset.add_map(self.maps[i].copy())
+            new_mapset.add_map(self.maps[i]) #add_map already makes the copy
         return new_mapset
     def dot(self,mapset):
         tot=0.0
         for i in range(self.nmap):
             tot=tot+self.maps[i].dot(mapset.maps[i])
         return tot
+    def dot_split(self,mapset):
+        """Return the dot product in two pieces - the part from maps every process has a full
+        copy of, and this process's share of the part from per-process things like timestream
+        models, which still needs to be summed over processes.  Lets a caller combine the MPI
+        reductions of several dot products into one."""
+        tot=np.zeros(2)
+        for i in range(self.nmap):
+            if getattr(self.maps[i],'mpi_distributed',False):
+                tot[1]=tot[1]+self.maps[i].dot(mapset.maps[i],do_reduce=False)
+            else:
+                tot[0]=tot[0]+self.maps[i].dot(mapset.maps[i])
+        return tot
     def axpy(self,mapset,a):
         for i in range(self.nmap):
             self.maps[i].axpy(mapset.maps[i],a)
+    def aypx(self,mapset,a):
+        #self=mapset+a*self.  In place for map types that know how, otherwise swap in a new map.
+        for i in range(self.nmap):
+            if hasattr(self.maps[i],'aypx'):
+                self.maps[i].aypx(mapset.maps[i],a)
+            else:
+                tmp=mapset.maps[i].copy()
+                tmp.axpy(self.maps[i],a)
+                self.maps[i]=tmp
+    def multiply(self,mapset,out):
+        #out=self*mapset, writing into out's maps where we can.  self is usually a preconditioner.
+        for i in range(self.nmap):
+            if hasattr(self.maps[i],'multiply'):
+                self.maps[i].multiply(mapset.maps[i],out.maps[i])
+            else:
+                out.maps[i]=self.maps[i]*mapset.maps[i]
+    def axpy_precon_dot(self,mapset,a,precon,out):
+        """Fused PCG residual update:  self+=a*mapset, out=precon*self, and return self.out.  If precon
+        is None, out should be self."""
+        if precon is None:
+            precons=[None]*self.nmap
+        else:
+            precons=precon.maps
+        tot=0.0
+        for i in range(self.nmap):
+            if hasattr(self.maps[i],'axpy_precon_dot'):
+                tot=tot+self.maps[i].axpy_precon_dot(mapset.maps[i],a,precons[i],out.maps[i])
+            else:
+                self.maps[i].axpy(mapset.maps[i],a)
+                if precons[i] is None:
+                    if not(out.maps[i] is self.maps[i]):
+                        out.maps[i]=self.maps[i].copy()
+                else:
+                    out.maps[i]=precons[i]*self.maps[i]
+                tot=tot+self.maps[i].dot(out.maps[i])
+        return tot
     def __add__(self,mapset):
         mm=self.copy()
         mm.axpy(mapset,1.0)
@@ -2020,7 +2745,7 @@ class Mapset:
 #            self.cuts[tod.info['tag']]=Cuts(tod)
             
 class SkyMap:
-    def __init__(self,lims,pixsize=0,proj='CAR',pad=2,primes=None,cosdec=None,nx=None,ny=None,mywcs=None,tag='ipix',purge_pixellization=False,ref_equ=False):
+    def __init__(self,lims,pixsize=0,proj='CAR',pad=2,primes=None,cosdec=None,nx=None,ny=None,mywcs=None,tag='ipix',purge_pixellization=False,ref_equ=False,compress_pixellization=False,onthefly_pixellization=False):
         if mywcs is None:
             assert(pixsize!=0) #we had better have a pixel size if we don't have an incoming WCS that contains it
             self.wcs=get_wcs(lims,pixsize,proj,cosdec,ref_equ)            
@@ -2055,10 +2780,9 @@ class SkyMap:
         nx=int(nx)
         ny=int(ny)
         if not(primes is None):
-            lens=find_good_fft_lens(2*(nx+ny),primes)
             #print 'nx and ny initially are ',nx,ny
-            nx=lens[lens>=nx].min()
-            ny=lens[lens>=ny].min()
+            nx=get_good_fft_len(nx,primes,below=False)
+            ny=get_good_fft_len(ny,primes,below=False)
             #print 'small prime nx and ny are now ',nx,ny
             self.primes=primes[:]
         else:
@@ -2072,6 +2796,9 @@ class SkyMap:
         self.pad=pad
         self.tag=tag
         self.purge_pixellization=purge_pixellization
+        self.compress_pixellization=compress_pixellization
+        self.onthefly_pixellization=onthefly_pixellization
+        self.pix_params=None
         self.caches=None
         self.cosdec=cosdec
         self.tod2map_method=None
@@ -2083,49 +2810,103 @@ class SkyMap:
         self.map[:]=np.reshape(np.sum(self.caches,axis=0),self.map.shape)
         self.caches=None
     def set_tod2map(self,method=None,todvec=None):
-        """Select which method of tod2map to use.  options include simple (1 proc), omp (everyone makes a map copy), everyone (everyone loops through
-           all the data but assigns only to their own piece), atomic (no map copy, accumulate via atomic adds), and cached (every thread has a sticky
-           copy of the map)."""
+        """Select which method of tod2map to use.  options include simple (1 proc), omp (everyone makes a map copy), everyone (each thread owns
+           a range of pixels holding about 1/nthread of the samples, and adds only the samples that land there), atomic (no map copy, accumulate 
+           via atomic adds), cached (every thread has a sticky copy of the map), and sorted (each TOD gets a pixel-sorted index, and threads sum up 
+           whole pixels with no map copies).  everyone and sorted cost an extra int32 per sample per map, and if todvec is sent in their indices 
+           are built now rather than the first time each TOD is used.  fastest times omp/atomic/everyone/sorted on todvec with benchmark_tod2map 
+           and picks the quickest.  No method (the default) goes back to omp.  Maps with on-the-fly or compressed pixellizations keep 
+           using their own kernels whatever the method."""
         if method is None:
-            if nproc==1:
-                self.tod2map_method=self.tod2map_simple
-            else:
-                self.tod2map_method=self.tod2map_omp
+            #back to the default, omp (or simple with do_omp=False in tod2map)
+            self.tod2map_method=None
             return
+        #tod2map won't use sorted/everyone indices on on-the-fly or compressed maps, so don't build them
+        prebuild=not(todvec is None) and not(self.onthefly_pixellization or self.compress_pixellization)
         if method=='omp':
             self.tod2map_method=self.tod2map_omp
             return
         if method=='simple':
             self.tod2map_method=self.tod2map_simple
         if method=='everyone':
-            if todvec is None:
-                print('need tods when setting to everyone so we can know which pieces belong to which threads')
-            for tod in todvec.tods:
-                ipix=self.get_pix(tod,False)
-                ipix=ipix.copy()
-                ipix=np.ravel(ipix)
-                ipix.sort()
-                inds=len(ipix)*np.arange(nproc+1)//nproc
-                inds=np.asarray(inds,dtype='int32')
-                tod.save_pixellization(self.tag+'_edges',inds)
-                self.tod2map_method=self.tod2map_everyone
+            if prebuild:
+                for tod in todvec.tods:
+                    self.get_everyone_pix(tod)
+            self.tod2map_method=self.tod2map_everyone
         if method=='cached':
             self.get_caches()
             self.tod2map_method=self.tod2map_cached
         if method=='atomic':
-            self.tod2map_method=self.todmap_atomic
+            self.tod2map_method=self.tod2map_atomic
+        if method=='sorted':
+            if prebuild:
+                for tod in todvec.tods:
+                    self.get_sorted_pix(tod)
+            self.tod2map_method=self.tod2map_sorted
+        if method=='fastest':
+            if todvec is None:
+                print('need tods in set_tod2map to find the fastest method.')
+                return
+            times=self.benchmark_tod2map(todvec)
+            best=min(times,key=times.get)
+            if myrank==0:
+                print('fastest tod2map method is ',best)
+            self.set_tod2map(best,todvec)
+    def benchmark_tod2map(self,todvec,methods=['omp','atomic','everyone','sorted'],nrep=2):
+        """Time a full pass of tod2map over todvec for each method in methods, going through set_tod2map.  Returns a 
+        dictionary of the time per pass, slowest process's time if running under MPI.  The map and method in use are
+        left as they were, although any per-TOD indices the methods build are kept."""
+        map_save=self.map.copy()
+        method_save=self.tod2map_method
+        times={}
+        for method in methods:
+            self.set_tod2map(method,todvec)
+            self.tod2map(todvec.tods[0],do_add=True) #warm up, and get any remaining setup out of the way
+            t1=time.time()
+            for i in range(nrep):
+                for tod in todvec.tods:
+                    self.tod2map(tod,do_add=True)
+            tt=(time.time()-t1)/nrep
+            if have_mpi:
+                tt=comm.allreduce(tt,op=MPI.MAX)
+            times[method]=tt
+            if myrank==0:
+                print('tod2map method ',method,' took ',tt,' seconds per pass.')
+        self.map[:]=map_save
+        self.tod2map_method=method_save
+        return times
     def tod2map_atomic(self,tod,dat):
         ipix=self.get_pix(tod)
         tod2map_omp(self.map,dat,ipix,True)
-    def todmap_omp(self,tod,dat):
+    def tod2map_omp(self,tod,dat):
         ipix=self.get_pix(tod)
         tod2map_omp(self.map,dat,ipix,False)
     def tod2map_simple(self,tod,dat):
         ipix=self.get_pix(tod)
         tod2map_simple(self.map,dat,ipix)
-    #def tod2map_cached(self.map,dat,ipix):
-    #    ipix=self.get_pix(tod)
-    #    tod2map_cached(map,dat,ipix)
+    def tod2map_cached(self,tod,dat):
+        ipix=self.get_pix(tod)
+        tod2map_cached(self.caches,dat,ipix)
+    def get_sorted_pix(self,tod):
+        tag=self.tag+'_sorted'
+        sorted_pix=tod.get_saved_pix(tag)
+        if sorted_pix is None:
+            sorted_pix=get_sorted_pix(self.get_pix(tod))
+            tod.save_pixellization(tag,sorted_pix)
+        return sorted_pix
+    def tod2map_sorted(self,tod,dat):
+        perm,upix,segs=self.get_sorted_pix(tod)
+        tod2map_sorted(self.map,dat,perm,upix,segs)
+    def get_everyone_pix(self,tod):
+        tag=self.tag+'_everyone'
+        everyone_pix=tod.get_saved_pix(tag)
+        if everyone_pix is None:
+            everyone_pix=get_everyone_pix(self.get_pix(tod))
+            tod.save_pixellization(tag,everyone_pix)
+        return everyone_pix
+    def tod2map_everyone(self,tod,dat):
+        perm,offsets,edges=self.get_everyone_pix(tod)
+        tod2map_everyone(self.map,dat,self.get_pix(tod),perm,offsets)
 
     def copy(self):
         if False:
@@ -2137,13 +2918,24 @@ class SkyMap:
     def clear(self):
         self.map[:]=0
     def axpy(self,map,a):
-        self.map[:]=self.map[:]+a*map.map[:]
+        axpy_inplace(self.map,map.map,a)
+    def aypx(self,map,a):
+        aypx_inplace(self.map,map.map,a)
+    def multiply(self,map,out):
+        np.multiply(self.map,map.map,out=out.map)
+    def axpy_precon_dot(self,map,a,precon,out):
+        if precon is None:
+            return axpy_precon_dot(self.map,map.map,a,None,out.map)
+        return axpy_precon_dot(self.map,map.map,a,precon.map,out.map)
     def assign(self,arr):
         assert(arr.shape[0]==self.nx)
         assert(arr.shape[1]==self.ny)
         #self.map[:,:]=arr
         self.map[:]=arr
     def pix_from_radec(self,ra,dec):
+        params=self.get_pix_params()
+        if not(params is None):
+            return radec2pix(ra,dec,params,self.ny)
         ndet=ra.shape[0]
         nsamp=ra.shape[1]
         nn=ndet*nsamp
@@ -2164,9 +2956,15 @@ class SkyMap:
         ipix=np.asarray(xpix*self.ny+ypix,dtype='int32')
         return ipix
 
-    def get_pix(self,tod,savepix=True):
+    def get_pix(self,tod,savepix=True,compressed=False):
+        #a compressed pixellization is only decoded for the caller, never saved back.  Callers that can
+        #take a DeltaPix should pass compressed=True to skip that.
         if not(self.tag is None):
             ipix=tod.get_saved_pix(self.tag)
+            if isinstance(ipix,DeltaPix):
+                if compressed:
+                    return ipix
+                return ipix.get_ipix()
             if not(ipix is None):
                 return ipix
         ra,dec=tod.get_radec()
@@ -2193,11 +2991,38 @@ class SkyMap:
             ipix=np.asarray(xpix*self.ny+ypix,dtype='int32')
         else:
             ipix=self.pix_from_radec(ra,dec)
-        if savepix:
+        if savepix and not(self.onthefly_pixellization):
             if not(self.tag is None):
-                tod.save_pixellization(self.tag,ipix)
+                if self.compress_pixellization:
+                    dpix=compress_pix(ipix)
+                    tod.save_pixellization(self.tag,dpix)
+                    if compressed:
+                        return dpix
+                else:
+                    tod.save_pixellization(self.tag,ipix)
         return ipix
+    def get_delta_pix(self,tod):
+        """Return the compressed pixellization of tod if we're storing one, otherwise None."""
+        if not(self.compress_pixellization) or self.tag is None:
+            return None
+        dpix=self.get_pix(tod,compressed=True)
+        if isinstance(dpix,DeltaPix):
+            return dpix
+        return None
+    def get_pix_params(self):
+        """Parameters for computing pixels on the fly in the C kernels, or None if our projection isn't supported."""
+        if self.pix_params is None:
+            self.pix_params=get_wcs_pix_params(self.wcs)
+        return self.pix_params
     def map2tod(self,tod,dat,do_add=True,do_omp=True):
+        if self.onthefly_pixellization and not(self.get_pix_params() is None):
+            ra,dec=tod.get_radec()
+            map2tod_onthefly(dat,self.map,ra,dec,self.get_pix_params(),self.ny,do_add)
+            return
+        dpix=self.get_delta_pix(tod)
+        if not(dpix is None):
+            map2tod_delta(dat,self.map,dpix,do_add)
+            return
         ipix=self.get_pix(tod)
         #map2tod(dat,self.map,tod.info['ipix'],do_add,do_omp)
         map2tod(dat,self.map,ipix,do_add,do_omp)
@@ -2207,12 +3032,25 @@ class SkyMap:
             dat=tod.get_data()
         if do_add==False:
             self.clear()
-        ipix=self.get_pix(tod)
-        
+        #on-the-fly and compressed pixellizations have their own kernels, whatever tod2map method is set
+        if self.caches is None and self.onthefly_pixellization and not(self.get_pix_params() is None):
+            ra,dec=tod.get_radec()
+            tod2map_onthefly(self.map,dat,ra,dec,self.get_pix_params(),self.ny,do_omp)
+            return
+        if self.caches is None:
+            dpix=self.get_delta_pix(tod)
+            if not(dpix is None):
+                tod2map_delta(self.map,dat,dpix,do_omp)
+                if self.purge_pixellization:
+                    self.purge_pix(tod)
+                return
         if not(self.caches is None):
             #tod2map_cached(self.caches,dat,tod.info['ipix'])
-            tod2map_cached(self.caches,dat,ipix)
+            tod2map_cached(self.caches,dat,self.get_pix(tod))
+        elif not(self.tod2map_method is None):
+            self.tod2map_method(tod,dat) #methods fetch their own pixels, since sorted/everyone may not need ipix
         else:
+            ipix=self.get_pix(tod)
             if do_omp:
                 #tod2map_omp(self.map,dat,tod.info['ipix'])
                 tod2map_omp(self.map,dat,ipix)
@@ -2220,7 +3058,11 @@ class SkyMap:
                 #tod2map_simple(self.map,dat,tod.info['ipix'])
                 tod2map_simple(self.map,dat,ipix)
         if self.purge_pixellization:
-            tod.clear_saved_pix(self.tag)
+            self.purge_pix(tod)
+    def purge_pix(self,tod):
+        """Drop the pixellization of tod, along with any sorted/everyone indices built from it."""
+        for tag in [self.tag,self.tag+'_sorted',self.tag+'_everyone']:
+            tod.clear_saved_pix(tag)
 
     def tod2map_old(self,tod,dat=None,do_add=True,do_omp=True):
         if dat is None:
@@ -2251,7 +3093,7 @@ class SkyMap:
         th=np.arctan2(xmat,ymat)
         return rmat,th
     def dot(self,map):
-        tot=np.sum(self.map*map.map)
+        tot=dot_inplace(self.map,map.map)
         return tot
         
     def plot(self,plot_info=None):
@@ -2448,9 +3290,9 @@ class SkyMapTwoRes:
         for i in range(self.nx_coarse):
             for j in range(self.nx_coarse):
                 tmp2[self.map_corner[0]+i,self.map_corner[1]+j]=np.mean(tmp[(i*self.osamp):((i+1)*self.osamp),(j*self.osamp):((j+1)*self.osamp)])
-        tmp2_conv=np.fft.irfft2(np.fft.rfft2(tmp2)*self.beamft)
+        tmp2_conv=self.beam_convolve(tmp2)
         tmp2_conv_filt=self.noise.apply_noise(tmp2_conv)
-        tmp2_reconv=np.fft.irfft2(np.fft.rfft2(tmp2_conv_filt)*self.beamft)
+        tmp2_reconv=self.beam_convolve(tmp2_conv_filt)
         #tmp2_reconv=np.fft.irfft2(np.fft.rfft2(tmp2_conv)*self.beamft)
         #tmp2_reconv=tmp2.copy()
         fac=1.0/self.osamp**2
@@ -2513,10 +3355,13 @@ class SkyMapTwoRes:
             mapset.maps[coarse_ind].map[:]=mapset.maps[coarse_ind].map[:]+coarse
             mapset.maps[fine_ind].map[self.mask]=mapset.maps[fine_ind].map[self.mask]+fine[self.mask]/self.osamp**2
 
-    def beam_convolve(self,map):
-        mapft=np.fft.rfft2(map)
+    def beam_convolve(self,map,nthread=None):
+        #FFTW with every thread we've got (or nthread), since these maps can be big
+        if nthread is None:
+            nthread=get_nthread()
+        mapft=mkfftw.rfftn(np.ascontiguousarray(map,dtype='float64'),nthread=nthread)
         mapft=mapft*self.beamft
-        return np.fft.irfft2(mapft)
+        return mkfftw.irfftn(mapft,iseven=(map.shape[-1]%2==0),preserve_input=False,nthread=nthread)
     def apply_prior(self,mapset,outmapset):
         coarse_ind=None
         fine_ind=None
@@ -2611,10 +3456,9 @@ class PolMap:
         nx=int(nx)
         ny=int(ny)
         if not(primes is None):
-            lens=find_good_fft_lens(2*(nx+ny),primes)
             #print 'nx and ny initially are ',nx,ny
-            nx=lens[lens>=nx].min()
-            ny=lens[lens>=ny].min()
+            nx=get_good_fft_len(nx,primes,below=False)
+            ny=get_good_fft_len(ny,primes,below=False)
             #print 'small prime nx and ny are now ',nx,ny
             self.primes=primes[:]
         else:
@@ -2653,7 +3497,23 @@ class PolMap:
     def clear(self):
         self.map[:]=0
     def axpy(self,map,a):
-        self.map[:]=self.map[:]+a*map.map[:]
+        axpy_inplace(self.map,map.map,a)
+    def aypx(self,map,a):
+        aypx_inplace(self.map,map.map,a)
+    def multiply(self,map,out):
+        if self.npol==1:
+            np.multiply(self.map,map.map,out=out.map)
+        else:
+            out.map[:]=(self*map).map
+    def axpy_precon_dot(self,map,a,precon,out):
+        if precon is None:
+            return axpy_precon_dot(self.map,map.map,a,None,out.map)
+        if precon.npol==1:
+            return axpy_precon_dot(self.map,map.map,a,precon.map,out.map)
+        #polarized preconditioners are little matrices per pixel, so no fusing for them
+        self.axpy(map,a)
+        precon.multiply(self,out)
+        return self.dot(out)
     def assign(self,arr):
         assert(arr.shape[0]==self.nx)
         assert(arr.shape[1]==self.ny)
@@ -2733,6 +3593,9 @@ class PolMap:
             mask=self.map!=0
             self.map[mask]=1.0/self.map[mask]
     def pix_from_radec(self,ra,dec):
+        params=get_wcs_pix_params(self.wcs)
+        if not(params is None):
+            return radec2pix(ra,dec,params,self.ny)
         ndet=ra.shape[0]
         nsamp=ra.shape[1]
         nn=ndet*nsamp
@@ -2751,6 +3614,8 @@ class PolMap:
     def get_pix(self,tod,savepix=True):
         if not(self.tag is None):
             ipix=tod.get_saved_pix(self.tag)
+            if isinstance(ipix,DeltaPix): #a SkyMap sharing our tag may have saved it compressed
+                return ipix.get_ipix()
             if not(ipix is None):
                 return ipix
         if False:
@@ -2821,7 +3686,7 @@ class PolMap:
         th=np.arctan2(xmat,ymat)
         return rmat,th
     def dot(self,map):
-        tot=np.sum(self.map*map.map)
+        tot=dot_inplace(self.map,map.map)
         return tot
         
     def write(self,fname='map.fits'):
@@ -2923,6 +3788,10 @@ class HealMap(SkyMap):
         self.ny=1
         self.caches=None
         self.tag=tag
+        self.purge_pixellization=False
+        self.compress_pixellization=False
+        self.onthefly_pixellization=False
+        self.tod2map_method=None
         self.map=np.zeros([self.nx,self.ny])
     def copy(self):
         newmap=HealMap(self.proj,self.nside,self.tag)
@@ -3232,11 +4101,12 @@ class CutsCompact:
             
 class SkyMapCar(SkyMap):
     def pix_from_radec(self,ra,dec):
-        xpix=np.round((ra-self.lims[0])*self.cosdec/self.pixsize)
-        #ypix=np.round((dec-self.lims[2])/self.pixsize)
-        ypix=((dec-self.lims[2])/self.pixsize)+0.5
-        ipix=np.asarray(xpix*self.ny+ypix,dtype='int32')
-        return ipix
+        return radec2pix(ra,dec,self.get_pix_params(),self.ny)
+    def get_pix_params(self):
+        #same linear pixellization as pix_from_radec and minkasi_nb.radec2pix_car
+        if self.pix_params is None:
+            self.pix_params=np.asarray([2,self.cosdec/self.pixsize,-self.lims[0]*self.cosdec/self.pixsize,1/self.pixsize,-self.lims[2]/self.pixsize],dtype='float64')
+        return self.pix_params
         
 class SkyMapCarOld:
     def __init__(self,lims,pixsize):
@@ -3516,7 +4386,7 @@ def isobeta_src_chisq(params,tods):
 
 
 class NoiseBinnedDet:
-    def __init__(self,dat,dt,freqs=None,scale_facs=None):
+    def __init__(self,dat,dt,freqs=None,scale_facs=None,expand_weights=False):
         ndet=dat.shape[0]
         ndata=dat.shape[1]
         nn=2*(ndata-1)
@@ -3539,12 +4409,33 @@ class NoiseBinnedDet:
         self.ndata=ndata
         self.ndet=ndet
         self.nn=nn
+        self.wt_table=None
+        self.set_expand_weights(expand_weights)
+    def set_expand_weights(self,expand_weights=True):
+        """With expand_weights, keep the per-bin weights expanded to a full ndet x ndata table, so applying the
+        noise is a single multiply over the whole transform.  That costs a TOD's worth of memory per noise model,
+        versus ndet x nbin for the binned weights that get applied in place a bin at a time.  Since the table has
+        to be streamed through memory too, the binned path is usually as fast; use mem_report to see the cost."""
+        if expand_weights:
+            self.wt_table=np.repeat(self.det_ps,np.diff(self.bins),axis=1)
+        else:
+            self.wt_table=None
+    def mem_report(self,verbose=True):
+        """Bytes used by the binned weights and by the expanded table (whether or not we have it)."""
+        nbyte_binned=self.det_ps.nbytes
+        nbyte_table=self.ndet*self.ndata*self.det_ps.itemsize
+        if verbose:
+            print('NoiseBinnedDet weights take ',nbyte_binned,' bytes binned, ',nbyte_table,' bytes expanded.  Expanded is ',(not(self.wt_table is None)))
+        return nbyte_binned,nbyte_table
     def apply_noise(self,dat):
         datft=mkfftw.fft_r2r(dat)
-        for i in range(self.nbin):
-            #datft[:,self.bins[i]:self.bins[i+1]]=datft[:,self.bins[i]:self.bins[i+1]]*np.outer(self.det_ps[:,i],self.bins[i+1]-self.bins[i])
-            datft[:,self.bins[i]:self.bins[i+1]]=datft[:,self.bins[i]:self.bins[i+1]]*np.outer(self.det_ps[:,i],np.ones(self.bins[i+1]-self.bins[i]))
-        dd=mkfftw.fft_r2r(datft)
+        if getattr(self,'wt_table',None) is None:
+            for i in range(self.nbin):
+                #datft[:,self.bins[i]:self.bins[i+1]]=datft[:,self.bins[i]:self.bins[i+1]]*np.outer(self.det_ps[:,i],self.bins[i+1]-self.bins[i])
+                datft[:,self.bins[i]:self.bins[i+1]]*=np.reshape(self.det_ps[:,i],[self.ndet,1])
+        else:
+            datft*=self.wt_table
+        dd=mkfftw.fft_r2r(datft) #FFTW's in-place r2r is slower than going out of place
         dd[:,0]=0.5*dd[:,0]
         dd[:,-1]=0.5*dd[:,-1]
         return dd
@@ -3633,24 +4524,29 @@ class NoiseBinnedEig:
         self.ndata=ndata
         self.ndet=ndet
         self.nn=nn
+        self.setup_woodbury()
+    def setup_woodbury(self):
+        """Precompute the per-bin Woodbury factors.  In bin i the inverse noise is D - D M (M^T D M + P)^-1 M^T D, with
+        D the detector weights, M the modes and P the mode weights.  We store W=D M and L=W (M^T D M + P)^-1, both
+        [nbin,ndet,nmode], so applying the noise costs two skinny matrix products per bin with no inversions."""
+        W=self.modes[np.newaxis,:,:]*np.reshape(self.det_ps.T,[self.nbin,self.ndet,1])
+        mats=np.matmul(self.modes.T[np.newaxis,:,:],W)
+        for i in range(self.nbin):
+            mats[i]+=np.diag(self.mode_ps[:,i])
+        self.wood_W=W
+        self.wood_L=np.matmul(W,np.linalg.inv(mats))
     def apply_noise(self,dat):
         assert(dat.shape[0]==self.ndet)
         assert(dat.shape[1]==self.ndata)
+        if getattr(self,'wood_L',None) is None:
+            self.setup_woodbury()
         datft=mkfftw.fft_r2r(dat)
         for i in range(self.nbin):
-            n=self.bins[i+1]-self.bins[i]
-            #print('bins are ',self.bins[i],self.bins[i+1],n,datft.shape[1])
-            tmp=self.modes*np.outer(self.det_ps[:,i],np.ones(self.modes.shape[1]))
-            mat=np.dot(self.modes.T,tmp)
-            mat=mat+np.diag(self.mode_ps[:,i])
-            mat_inv=np.linalg.inv(mat)
-            Ax=datft[:,self.bins[i]:self.bins[i+1]]*np.outer(self.det_ps[:,i],np.ones(n))
-            tmp=np.dot(self.modes.T,Ax)
-            tmp=np.dot(mat_inv,tmp)
-            tmp=np.dot(self.modes,tmp)
-            tmp=Ax-tmp*np.outer(self.det_ps[:,i],np.ones(n))
-            datft[:,self.bins[i]:self.bins[i+1]]=tmp
-            #print(tmp.shape,mat.shape)
+            #work in place on the bin's slice of datft: x <- D x - L (W^T x)
+            x=datft[:,self.bins[i]:self.bins[i+1]]
+            tmp=np.dot(self.wood_W[i].T,x)
+            x*=np.reshape(self.det_ps[:,i],[self.ndet,1])
+            x-=np.dot(self.wood_L[i],tmp)
         dd=mkfftw.fft_r2r(datft)
         dd[:,0]=0.5*dd[:,0]
         dd[:,-1]=0.5*dd[:,-1]
@@ -3697,8 +4593,113 @@ class NoiseCMWhite:
     def get_det_weights(self):
         return self.mywt.copy()
 
+def get_noise_block(dat,nbyte=1<<22):
+    """Number of detectors to push through the noise FFTs at a time - enough rows to fill about nbyte
+    (roughly an L2/L3 slice), but never fewer than the number of threads so each thread still gets a row."""
+    rowbytes=dat.shape[1]*dat.itemsize
+    return int(max(nbyte//max(rowbytes,1),get_nthread(),1))
+
+noise_cache_dir=None
+
+def set_noise_cache(dirname):
+    """Keep fitted noise models under dirname so Tod.set_noise can load them instead of refitting.  Models
+    are keyed by a hash of the data they were fit to plus the model class and its arguments, so changing
+    either gets you a new model.  Pass None to turn the cache off."""
+    global noise_cache_dir
+    if not(dirname is None) and not(os.path.isdir(dirname)):
+        os.makedirs(dirname,exist_ok=True)
+    noise_cache_dir=dirname
+
+def _hash_noise_arg(h,arg):
+    #only hash plain values.  Anything else (a Tod, say) has a repr with its id() in it, so it would never
+    #give the same key twice; return False so the caller skips the cache.
+    if isinstance(arg,np.ndarray):
+        h.update(repr((arg.shape,arg.dtype.str)).encode())
+        h.update(np.ascontiguousarray(arg).tobytes())
+    elif isinstance(arg,(list,tuple)):
+        h.update(repr((type(arg).__name__,len(arg))).encode())
+        for a in arg:
+            if not(_hash_noise_arg(h,a)):
+                return False
+    elif isinstance(arg,dict):
+        h.update(repr(('dict',len(arg))).encode())
+        for key in sorted(arg.keys()):
+            h.update(repr(key).encode())
+            if not(_hash_noise_arg(h,arg[key])):
+                return False
+    elif arg is None or isinstance(arg,(bool,int,float,complex,str,bytes,np.generic)):
+        h.update(repr((type(arg).__name__,arg)).encode())
+    else:
+        return False
+    return True
+
+def get_noise_cache_key(modelclass,dat,args=(),kwargs={}):
+    """Cache key for a modelclass model fit to dat with args/kwargs, or None if the arguments can't be hashed."""
+    h=hashlib.sha1()
+    h.update((modelclass.__module__+'.'+modelclass.__qualname__).encode())
+    for arg in (dat,tuple(args),kwargs):
+        if not(_hash_noise_arg(h,arg)):
+            return None
+    return h.hexdigest()
+
+def save_noise_cache(noise,key,dirname=None):
+    if dirname is None:
+        dirname=noise_cache_dir
+    fname=os.path.join(dirname,key+'.pkl')
+    #write under a private name and rename so readers never see a partial file
+    tmpname=fname+'.'+repr(os.getpid())+'.'+repr(threading.get_ident())+'.tmp'
+    if hasattr(noise,'__getstate__'):
+        state=noise.__getstate__()
+    else:
+        state=noise.__dict__
+    f=open(tmpname,'wb')
+    pickle.dump(state,f,protocol=pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.replace(tmpname,fname)
+
+def load_noise_cache(modelclass,key,dirname=None):
+    """Rebuild a modelclass noise model from the cache, or return None if it isn't there."""
+    if dirname is None:
+        dirname=noise_cache_dir
+    fname=os.path.join(dirname,key+'.pkl')
+    if not(os.path.isfile(fname)):
+        return None
+    try:
+        f=open(fname,'rb')
+        state=pickle.load(f)
+        f.close()
+    except:
+        print('unable to read cached noise model ',fname,', refitting.')
+        return None
+    noise=modelclass.__new__(modelclass)
+    if hasattr(noise,'__setstate__'):
+        noise.__setstate__(state)
+    else:
+        noise.__dict__.update(state)
+    return noise
+
+def get_smoothed_inv_spec(dat,fwhm=50,fit_powlaw=False):
+    """Inverse smoothed power spectra (in the DCT basis used by the noise classes) for each row of dat,
+    with the DC term zeroed."""
+    if fit_powlaw:
+        spec_smooth=0*dat
+        for ind in range(dat.shape[0]):
+            fitp,datsqr,C=fit_ts_ps(dat[ind,:]);
+            spec_smooth[ind,1:]=C
+    else:
+        dat_trans=mkfftw.fft_r2r(dat)
+        spec_smooth=smooth_many_vecs(dat_trans**2,fwhm)
+    spec_smooth[:,1:]=1.0/spec_smooth[:,1:]
+    spec_smooth[:,0]=0
+    return spec_smooth
+
 class NoiseSmoothedSVD:
-    def __init__(self,dat_use,fwhm=50,prewhiten=False,fit_powlaw=False,u_in=None):
+    def __init__(self,dat_use,fwhm=50,prewhiten=False,fit_powlaw=False,u_in=None,rot_tol=1e-10,nmode=None):
+        #if nmode is set (and less than ndet), only keep the top nmode singular vectors with their own
+        #smoothed spectra, and treat what's left after projecting them out as uncorrelated, with a
+        #smoothed spectrum per detector.  v is then [nmode,ndet] and applying the noise costs
+        #O(nmode*ndet*nsamp) rather than O(ndet^2*nsamp).
+        dat_use=np.asarray(dat_use,dtype='float64') #fit the noise in double even for single-precision TODs
         if prewhiten:
             noisevec=np.median(np.abs(np.diff(dat_use,axis=1)),axis=1)
             dat_use=dat_use/(np.repeat([noisevec],dat_use.shape[1],axis=0).transpose())
@@ -3714,74 +4715,443 @@ class NoiseSmoothedSVD:
         print('got svd')
 
         n=dat_use.shape[1]
-        self.v=np.zeros([ndet,ndet])
-        self.v[:]=u.transpose()
-        if u_in is None:
-            self.vT=self.v.T
+        if not(nmode is None) and nmode>=ndet:
+            nmode=None
+        self.nmode=nmode
+        if nmode is None:
+            self.v=np.zeros([ndet,ndet])
+            self.v[:]=u.transpose()
+            if u_in is None:
+                self.vT=self.v.T
+            else:
+                self.vT=np.linalg.inv(self.v)
         else:
-            self.vT=np.linalg.inv(self.v)
+            self.v=np.ascontiguousarray(u[:,:nmode].transpose())
+            if u_in is None:
+                self.vT=np.ascontiguousarray(self.v.T)
+            else:
+                self.vT=np.linalg.pinv(self.v)
         dat_rot=np.dot(self.v,dat_use)
-        if fit_powlaw:
-            spec_smooth=0*dat_rot
-            for ind in range(ndet):
-                fitp,datsqr,C=fit_ts_ps(dat_rot[ind,:]);
-                spec_smooth[ind,1:]=C
+        spec_smooth=get_smoothed_inv_spec(dat_rot,fwhm,fit_powlaw)
+        if nmode is None:
+            self.mywt_det=None
         else:
-            dat_trans=mkfftw.fft_r2r(dat_rot)
-            spec_smooth=smooth_many_vecs(dat_trans**2,fwhm)
-        spec_smooth[:,1:]=1.0/spec_smooth[:,1:]
-        spec_smooth[:,0]=0
+            dat_resid=dat_use-np.dot(self.vT,dat_rot)
+            self.mywt_det=get_smoothed_inv_spec(dat_resid,fwhm,fit_powlaw)
+            #the residual only spans ndet-nmode dimensions, so detector d only sees a fraction (1-P)_dd of
+            #the residual modes' power.  Scaling its weight by (1-P)_dd makes (1-P) W_det (1-P) the exact
+            #inverse when the residual modes share a spectrum, and exact for any spectrum when one mode is left.
+            pdiag=1-np.sum(self.vT*self.v.T,axis=1)
+            self.mywt_det*=np.reshape(np.maximum(pdiag,0),[ndet,1])
         if prewhiten:
             self.noisevec=noisevec.copy()
         else:
             self.noisevec=None
         self.mywt=spec_smooth
+        self.mats_single=None
+        self.mode_bufs={}
+        self.set_rot_kind(rot_tol)
+    def __getstate__(self):
+        #leave the single-precision copies and low-rank buffers out of pickles (and the noise cache)
+        state=self.__dict__.copy()
+        for name in ['mats_single','mywt_det_single','mode_bufs']:
+            state.pop(name,None)
+        return state
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.mats_single=None
+        self.mode_bufs={}
+    def set_rot_kind(self,rot_tol=1e-10):
+        """Look at the rotation to see if apply_noise_wscratch can skip the matrix multiplies.  If every
+        off-diagonal element of v and vT is below rot_tol times the largest element, the rotation is
+        treated as diagonal (a per-detector scale), and if the diagonal is also 1 to within rot_tol it
+        is skipped entirely.  Setting rot_tol<0 forces the full rotation."""
+        self.rot_kind='full'
+        self.rot_diag=None
+        if not(getattr(self,'nmode',None) is None):
+            self.rot_kind='lowrank'
+            return
+        if rot_tol<0:
+            return
+        vv=[self.v,np.asarray(self.vT)]
+        for mat in vv:
+            dd=np.abs(np.diag(mat))
+            thresh=rot_tol*np.max(np.abs(mat))
+            off=np.abs(mat)
+            off=np.max(off-np.diag(dd)) if mat.shape[0]>1 else 0
+            if off>thresh:
+                return
+        dd=np.diag(self.v).copy()
+        ddT=np.diag(self.vT).copy()
+        if np.max(np.abs(dd-1))<=rot_tol and np.max(np.abs(ddT-1))<=rot_tol:
+            self.rot_kind='identity'
+        else:
+            self.rot_kind='diag'
+            self.rot_diag=(dd,ddT)
+    def get_rot(self,dtype):
+        """Return the rotation kind ('full', 'diag', 'identity' or 'lowrank') and the diagonals of v and vT (as
+        [ndet,1] columns in the requested precision) when the rotation is diagonal."""
+        kind=getattr(self,'rot_kind','full')
+        if kind!='diag':
+            return kind,None,None
+        dd,ddT=self.rot_diag
+        return kind,np.reshape(np.asarray(dd,dtype=dtype),[len(dd),1]),np.reshape(np.asarray(ddT,dtype=dtype),[len(ddT),1])
+    def get_mats(self,dtype):
+        """Return v, vT, mywt and noisevec in the precision of the data we're applying to, so single-precision
+        TODs stay single through the rotations and FFTs."""
+        if dtype!=np.dtype('float32'):
+            return self.v,self.vT,self.mywt,self.noisevec
+        if getattr(self,'mats_single',None) is None:
+            if not(getattr(self,'mywt_det',None) is None):
+                self.mywt_det_single=np.asarray(self.mywt_det,dtype='float32')
+            noisevec=None
+            if not(self.noisevec is None):
+                noisevec=np.asarray(self.noisevec,dtype='float32')
+            self.mats_single=(np.asarray(self.v,dtype='float32'),np.ascontiguousarray(self.vT,dtype='float32'),np.asarray(self.mywt,dtype='float32'),noisevec)
+        return self.mats_single
+    def get_mode_buf(self,name,shape,dtype):
+        #small [nmode,nsamp] work arrays for the low-rank apply, kept around between calls
+        key=(name,tuple(shape),np.dtype(dtype).str)
+        if not(key in self.mode_bufs):
+            self.mode_bufs[key]=np.empty(shape,dtype=dtype)
+        return self.mode_bufs[key]
+    def apply_noise_lowrank(self,dat,tmp,tmp2,block=None):
+        #N^-1 x = vT W_mode v x + (1-P) W_det (1-P) x with P=vT v, so the residual after
+        #projecting out the modes only sees the per-detector spectra and the whole thing stays symmetric.
+        v,vT,mywt,noisevec=self.get_mats(dat.dtype)
+        if dat.dtype==np.dtype('float32'):
+            mywt_det=self.mywt_det_single
+        else:
+            mywt_det=self.mywt_det
+        nmode=v.shape[0]
+        ndet=dat.shape[0]
+        ma=self.get_mode_buf('a',[nmode,dat.shape[1]],dat.dtype)
+        mb=self.get_mode_buf('b',[nmode,dat.shape[1]],dat.dtype)
+        x=dat
+        if not(noisevec is None):
+            np.divide(x,np.reshape(noisevec,[len(noisevec),1]),out=tmp2)
+            x=tmp2
+        np.dot(v,x,ma)
+        np.dot(vT,ma,tmp)
+        np.subtract(x,tmp,out=tmp)
+        if block is None:
+            block=get_noise_block(dat)
+        if block<=0 or block>=ndet:
+            block=ndet
+        for i0 in range(0,ndet,block):
+            i1=min(i0+block,ndet)
+            datft=mkfftw.fft_r2r(tmp[i0:i1,:],tmp2[i0:i1,:])
+            nn=datft.shape[1]
+            np.multiply(datft,mywt_det[i0:i1,:nn],out=datft)
+            mkfftw.fft_r2r(datft,tmp[i0:i1,:])
+        np.dot(v,tmp,mb)
+        np.dot(vT,mb,tmp2)
+        np.subtract(tmp,tmp2,out=tmp)
+        datft=mkfftw.fft_r2r(ma,mb)
+        nn=datft.shape[1]
+        np.multiply(datft,mywt[:,:nn],out=datft)
+        mkfftw.fft_r2r(datft,ma)
+        np.dot(vT,ma,tmp2)
+        np.add(tmp,tmp2,out=tmp)
+        tmp[:,0]*=0.5
+        tmp[:,-1]*=0.5
+        if not(noisevec is None):
+            tmp/=np.reshape(noisevec,[len(noisevec),1])
+        return tmp
     def apply_noise(self,dat):
-        if not(self.noisevec is None):
-            noisemat=np.repeat([self.noisevec],dat.shape[1],axis=0).transpose()
+        if getattr(self,'nmode',None) is not None:
+            return self.apply_noise_lowrank(dat,np.empty(dat.shape,dtype=dat.dtype),np.empty(dat.shape,dtype=dat.dtype))
+        v,vT,mywt,noisevec=self.get_mats(dat.dtype)
+        if not(noisevec is None):
+            noisemat=np.repeat([noisevec],dat.shape[1],axis=0).transpose()
             dat=dat/noisemat
-        dat_rot=np.dot(self.v,dat)
+        dat_rot=np.dot(v,dat)
         datft=mkfftw.fft_r2r(dat_rot)
         nn=datft.shape[1]
-        datft=datft*self.mywt[:,:nn]
+        datft=datft*mywt[:,:nn]
         dat_rot=mkfftw.fft_r2r(datft)
         #dat=np.dot(self.v.T,dat_rot)
-        dat=np.dot(self.vT,dat_rot)
+        dat=np.dot(vT,dat_rot)
         dat[:,0]=0.5*dat[:,0]
         dat[:,-1]=0.5*dat[:,-1]
-        if not(self.noisevec is None):
+        if not(noisevec is None):
             #noisemat=np.repeat([self.noisevec],dat.shape[1],axis=0).transpose()
             dat=dat/noisemat        
         return dat
 
-    def apply_noise_wscratch(self,dat,tmp,tmp2):
-        if not(self.noisevec is None):
-            noisemat=np.repeat([self.noisevec],dat.shape[1],axis=0).transpose()
-            dat=dat/noisemat
-        dat_rot=tmp
-        dat_rot=np.dot(self.v,dat,dat_rot)
-        dat=tmp2
-        datft=dat
-        datft=mkfftw.fft_r2r(dat_rot,datft)
-        nn=datft.shape[1]
-        datft[:]=datft*self.mywt[:,:nn]
-        dat_rot=tmp
-        dat_rot=mkfftw.fft_r2r(datft,dat_rot)
-        #dat=np.dot(self.v.T,dat_rot)
-        dat=np.dot(self.vT,dat_rot,dat)
-        dat[:,0]=0.5*dat[:,0]
-        dat[:,-1]=0.5*dat[:,-1]
-        if not(self.noisevec is None):
-            #noisemat=np.repeat([self.noisevec],dat.shape[1],axis=0).transpose()
-            dat=dat/noisemat        
-        return dat
+    def apply_noise_wscratch(self,dat,tmp,tmp2,block=None):
+        #apply_noise without allocating anything.  tmp and tmp2 are work arrays shaped like dat, and the
+        #answer comes back in one of them (use the return value).  dat is left alone.  If the rotation
+        #is diagonal or the identity we skip the matrix multiplies (see set_rot_kind).  The forward
+        #transform, weighting and inverse transform are done block detectors at a time so each block
+        #is still in cache when we weight it and transform it back.  block<=0 does everything at once.
+        kind,dd,ddT=self.get_rot(dat.dtype)
+        if kind=='lowrank':
+            return self.apply_noise_lowrank(dat,tmp,tmp2,block)
+        v,vT,mywt,noisevec=self.get_mats(dat.dtype)
+        x=dat
+        if not(noisevec is None):
+            np.divide(x,np.reshape(noisevec,[len(noisevec),1]),out=tmp2)
+            x=tmp2
+        if kind=='full':
+            x=np.dot(v,x,tmp)
+        elif kind=='diag':
+            x=np.multiply(x,dd,out=tmp)
+        #y holds the transform, z the filtered timestreams.  z is allowed to be x since each block is
+        #finished with its own rows of x before the inverse transform writes them.
+        if x is tmp2:
+            y=tmp
+        else:
+            y=tmp2
+        if x is dat:
+            z=tmp
+        else:
+            z=x
+        ndet=dat.shape[0]
+        if block is None:
+            block=get_noise_block(dat)
+        if block<=0 or block>=ndet:
+            block=ndet
+        for i0 in range(0,ndet,block):
+            i1=min(i0+block,ndet)
+            datft=mkfftw.fft_r2r(x[i0:i1,:],y[i0:i1,:])
+            nn=datft.shape[1]
+            np.multiply(datft,mywt[i0:i1,:nn],out=datft)
+            mkfftw.fft_r2r(datft,z[i0:i1,:])
+        if kind=='full':
+            #dat=np.dot(self.v.T,dat_rot)
+            z=np.dot(vT,z,y)
+        elif kind=='diag':
+            np.multiply(z,ddT,out=z)
+        z[:,0]*=0.5
+        z[:,-1]*=0.5
+        if not(noisevec is None):
+            z/=np.reshape(noisevec,[len(noisevec),1])
+        return z
 
     def get_det_weights(self):
         """Find the per-detector weights for use in making actual noise maps."""
         mode_wt=np.sum(self.mywt,axis=1)
         #tmp=np.dot(self.v.T,np.dot(np.diag(mode_wt),self.v))
         tmp=np.dot(self.vT,np.dot(np.diag(mode_wt),self.v))
-        return np.diag(tmp).copy()*2.0
+        if getattr(self,'mywt_det',None) is None:
+            return np.diag(tmp).copy()*2.0
+        proj=np.eye(self.vT.shape[0])-np.dot(self.vT,self.v)
+        det_wt=np.sum(self.mywt_det,axis=1)
+        return (np.diag(tmp)+np.dot(proj**2,det_wt))*2.0
+
+class NoiseSmoothedSVDBand(NoiseSmoothedSVD):
+    """NoiseSmoothedSVD for long TODs whose mode spectra are flat above some knee.  Each mode is treated as white
+    (just a scale in the time domain) with weight w_hi, and the difference between its smoothed spectrum and
+    w_hi below the cutoff index is applied exactly on those DCT coefficients.  We get the first cutoff DCT-I
+    coefficients without a full-length transform by splitting the TOD into blocks of decimate samples and
+    Taylor expanding each cosine across a block, so the low band comes from a handful of polynomial moments
+    per block (one matrix multiply) and FFTs that are decimate times shorter.  The adjoint does the same in
+    reverse, so the operator stays symmetric.  decimate has to divide nsamp-1, and the coarse grid keeps
+    the cutoff below 1/oversamp of its band so the expansion converges quickly; npoly terms are kept, enough
+    for a truncation error well below band_tol, and decimate has to be at least 2*npoly for this to be any
+    faster than the full transforms.  If cutoff isn't given, it's the smallest one whose expected
+    fractional error from flattening the spectra is below band_tol (see get_band_cutoff).  If the cutoff is
+    too high to decimate, or the flattening error at the cutoff or the measured transform error is over
+    max_err, we say so and fall back to plain NoiseSmoothedSVD.  band_err holds the measured transform
+    error, the difference from the full operator and the fractional change in chi^2 on the fitting data."""
+    def __init__(self,dat_use,fwhm=50,prewhiten=False,fit_powlaw=False,u_in=None,cutoff=None,decimate=None,band_tol=1e-2,oversamp=4,max_err=None,report_error=True):
+        NoiseSmoothedSVD.__init__(self,dat_use,fwhm,prewhiten,fit_powlaw,u_in)
+        if max_err is None:
+            max_err=10*band_tol
+        #the smoothed spectra scatter by 2/(1.5*fwhm) (relative variance) from the DCT-I coefficients being chi^2
+        #with one dof and the smoothing kernel covering 1.5*fwhm of them
+        neff=1.5*fwhm
+        if fit_powlaw:
+            neff=np.inf
+        self.setup_band(cutoff,decimate,band_tol,oversamp,neff)
+        self.band_err=None
+        if self.use_band and self.band_model_err>max_err:
+            print('banded noise cutoff ',self.cutoff,' flattens the spectra with an error of ',self.band_model_err,' over ',max_err,', so using plain NoiseSmoothedSVD.')
+            self.use_band=False
+        if self.use_band:
+            self.band_err=self.get_band_error(np.asarray(dat_use,dtype='float64'))
+            if report_error:
+                print('banded noise with cutoff ',self.cutoff,', decimation ',self.decimate,' and ',self.npoly,' terms has flattening error ',self.band_model_err,', transform error ',self.band_err[0],', difference from full ',self.band_err[1],' and chi^2 change ',self.band_err[2])
+            if self.band_err[0]>max_err:
+                print('banded noise transform error ',self.band_err[0],' is over ',max_err,', so using plain NoiseSmoothedSVD.')
+                self.use_band=False
+    def get_band_cutoff(self,band_tol=1e-2,neff=75):
+        """Expected fractional rms error in N^-1 d from flattening the mode spectra above each cutoff.  Mode
+        power at k is 1/w, so N^-1 d has power w there and treating it as white with weight c adds (w-c)^2/w;
+        c is the harmonic mean of w above the cutoff, which minimizes that.  w scatters around the true
+        spectrum by sqrt(2/neff) or so, and flattening that scatter away isn't an error, so we average w over
+        log-spaced bins (harmonically) and only count what's more than twice the scatter of each bin's mean from flat.
+        Returns the smallest bin edge that gets the error under band_tol (nsamp if none does), and the edges
+        with their errors."""
+        mywt=self.mywt
+        nmode,n=mywt.shape
+        w=np.maximum(mywt,1e-12*np.max(mywt))
+        edges=np.unique(np.asarray(np.logspace(0,np.log10(n),10*int(np.log10(n)+1)),dtype='int64'))
+        edges[-1]=n
+        nb=np.diff(edges)
+        #harmonic means, i.e. 1/mean power, since the plain mean of 1/power is biased up by the scatter
+        invb=np.add.reduceat(1.0/w,edges[:-1],axis=1)
+        wb=nb/invb
+        sig=np.sqrt(2.0/(nb+neff))
+        tot=np.sum(w[:,1:])
+        err=np.zeros(len(edges))
+        for i in range(len(edges)-1):
+            c=np.reshape((n-edges[i])/np.sum(invb[:,i:],axis=1),[nmode,1])
+            dev=np.maximum(np.abs(wb[:,i:]/c-1)-2*sig[i:],0)
+            err[i]=np.sqrt(np.sum(nb[i:]*c**2*dev**2/wb[:,i:])/tot)
+        ok=np.where(err<=band_tol)[0]
+        return edges[ok[0]],edges,err
+    def setup_band(self,cutoff=None,decimate=None,band_tol=1e-2,oversamp=4,neff=75):
+        mywt=self.mywt
+        nmode,n=mywt.shape
+        best,edges,err=self.get_band_cutoff(band_tol,neff)
+        if cutoff is None:
+            cutoff=best
+        cutoff=int(min(max(cutoff,1),n))
+        self.cutoff=cutoff
+        self.band_model_err=err[np.searchsorted(edges,cutoff,side='right')-1]
+        self.band_single=None
+        if decimate is None:
+            decimate=(n-1)//(oversamp*cutoff)
+        decimate=int(min(max(decimate,1),(n-1)//2))
+        target=decimate
+        while decimate>1 and ((n-1)%decimate or (n-1)//decimate<cutoff):
+            decimate=decimate-1
+        self.decimate=decimate
+        self.use_band=decimate>1
+        if not(self.use_band):
+            if target>1:
+                print('nsamp-1=',n-1,' has no divisor up to ',target,' for the banded noise, so using plain NoiseSmoothedSVD.  truncate_tod first to fix this.')
+            else:
+                print('noise cutoff ',cutoff,' (flattening error ',self.band_model_err,') is too high to decimate ',n,' samples, so using plain NoiseSmoothedSVD.')
+            return
+        if 2*decimate<=target:
+            print('banded noise decimating by ',decimate,' rather than ',target,' since nsamp-1=',n-1,' has no better divisor.  truncate_tod first to fix this.')
+        nblock=(n-1)//decimate
+
+        #sample j=a*decimate+r has cos(pi*j*k/(n-1))=Re(exp(i*pi*a*k/nblock)*exp(i*s_k*t_r)) with t_r=r/decimate
+        #and s_k=pi*k/nblock, and we expand the second factor to npoly terms.  s_k is at most pi/oversamp or
+        #so, and the first term we drop is s^npoly/npoly!
+        smax=np.pi*(cutoff-1)/nblock
+        npoly=1
+        term=1.0
+        while npoly<30:
+            term=term*smax/npoly
+            if term<1e-3*band_tol:
+                break
+            npoly=npoly+1
+        self.npoly=npoly
+        if decimate<2*npoly:
+            #the moments cost npoly multiply-adds a sample each way, which is about what the full transforms do
+            print('banded noise decimating by ',decimate,' with ',npoly,' terms would be no faster, so using plain NoiseSmoothedSVD.')
+            self.use_band=False
+            return
+        pp=np.arange(npoly)
+        fac=np.cumprod(np.maximum(pp,1))
+        tt=np.arange(decimate)/decimate
+        self.band_tpow=tt[:,None]**pp[None,:]
+        ss=np.pi*np.arange(cutoff)/nblock
+        self.band_coef=(1j*ss[None,:])**pp[:,None]/fac[:,None]
+
+        w_hi=np.zeros(nmode)
+        if cutoff<n:
+            w=np.maximum(mywt[:,cutoff:],1e-12*np.max(mywt))
+            w_hi=(n-cutoff)/np.sum(1.0/w,axis=1)
+        cvec=2*np.ones(cutoff)
+        cvec[0]=1
+        self.band_w_hi=w_hi
+        self.band_white=2.0*(n-1)*w_hi
+        self.band_wlow=(mywt[:,:cutoff]-np.reshape(w_hi,[nmode,1]))*cvec
+    def __getstate__(self):
+        state=NoiseSmoothedSVD.__getstate__(self)
+        state.pop('band_single',None)
+        return state
+    def __setstate__(self,state):
+        NoiseSmoothedSVD.__setstate__(self,state)
+        self.band_single=None
+    def get_band_mats(self,dtype):
+        if dtype!=np.dtype('float32'):
+            return self.band_white,self.band_wlow,self.band_tpow,self.band_coef
+        if self.band_single is None:
+            self.band_single=(np.asarray(self.band_white,dtype='float32'),np.asarray(self.band_wlow,dtype='float32'),np.asarray(self.band_tpow,dtype='float32'),np.asarray(self.band_coef,dtype='complex64'))
+        return self.band_single
+    def get_low_band(self,x):
+        """First cutoff DCT-I coefficients (FFTW's REDFT00 normalization) of the rows of x."""
+        white,wlow,tpow,coef=self.get_band_mats(x.dtype)
+        ndet,n=x.shape
+        m=self.decimate
+        nblock=(n-1)//m
+        npoly=self.npoly
+        mom=np.dot(np.reshape(x[:,:n-1],[ndet*nblock,m]),tpow)
+        mpad=self.get_mode_buf('bandmom',[ndet,npoly,2*nblock],x.dtype)
+        mpad[:]=0
+        mpad[:,:,:nblock]=np.transpose(np.reshape(mom,[ndet,nblock,npoly]),[0,2,1])
+        #the DCT-I weights the end points by half relative to the rest
+        mpad[:,0,0]-=0.5*x[:,0]
+        mpad[:,0,nblock]=0.5*x[:,-1]
+        mft=np.fft.rfft(mpad,axis=2)[:,:,:self.cutoff]
+        return 2*np.real(np.einsum('pk,dpk->dk',coef,np.conj(mft)))
+    def put_low_band(self,u,out):
+        """Add sum_k u_k cos(pi*j*k/(n-1)) to each row of out (the transpose of get_low_band, bar the
+        end-point weights)."""
+        white,wlow,tpow,coef=self.get_band_mats(out.dtype)
+        ndet,n=out.shape
+        m=self.decimate
+        nblock=(n-1)//m
+        npoly=self.npoly
+        vv=u[:,None,:]*coef[None,:,:]
+        vv[:,:,0]*=2
+        gg=np.fft.irfft(vv,n=2*nblock,axis=2)[:,:,:nblock+1]*nblock
+        up=np.dot(np.reshape(np.transpose(gg[:,:,:nblock],[0,2,1]),[ndet*nblock,npoly]),tpow.T)
+        out[:,:n-1]+=np.reshape(up,[ndet,n-1])
+        out[:,-1]+=gg[:,0,nblock]
+        return out
+    def apply_noise(self,dat):
+        return self.apply_noise_wscratch(dat,np.empty(dat.shape,dtype=dat.dtype),np.empty(dat.shape,dtype=dat.dtype))
+    def apply_noise_wscratch(self,dat,tmp,tmp2,block=None):
+        if not(getattr(self,'use_band',True)):
+            return NoiseSmoothedSVD.apply_noise_wscratch(self,dat,tmp,tmp2,block)
+        v,vT,mywt,noisevec=self.get_mats(dat.dtype)
+        white,wlow,tpow,coef=self.get_band_mats(dat.dtype)
+        ndet,n=dat.shape
+        x=dat
+        if not(noisevec is None):
+            np.divide(x,np.reshape(noisevec,[len(noisevec),1]),out=tmp2)
+            x=tmp2
+        x=np.dot(v,x,tmp)
+        xlow=self.get_low_band(x)
+        xlow*=wlow
+        np.multiply(x,np.reshape(white,[ndet,1]),out=tmp2)
+        self.put_low_band(xlow,tmp2)
+        z=np.dot(vT,tmp2,tmp)
+        z[:,0]*=0.5
+        z[:,-1]*=0.5
+        if not(noisevec is None):
+            z/=np.reshape(noisevec,[len(noisevec),1])
+        return z
+    def get_band_error(self,dat):
+        """Compare the banded operator on dat to the same flattened weights applied with full-length transforms
+        (which should only differ by the Taylor truncation), and to the full NoiseSmoothedSVD operator (which
+        also differs by the scatter of the smoothed spectra above the cutoff).  Returns both fractional rms
+        differences, and the fractional change in chi^2=dat.N^-1.dat against the full operator."""
+        exact=NoiseSmoothedSVD.apply_noise(self,dat)
+        approx=self.apply_noise(dat)
+        wflat=self.mywt.copy()
+        wflat[:,self.cutoff:]=np.reshape(self.band_w_hi,[len(self.band_w_hi),1])
+        x=dat
+        if not(self.noisevec is None):
+            x=x/np.reshape(self.noisevec,[len(self.noisevec),1])
+        xft=mkfftw.fft_r2r(np.dot(self.v,x))
+        flat=np.dot(self.vT,mkfftw.fft_r2r(xft*wflat))
+        flat[:,0]*=0.5
+        flat[:,-1]*=0.5
+        if not(self.noisevec is None):
+            flat/=np.reshape(self.noisevec,[len(self.noisevec),1])
+        terr=np.sqrt(np.sum((approx-flat)**2)/np.sum(flat**2))
+        err=np.sqrt(np.sum((approx-exact)**2)/np.sum(exact**2))
+        chisq_err=np.sum(dat*approx)/np.sum(dat*exact)-1
+        return terr,err,chisq_err
 
 class Tod:
     def __init__(self,info):
@@ -3849,13 +5219,15 @@ class Tod:
 
     def get_radec(self):
         return self.info['dx'],self.info['dy']
-    def get_empty(self,clear=False):
+    def get_dtype(self):
         if 'dtype' in self.info.keys():
-            dtype=self.info['dtype']
+            return self.info['dtype']
         elif 'dat_calib' in self.info.keys():
-            dtype=self.info['dat_calib'].dtype
+            return self.info['dat_calib'].dtype
         else:            
-            dtype='float'
+            return 'float'
+    def get_empty(self,clear=False):
+        dtype=self.get_dtype()
         if clear:
             #return np.zeros(self.info['dat_calib'].shape,dtype=self.info['dat_calib'].dtype)            
             return np.zeros([self.get_ndet(),self.get_ndata()],dtype=dtype)
@@ -3865,7 +5237,10 @@ class Tod:
     def set_tag(self,tag):
         self.info['tag']=tag
     def set_pix(self,map):
-        ipix=map.get_pix(self)
+        if isinstance(map,SkyMap):
+            ipix=map.get_pix(self,compressed=True)
+        else:
+            ipix=map.get_pix(self)
         #self.info['ipix']=ipix
         self.info[map.tag]=ipix
     def copy(self,copy_info=False):
@@ -3893,7 +5268,9 @@ class Tod:
         tod.noise=self.noise
             
         return tod
-    def set_noise(self,modelclass=NoiseSmoothedSVD,dat=None,delayed=False,*args,**kwargs):
+    def set_noise(self,modelclass=NoiseSmoothedSVD,dat=None,delayed=False,*args,noise_cache=None,**kwargs):
+        #if noise_cache (or the module-wide noise_cache_dir from set_noise_cache) is set, look for a model
+        #fit to the same data with the same class and arguments before fitting a new one.
         if delayed:
             self.noise_args=copy.deepcopy(args)
             self.noise_kwargs=copy.deepcopy(kwargs)
@@ -3903,7 +5280,23 @@ class Tod:
             self.noise_delayed=False
             if dat is None:
                 dat=self.info['dat_calib']
-            self.noise=modelclass(dat,*args,**kwargs)
+            if noise_cache is None:
+                noise_cache=noise_cache_dir
+            if noise_cache is None:
+                self.noise=modelclass(dat,*args,**kwargs)
+                return
+            key=get_noise_cache_key(modelclass,dat,args,kwargs)
+            if key is None:
+                print('noise model arguments can not be hashed, fitting without the cache.')
+                self.noise=modelclass(dat,*args,**kwargs)
+                return
+            self.noise=load_noise_cache(modelclass,key,noise_cache)
+            if self.noise is None:
+                self.noise=modelclass(dat,*args,**kwargs)
+                try:
+                    save_noise_cache(self.noise,key,noise_cache)
+                except:
+                    print('unable to write noise model to cache ',noise_cache)
     def get_det_weights(self):
         if self.noise is None:
             print("noise model not set in get_det_weights.")
@@ -4018,14 +5411,30 @@ class Tod:
         self.info['noise']='smoothed_svd'
         #return dat_rot
         
-    def apply_noise(self,dat=None):
+    def apply_noise(self,dat=None,scratch=None):
+        #noise models with an apply_noise_wscratch leave their input alone, so we can skip copying the
+        #data and run them in work buffers.  If scratch (a ScratchArena) is passed the answer is a view
+        #into it, so use it before the next call that shares the arena.
+        if self.noise_delayed:
+            if dat is None:
+                self.noise=self.noise_modelclass(self.get_data().copy(),*(self.noise_args), **(self.noise_kwargs))
+            else:
+                self.noise=self.noise_modelclass(dat,*(self.noise_args), **(self.noise_kwargs))
+            self.noise_delayed=False
+        if hasattr(getattr(self,'noise',None),'apply_noise_wscratch'):
+            if dat is None:
+                dat=self.get_data()
+            if scratch is None:
+                tmp=np.empty(dat.shape,dtype=dat.dtype)
+                tmp2=np.empty(dat.shape,dtype=dat.dtype)
+            else:
+                tmp=scratch.get('tmp',dat.shape,dat.dtype)
+                tmp2=scratch.get('tmp2',dat.shape,dat.dtype)
+            return self.noise.apply_noise_wscratch(dat,tmp,tmp2)
         if dat is None:
             #dat=self.info['dat_calib']
             dat=self.get_data().copy() #the .copy() is here so you don't
                                        #overwrite data stored in the TOD.
-        if self.noise_delayed:
-            self.noise=self.noise_modelclass(dat,*(self.noise_args), **(self.noise_kwargs))
-            self.noise_delayed=False
         try:
             return self.noise.apply_noise(dat)
         except:
@@ -4067,14 +5476,32 @@ class Tod:
             dat=self.get_data()
         for map in mapset.maps:
             map.tod2map(self,dat)
-    def dot(self,mapset,mapset_out,times=False):
+    def apply_noise_wscratch(self,dat,tmp,tmp2):
+        """apply_noise using work arrays shaped like dat, for noise models that can run without allocating.
+        Other noise models fall back on apply_noise."""
+        if self.noise_delayed:
+            self.noise=self.noise_modelclass(self.get_data().copy(),*(self.noise_args), **(self.noise_kwargs))
+            self.noise_delayed=False
+        if hasattr(self.noise,'apply_noise_wscratch'):
+            return self.noise.apply_noise_wscratch(dat,tmp,tmp2)
+        return self.apply_noise(dat)
+    def dot(self,mapset,mapset_out,times=False,scratch=None):
         #tmp=0.0*self.info['dat_calib']
         #for map in mapset.maps:
         #    map.map2tod(self,tmp)
         t1=time.time()
-        tmp=self.mapset2tod(mapset)
-        t2=time.time()
-        tmp=self.apply_noise(tmp)
+        if scratch is None:
+            tmp=self.mapset2tod(mapset)
+            t2=time.time()
+            tmp=self.apply_noise(tmp)
+        else:
+            dims=self.get_data_dims()
+            dtype=self.get_dtype()
+            tmp=scratch.get('dat',dims,dtype)
+            tmp[:]=0
+            self.mapset2tod(mapset,tmp)
+            t2=time.time()
+            tmp=self.apply_noise_wscratch(tmp,scratch.get('tmp',dims,dtype),scratch.get('tmp2',dims,dtype))
         t3=time.time()
         self.tod2mapset(mapset_out,tmp)
         t4=time.time()
@@ -4145,10 +5572,34 @@ def slice_with_copy(arr,ind):
             ans[:,:]=arr[ind,:].copy()
         return ans
     return None #should not get here
+class ScratchArena:
+    """Reusable work buffers for the TOD-sized temporaries in Tod.dot.  Each named buffer grows to fit the
+    largest TOD asked for and then hands out views, so once we've been through a TodVec nothing new gets
+    allocated.  nbytes_allocated counts every byte the arena has ever had to allocate."""
+    def __init__(self):
+        self.bufs={}
+        self.nbytes_allocated=0
+    def get(self,name,shape,dtype='float64'):
+        dtype=np.dtype(dtype)
+        n=int(np.prod(shape))
+        key=(name,dtype.str)
+        buf=self.bufs.get(key)
+        if buf is None or buf.size<n:
+            buf=np.empty(n,dtype=dtype)
+            self.nbytes_allocated+=buf.nbytes
+            self.bufs[key]=buf
+        return np.reshape(buf[:n],shape)
+    def nbytes(self):
+        return sum([buf.nbytes for buf in self.bufs.values()])
+    def clear(self):
+        self.bufs={}
+
 class TodVec:
     def __init__(self):
         self.tods=[]
         self.ntod=0
+        self.scratch=ScratchArena()
+        self.alloc_log=[]
     def add_tod(self,tod):
 
         self.tods.append(tod.copy())
@@ -4201,7 +5652,21 @@ class TodVec:
                 tot=comm.allreduce(tot)
         return tot
 
-    def dot(self,mapset,mapset2=None,report_times=False,cache_maps=False):
+    def dot(self,mapset,mapset2=None,report_times=False,cache_maps=False,use_scratch=True,report_alloc=False):
+        """Apply A=P^T N^-1 P to mapset.  With use_scratch, the TOD-sized temporaries come out of self.scratch,
+        which is reused across TODs and calls.  With report_alloc, we record in self.alloc_log the peak bytes
+        numpy/python allocated on top of what was live going in (via tracemalloc), and how much the
+        scratch arena grew, so allocation regressions in the dot show up as numbers."""
+        if report_alloc:
+            was_tracing=tracemalloc.is_tracing()
+            if not(was_tracing):
+                tracemalloc.start()
+            try:
+                tracemalloc.reset_peak()
+            except AttributeError: #reset_peak is new in python 3.9
+                pass
+            mem_start=tracemalloc.get_traced_memory()[0]
+            arena_start=self.scratch.nbytes_allocated
         if mapset2 is None:
             mapset2=mapset.copy()
             mapset2.clear()
@@ -4210,6 +5675,10 @@ class TodVec:
             mapset2=self.dot_cached(mapset,mapset2)
             return mapset2
             
+        if not(hasattr(self,'scratch')): #TodVecs pickled before the arena existed
+            self.scratch=ScratchArena()
+            self.alloc_log=[]
+        scratch=self.scratch if use_scratch else None
 
         times=np.zeros(self.ntod)
         tot_times=0
@@ -4217,22 +5686,61 @@ class TodVec:
         for i in range(self.ntod):
             tod=self.tods[i]
             t1=time.time()
-            mytimes=tod.dot(mapset,mapset2,True)
+            mytimes=tod.dot(mapset,mapset2,True,scratch)
             t2=time.time()
             tot_times=tot_times+mytimes
             times[i]=t2-t1
         if have_mpi:
             mapset2.mpi_reduce()
         print(tot_times)
+        if report_alloc:
+            peak=tracemalloc.get_traced_memory()[1]-mem_start
+            if not(was_tracing):
+                tracemalloc.stop()
+            arena_grew=self.scratch.nbytes_allocated-arena_start
+            self.alloc_log.append([peak,arena_grew])
+            print('dot peak allocation ',peak,' bytes, scratch arena grew by ',arena_grew,' bytes')
         if report_times:
             return mapset2,times
         else:
             return mapset2
+    def set_noise_all(self,modelclass=NoiseSmoothedSVD,*args,nworker=None,**kwargs):
+        """Fit modelclass noise models for every TOD in a pool of nworker threads, passing args/kwargs through
+        to Tod.set_noise.  The SVDs, FFTs and smoothing all drop the GIL, so threads are enough.  TODs go out
+        biggest first so the long ones don't end up at the back of the queue, and the set_nthread threads are
+        split between the workers.  Splitting the BLAS threads (numpy's SVDs) needs threadpoolctl, so without
+        it nworker defaults to 1, and an explicit nworker>1 can run up to nworker times the BLAS thread count."""
+        nthread=get_nthread()
+        if nworker is None:
+            nworker=nthread if have_threadpoolctl else 1
+        nworker=int(max(1,min(nworker,self.ntod)))
+        if nworker==1:
+            for tod in self.tods:
+                tod.set_noise(modelclass,None,False,*args,**kwargs)
+            return
+        inner=int(max(1,nthread//nworker))
+        def fit_one(tod):
+            set_local_nthread(inner)
+            tod.set_noise(modelclass,None,False,*args,**kwargs)
+        sizes=[np.prod(tod.get_data_dims()) for tod in self.tods]
+        order=np.argsort(sizes,kind='stable')[::-1]
+        if have_threadpoolctl:
+            limits=threadpool_limits(limits=inner,user_api='blas')
+        else:
+            print('threadpoolctl not found, BLAS threads in set_noise_all are not limited')
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nworker) as pool:
+                jobs=[pool.submit(fit_one,self.tods[i]) for i in order]
+                for job in jobs:
+                    job.result()
+        finally:
+            if have_threadpoolctl:
+                limits.restore_original_limits()
     def make_rhs(self,mapset,do_clear=False):
         if do_clear:
             mapset.clear()
         for tod in self.tods:
-            dat_filt=tod.apply_noise()
+            dat_filt=tod.apply_noise(scratch=self.scratch)
             for map in mapset.maps:
                 map.tod2map(tod,dat_filt)
         
@@ -4328,9 +5836,17 @@ def read_tod_from_fits_cbass(fname,dopol=False,lat=37.2314,lon=-118.2941,v34=Tru
     f.close()
     return dat
 
-def read_tod_from_fits(fname,hdu=1,branch=None):
-    f=pyfits.open(fname)
+def read_tod_from_fits(fname,hdu=1,branch=None,dtype='float64',columns=None):
+    """Read a MUSTANG TOD.  Pointing is always kept in double, while dat_calib is stored as dtype, so
+    dtype='float32' halves the memory and bandwidth of the data in the map-making loop.  The table is
+    memory-mapped and each column we want is byte-swapped/converted straight into its [ndet,nsamp] array,
+    so columns we don't want are never read.  columns picks which of 'dx', 'dy', 'elev', 'dat_calib' and
+    'mask' to read (default all of them); pixid and dt are always there."""
+    f=pyfits.open(fname,memmap=True)
     raw=f[hdu].data
+    names=raw.columns.names
+    if columns is None:
+        columns=['dx','dy','elev','dat_calib','mask']
     #print 'sum of cut elements is ',np.sum(raw['UFNU']<9e5)
     try : #read in calinfo (per-scan beam volumes etc) if present
         calinfo={'calinfo':True}
@@ -4341,68 +5857,236 @@ def read_tod_from_fits(fname,hdu=1,branch=None):
         print('WARNING - calinfo information not found in fits file header - to track JytoK etc you may need to reprocess the fits files using mustangidl > revision 932') 
         calinfo['calinfo']=False
 
+    #samples are stored detector by detector, so the first change in PIXID gives us nsamp
     pixid=raw['PIXID']
-    dets=np.unique(pixid)
-    ndet=len(dets)
-    nsamp=len(pixid)/len(dets)
-    if True:
+    nn=len(pixid)
+    nsamp=int(np.argmax(pixid!=pixid[0]))
+    if nsamp==0:
+        nsamp=nn
+    ndet=nn//nsamp
+    dets=pixid[::nsamp]
+    if (ndet*nsamp!=nn) or (len(np.unique(dets))!=ndet):
+        #not laid out the way we expect, so fall back on counting detectors
+        dets=np.unique(pixid)
+        ndet=len(dets)
+        nsamp=nn//ndet
+        dets=pixid[::nsamp]
+    dat={}
+    def read_col(name,mydtype='float64',fac=None):
+        #one pass from the (big-endian) FITS column into a native [ndet,nsamp] array
+        vec=np.empty([ndet,nsamp],dtype=mydtype)
+        np.copyto(vec,np.reshape(raw[name],[ndet,nsamp]),casting='unsafe')
+        if not(fac is None):
+            vec*=fac
+        return vec
+    #float32 is a bit on the edge for pointing, so cast to float64
+    if 'dx' in columns:
+        dat['dx']=read_col('DX')
+        if not(branch is None):
+            bb=branch*np.pi/180.0
+            dat['dx'][dat['dx']>bb]-=2*np.pi
+    if 'dy' in columns:
+        dat['dy']=read_col('DY')
+    if ('dx' in dat) and ('dy' in dat):
         ff=180/np.pi
-        xmin=raw['DX'].min()*ff
-        xmax=raw['DX'].max()*ff
-        ymin=raw['DY'].min()*ff
-        ymax=raw['DY'].max()*ff
-        print('nsamp and ndet are ',ndet,nsamp,len(pixid),' on ',fname, 'with lims ',xmin,xmax,ymin,ymax)
+        print('nsamp and ndet are ',ndet,nsamp,nn,' on ',fname, 'with lims ',dat['dx'].min()*ff,dat['dx'].max()*ff,dat['dy'].min()*ff,dat['dy'].max()*ff)
     else:
-        print('nsamp and ndet are ',ndet,nsamp,len(pixid),' on ',fname)
-    #print raw.names
-    dat={}
-    #this bit of odd gymnastics is because a straightforward reshape doesn't seem to leave the data in
-    #memory-contiguous order, which causes problems down the road
-    #also, float32 is a bit on the edge for pointing, so cast to float64
-    dx=raw['DX']
-    if not(branch is None):
-        bb=branch*np.pi/180.0
-        dx[dx>bb]=dx[dx>bb]-2*np.pi
-    #dat['dx']=np.zeros([ndet,nsamp],dtype=type(dx[0]))
-    ndet=np.int(ndet)
-    nsamp=np.int(nsamp)
-    dat['dx']=np.zeros([ndet,nsamp],dtype='float64')
-    dat['dx'][:]=np.reshape(dx,[ndet,nsamp])[:]
-    dy=raw['DY']
-    #dat['dy']=np.zeros([ndet,nsamp],dtype=type(dy[0]))
-    dat['dy']=np.zeros([ndet,nsamp],dtype='float64')
-    dat['dy'][:]=np.reshape(dy,[ndet,nsamp])[:]
-    if 'ELEV' in raw.names:
-        elev=raw['ELEV']*np.pi/180
-        dat['elev']=np.zeros([ndet,nsamp],dtype='float64')
-        dat['elev'][:]=np.reshape(elev,[ndet,nsamp])[:]
-
-    tt=np.reshape(raw['TIME'],[ndet,nsamp])
-    tt=tt[0,:]
-    dt=np.median(np.diff(tt))
-    dat['dt']=dt
-    pixid=np.reshape(pixid,[ndet,nsamp])
-    pixid=pixid[:,0]
-    dat['pixid']=pixid
-    dat_calib=raw['FNU']
-    #print 'shapes are ',raw['FNU'].shape,raw['UFNU'].shape,np.mean(raw['UFNU']>9e5)
-    #dat_calib[raw['UFNU']>9e5]=0.0
-
-    #dat['dat_calib']=np.zeros([ndet,nsamp],dtype=type(dat_calib[0]))
-    dat['dat_calib']=np.zeros([ndet,nsamp],dtype='float64') #go to double because why not
-    dat_calib=np.reshape(dat_calib,[ndet,nsamp])
-
-    dat['dat_calib'][:]=dat_calib[:]
-    if np.sum(raw['UFNU']>9e5)>0:
-        dat['mask']=np.reshape(raw['UFNU']<9e5,dat['dat_calib'].shape)
-        dat['mask_sum']=np.sum(dat['mask'],axis=0)
+        print('nsamp and ndet are ',ndet,nsamp,nn,' on ',fname)
+    if ('elev' in columns) and ('ELEV' in names):
+        dat['elev']=read_col('ELEV',fac=np.pi/180)
+
+    tt=np.asarray(raw['TIME'][:nsamp],dtype='float64')
+    dat['dt']=np.median(np.diff(tt))
+    dat['pixid']=np.asarray(dets,dtype=dets.dtype.newbyteorder('='))
+    if 'dat_calib' in columns:
+        dat['dat_calib']=read_col('FNU',dtype) #double unless asked for single
+    if 'mask' in columns:
+        mask=np.reshape(raw['UFNU'],[ndet,nsamp])<9e5
+        if not(np.all(mask)):
+            dat['mask']=mask
+            dat['mask_sum']=np.sum(mask,axis=0)
     #print 'cut frac is now ',np.mean(dat_calib==0)
-    #print 'cut frac is now ',np.mean(dat['dat_calib']==0),dat['dat_calib'][0,0]
     dat['fname']=fname
     dat['calinfo']=calinfo
+    del raw
+    f.close()
+    return dat
+
+
+def preprocess_tod(dat,fac=10,cm_poly=True):
+    """The standard cleanup after reading a TOD: truncate to a good FFT length, downsample by fac (skipped if
+    fac is None) and truncate again, then take out detector offsets/drifts with fit_cm_plus_poly (unless
+    cm_poly is False).  dat is modified in place and also returned."""
+    truncate_tod(dat) #truncate_tod chops samples from the end to make the length happy for ffts
+    if not(fac is None):
+        downsample_tod(dat,fac)
+        truncate_tod(dat)
+    if cm_poly:
+        dat['dat_calib']=np.asarray(fit_cm_plus_poly(dat['dat_calib']),dtype=dat['dat_calib'].dtype)
+    return dat
+
+def todvec_from_files(fnames,preprocess=preprocess_tod,preprocess_kwargs={},reader=read_tod_from_fits,reader_kwargs={},nworker=None,nqueue=4,report=True):
+    """Read and preprocess a list of TODs into a TodVec, overlapping the I/O with the processing.  A reader
+    thread reads files in order with reader(fname,**reader_kwargs) and hands them to nworker threads (default
+    all but one of the set_nthread threads) that run preprocess(dat,**preprocess_kwargs), which should modify
+    dat in place or return the new one.  At most nqueue files wait to be processed and nqueue are in
+    processing, so memory stays bounded.  Files that can't be read or preprocessed are skipped with a warning.
+    The TodVec keeps the order of fnames.  If report, print how long each file took to read and process, and
+    the totals at the end.  Under MPI, pass each process its own share of the files."""
+    t0=time.time()
+    nthread=get_nthread()
+    if nworker is None:
+        nworker=nthread-1
+    nworker=int(max(nworker,1))
+    inner=int(max(1,nthread//(nworker+1)))
+    todo=queue.Queue(maxsize=nqueue)
+    stop=threading.Event()
+    read_stats={'nbyte':0,'time':0.0}
+    def put(item):
+        #don't block forever if we've stopped taking things off the queue
+        while not(stop.is_set()):
+            try:
+                todo.put(item,timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    def read_all():
+        for i,fname in enumerate(fnames):
+            if stop.is_set():
+                return
+            t1=time.time()
+            try:
+                dat=reader(fname,**reader_kwargs)
+                read_stats['nbyte']+=os.path.getsize(fname)
+            except Exception as e:
+                print('unable to read ',fname,' in todvec_from_files: ',e)
+                dat=None
+            tread=time.time()-t1
+            read_stats['time']+=tread
+            if not(dat is None):
+                put((i,fname,dat,tread))
+        put(None)
+    def work(i,fname,dat,tread):
+        set_local_nthread(inner)
+        t1=time.time()
+        if not(preprocess is None):
+            try:
+                out=preprocess(dat,**preprocess_kwargs)
+            except Exception as e:
+                print('unable to preprocess ',fname,' in todvec_from_files: ',e)
+                return i,None
+            if not(out is None):
+                dat=out
+        if report:
+            print('took ',tread,' ',time.time()-t1,' seconds to read and process file ',fname)
+        return i,dat
+
+    reader_thread=threading.Thread(target=read_all,daemon=True)
+    reader_thread.start()
+    results={}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nworker) as pool:
+            jobs=set()
+            while True:
+                item=todo.get()
+                if item is None:
+                    break
+                jobs.add(pool.submit(work,*item))
+                if len(jobs)>=nqueue:
+                    done,jobs=concurrent.futures.wait(jobs,return_when=concurrent.futures.FIRST_COMPLETED)
+                    for job in done:
+                        i,dat=job.result()
+                        results[i]=dat
+            for job in jobs:
+                i,dat=job.result()
+                results[i]=dat
+    finally:
+        #if we bailed out early, tell the reader to stop and let go of anything it has queued up
+        stop.set()
+        while True:
+            try:
+                todo.get_nowait()
+            except queue.Empty:
+                break
+        reader_thread.join()
+
+    todvec=TodVec()
+    nfile=0
+    for i in sorted(results.keys()):
+        if not(results[i] is None):
+            todvec.add_tod(Tod(results[i]))
+            nfile=nfile+1
+    if report:
+        dt=time.time()-t0
+        mb=read_stats['nbyte']/1024.0**2
+        print('read and processed ',nfile,' files (',mb,' MB) in ',dt,' seconds: ',nfile/dt,' files/s, ',mb/dt,' MB/s.  Reading alone took ',read_stats['time'],' seconds.')
+    return todvec
+
+def save_tod_cache(dat,dirname):
+    """Write a TOD info dict to dirname as one .npy file per array (so they can be memory-mapped back with
+    their data aligned) plus meta.pkl holding everything else.  The cache is built in a scratch directory and
+    renamed into place, so other processes never see a half-written one."""
+    tmpname=dirname.rstrip('/')+'.'+repr(os.getpid())+'.tmp'
+    os.makedirs(tmpname,exist_ok=True)
+    meta={}
+    arrays=[]
+    for key in dat.keys():
+        if isinstance(dat[key],np.ndarray) and dat[key].dtype!=np.dtype('object'):
+            np.save(os.path.join(tmpname,key+'.npy'),np.ascontiguousarray(dat[key]))
+            arrays.append(key)
+        else:
+            meta[key]=dat[key]
+    f=open(os.path.join(tmpname,'meta.pkl'),'wb')
+    pickle.dump({'meta':meta,'arrays':arrays},f,protocol=pickle.HIGHEST_PROTOCOL)
+    f.close()
+    try:
+        os.rename(tmpname,dirname)
+    except OSError:
+        #someone else got there first, and theirs is just as good
+        for fname in os.listdir(tmpname):
+            os.remove(os.path.join(tmpname,fname))
+        os.rmdir(tmpname)
+
+def load_tod_cache(dirname,mmap_mode='c'):
+    """Read a TOD written by save_tod_cache, or return None if there isn't one.  Arrays are memory-mapped,
+    copy-on-write by default, so nothing is read until it's used, processes on a node share the pages, and
+    changing the arrays doesn't touch the cache."""
+    metaname=os.path.join(dirname,'meta.pkl')
+    if not(os.path.isfile(metaname)):
+        return None
+    f=open(metaname,'rb')
+    state=pickle.load(f)
     f.close()
+    dat=state['meta']
+    for key in state['arrays']:
+        dat[key]=np.load(os.path.join(dirname,key+'.npy'),mmap_mode=mmap_mode)
     return dat
 
+def get_tod_cache_name(fname,cache_dir,**kwargs):
+    #cache entries are keyed by the file (path, size and modification time) and the processing parameters
+    st=os.stat(fname)
+    h=hashlib.sha1()
+    h.update(repr((os.path.abspath(fname),st.st_size,st.st_mtime_ns)).encode())
+    _hash_noise_arg(h,kwargs)
+    return os.path.join(cache_dir,os.path.basename(fname)+'.'+h.hexdigest()[:16])
+
+def read_tod_cached(fname,cache_dir,fac=10,cm_poly=True,dtype='float64',mmap_mode='c'):
+    """The usual read_tod_from_fits/truncate_tod/downsample_tod/truncate_tod/fit_cm_plus_poly chain, with the
+    result cached under cache_dir.  Set fac to None to skip the downsampling and cm_poly to False to skip
+    the common-mode/polynomial cleanup.  A rerun with the same file and parameters memory-maps the cached
+    arrays (see load_tod_cache) instead of redoing the work."""
+    cache_name=get_tod_cache_name(fname,cache_dir,fac=fac,cm_poly=cm_poly,dtype=dtype)
+    dat=load_tod_cache(cache_name,mmap_mode)
+    if not(dat is None):
+        return dat
+    dat=read_tod_from_fits(fname,dtype=dtype)
+    preprocess_tod(dat,fac,cm_poly)
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        save_tod_cache(dat,cache_name)
+    except:
+        print('unable to write TOD cache for ',fname,' in ',cache_dir)
+    return dat
 
 def downsample_array_r2r(arr,fac):
 
@@ -4422,30 +6106,94 @@ def downsample_vec_r2r(vec,fac):
     vec=mkfftw.fft_r2r(vec_ft)/(2*(n-1))
     return vec
 
-def downsample_tod(dat,fac=10):
+def downsample_boxcar(arr,nn):
+    """Downsample the rows of arr to length nn by averaging over boxes centred on the samples a DCT downsample
+    to nn would give you (the end points stay put), which is plenty for slowly varying things like pointing
+    and costs one cumulative sum instead of two transforms."""
+    n=arr.shape[-1]
+    arr2=np.reshape(arr,[-1,n])
+    csum=np.zeros([arr2.shape[0],n+1])
+    np.cumsum(arr2,axis=1,out=csum[:,1:])
+    step=(n-1)/(nn-1)
+    cent=np.arange(nn)*step
+    #boxes near the ends shrink to stay centred so they don't drag the average off the sample time
+    half=np.minimum(np.minimum(step/2,cent+0.5),n-0.5-cent)
+    lo=cent-half
+    hi=cent+half
+    def integ(x):
+        #integral of the samples (as unit-width boxes) from -0.5 up to x
+        xx=x+0.5
+        i=np.minimum(np.asarray(np.floor(xx),dtype='int64'),n-1)
+        frac=xx-i
+        return csum[:,i]+frac*(csum[:,i+1]-csum[:,i])
+    out=(integ(hi)-integ(lo))/(hi-lo)
+    return np.asarray(np.reshape(out,arr.shape[:-1]+(nn,)),dtype=arr.dtype)
+
+def downsample_mask(mask,nn):
+    """Downsample the rows of a good-sample mask (nonzero/True is good) to length nn, keeping a sample only if
+    every sample in its box was good.  Each input sample goes to the nearest output sample, on the same grid
+    as downsample_boxcar."""
+    n=mask.shape[-1]
+    mask2=np.reshape(mask,[-1,n])
+    step=(n-1)/(nn-1)
+    starts=np.searchsorted(np.round(np.arange(n)/step),np.arange(nn))
+    out=np.minimum.reduceat(mask2,starts,axis=1)
+    return np.reshape(out,mask.shape[:-1]+(nn,))
+
+def downsample_tod(dat,fac=10,pointing_method='r2r',pointing_keys=('dx','dy','elev')):
+    """Downsample every floating-point field of dat that runs along the samples (ndet x nsamp or nsamp long) by
+    fac, keeping the first nsamp/fac DCT modes.  The kept modes of all the fields of a given precision are
+    stacked so they share one batch of inverse transforms.  With pointing_method='boxcar' the fields in pointing_keys are box-averaged instead
+    (see downsample_boxcar).  mask is downsampled with downsample_mask and mask_sum recomputed from it, and any
+    other non-float field along the samples just keeps the samples nearest the new ones."""
     ndata=dat['dat_calib'].shape[1]
-    keys=dat.keys()
-    for key in dat.keys():
-        try:
-            if len(dat[key].shape)==1:
-                #print('working on downsampling ' + key)
-                #print('shape is ' + repr(dat[key].shape[0])+'  '+repr(n))
-                if len(dat[key]):
-                    #print('working on downsampling ' + key)
-                    dat[key]=downsample_vec_r2r(dat[key],fac)
-            else:
-                if dat[key].shape[1]==ndata:
-                #print 'downsampling ' + key
-                    dat[key]=downsample_array_r2r(dat[key],fac)
-        except:
-            #print 'not downsampling ' + key
-            pass
-    
+    nn=int(ndata/fac)
+    groups={}
+    for key in list(dat.keys()):
+        val=dat[key]
+        if not(isinstance(val,np.ndarray)) or val.ndim>2 or val.ndim==0 or val.shape[-1]!=ndata:
+            continue
+        if val.dtype.kind!='f':
+            if key=='mask':
+                dat[key]=downsample_mask(val,nn)
+            elif key!='mask_sum':
+                dat[key]=val[...,np.asarray(np.round(np.arange(nn)*(ndata-1)/(nn-1)),dtype='int64')].copy()
+            continue
+        if pointing_method=='boxcar' and key in pointing_keys:
+            dat[key]=downsample_boxcar(val,nn)
+            continue
+        if not(val.dtype.str in groups):
+            groups[val.dtype.str]=[]
+        groups[val.dtype.str].append(key)
+    for dtype in groups.keys():
+        keys=groups[dtype]
+        nrows=[int(np.prod(dat[key].shape[:-1])) for key in keys]
+        #forward transforms share one work array, and only the modes we keep get stacked for the inverse
+        work=np.empty(max(nrows)*ndata,dtype=dtype)
+        ft=np.empty([sum(nrows),nn],dtype=dtype)
+        i0=0
+        for key,nrow in zip(keys,nrows):
+            tmp=mkfftw.fft_r2r(np.reshape(dat[key],[nrow,ndata]),np.reshape(work[:nrow*ndata],[nrow,ndata]))
+            ft[i0:i0+nrow,:]=tmp[:,:nn]
+            i0+=nrow
+        out=mkfftw.fft_r2r(ft)
+        out/=(2*(ndata-1))
+        i0=0
+        for key,nrow in zip(keys,nrows):
+            dat[key]=np.reshape(out[i0:i0+nrow,:],dat[key].shape[:-1]+(nn,))
+            i0+=nrow
+    if 'mask_sum' in dat and 'mask' in dat:
+        dat['mask_sum']=np.sum(dat['mask'],axis=0)
 
-def truncate_tod(dat,primes=[2,3,5,7,11]):
-    n=dat['dat_calib'].shape[1]
-    lens=find_good_fft_lens(n-1,primes)
-    n_new=lens.max()+1
+def truncate_tod(dat,primes=[2,3,5,7,11],benchmark=False,max_loss=0.02):
+    #chop samples off the end so n-1 has only small prime factors.  With benchmark set, time the candidate
+    #lengths keeping at least 1-max_loss of the data on transforms shaped like dat_calib and take the fastest
+    #instead (see find_fastest_dct_len, which only benchmarks from the main thread).
+    ndet,n=dat['dat_calib'].shape
+    if benchmark:
+        n_new=find_fastest_dct_len(n,primes,max_loss,nrow=ndet,dtype=dat['dat_calib'].dtype)
+    else:
+        n_new=get_good_fft_len(n-1,primes)+1
     if n_new<n:
         print('truncating from ',n,' to ',n_new)
         for key in dat.keys():
@@ -4538,6 +6286,14 @@ def get_wcs(lims,pixsize,proj='CAR',cosdec=None,ref_equ=False):
         w.wcs.cdelt=[-pixsize/cosdec*180/np.pi,pixsize*180/np.pi]
         w.wcs.ctype=['RA---CAR','DEC--CAR']
         return w
+    if proj=='TAN':
+        #center the tangent point on the map, leaving room for the widest (closest to the equator) RA edge
+        cosedge=np.max(np.cos(lims[2:4]))
+        w.wcs.crval=[0.5*(lims[0]+lims[1])*180/np.pi,dec*180/np.pi]
+        w.wcs.crpix=[0.5*(lims[1]-lims[0])*cosedge/pixsize+1,0.5*(lims[3]-lims[2])/pixsize+1]
+        w.wcs.cdelt=[-pixsize*180/np.pi,pixsize*180/np.pi]
+        w.wcs.ctype=['RA---TAN','DEC--TAN']
+        return w
     print('unknown projection type ',proj,' in get_wcs.')
     return None
 
@@ -18,28 +18,12 @@ tod_names=tod_names[minkasi.myrank::minkasi.nproc]
 #run in a non-MPI environment
 
 
-todvec=minkasi.TodVec()
-
-#loop over each file, and read it.
-for fname in tod_names:
-    t1=time.time()
-    dat=minkasi.read_tod_from_fits(fname)
-    t2=time.time()
-    minkasi.truncate_tod(dat) #truncate_tod chops samples from the end to make
-                              #the length happy for ffts
-    minkasi.downsample_tod(dat)   #sometimes we have faster sampled data than we need.
-                                  #this fixes that.  You don't need to, though.
-    minkasi.truncate_tod(dat)    #since our length changed, make sure we have a happy length
-
-    #figure out a guess at common mode #and (assumed) linear detector drifts/offset
-    #drifts/offsets are removed, which is important for mode finding.  CM is *not* removed.
-    dd=minkasi.fit_cm_plus_poly(dat['dat_calib'])  
-    
-    dat['dat_calib']=dd
-    t3=time.time()
-    tod=minkasi.Tod(dat)
-    todvec.add_tod(tod)
-    print 'took ',t2-t1,' ',t3-t2,' seconds to read and downsample file ',fname
+#read the files, truncate them to a length happy for ffts, downsample them (sometimes we have faster
+#sampled data than we need - you don't need to, though) and truncate again, then take out a guess at
+#the common mode and (assumed) linear detector drifts/offsets, which is important for mode finding.
+#CM is *not* removed.  Reading happens on its own thread while earlier files are being processed, and
+#it prints how long each file took.
+todvec=minkasi.todvec_from_files(tod_names)
 
 #make a template map with desired pixel size an limits that cover the data
 #todvec.lims() is MPI-aware and will return global limits, not just
@@ -1,6 +1,10 @@
 #include <stdio.h>
 #include <complex.h>
 #include <math.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <pthread.h>
 #include <fftw3.h>
 #include <omp.h>
 
@@ -13,6 +17,187 @@
 //gcc -I{HIPPO_FFTW_DIR}/include -fopenmp -std=c99 -O3 -shared -fPIC -o libmkfftw.so mkfftw.c -L${HIPPO_FFTW_DIR}/lib    -lfftw3f_threads -lfftw3f -lfftw3_threads -lfftw3  -lm -lgomp
 //gcc -fopenmp -std=c99 -O3 -shared -fPIC -o libmkfftw.so mkfftw.c -lfftw3f_threads -lfftw3f -lfftw3_threads -lfftw3 -lgomp -lpthread
 
+/*--------------------------------------------------------------------------------*/
+//Plans are cached for the life of the process, keyed on everything that makes a plan valid for
+//new-array execution: the transform, precision, sizes, batch layout, r2r kind, in-/out-of-place,
+//the SIMD alignment of the arrays, the thread count, and the planner flag.  Repeat transforms
+//(the same TOD lengths every PCG iteration) then never re-plan, so it becomes affordable to plan with
+//FFTW_MEASURE or FFTW_PATIENT.  Those planners scribble on their arrays, so they are
+//run on scratch buffers with the same alignment as the real ones.
+
+#define MKFFTW_MAXPLAN 1024
+#define MKFFTW_MAXDIM 8
+#define MKFFTW_KEYLEN (12+MKFFTW_MAXDIM)
+
+enum {MKFFTW_R2C=1,MKFFTW_C2R,MKFFTW_R2R,MKFFTW_R2C_N,MKFFTW_C2R_N};
+
+//Threading: mkfftw_nthread (set_threaded) is the process-wide count, and a thread can override it for its own
+//calls with set_local_nthread (0 goes back to the process-wide count).  mkfftw_nthread is 0 until set_threaded
+//is called, which transforms treat as one thread (batched r2r as however many threads OpenMP has).  Multi-dimensional and complex transforms
+//use that many FFTW threads.  Batched r2r transforms split their rows into one block per thread when there are
+//enough rows, and otherwise hand FFTW the threads.  Small batches get fewer threads, so short TODs don't pay
+//for waking up the whole pool.
+#define MKFFTW_MIN_PER_THREAD 16384
+
+static unsigned mkfftw_flag=MKFFTW_FLAG;
+static int mkfftw_nthread=0;
+static __thread int mkfftw_local_nthread=0;
+static int mkfftw_threads_ready=0;
+static int mkfftw_nplan=0;
+static int mkfftw_keys[MKFFTW_MAXPLAN][MKFFTW_KEYLEN];
+static void *mkfftw_plans[MKFFTW_MAXPLAN];
+static int mkfftw_is_single[MKFFTW_MAXPLAN];
+static pthread_mutex_t mkfftw_lock=PTHREAD_MUTEX_INITIALIZER;
+
+int get_call_nthread()
+{
+  if (mkfftw_local_nthread>0)
+    return mkfftw_local_nthread;
+  if (mkfftw_nthread>0)
+    return mkfftw_nthread;
+  return 1;
+}
+
+void set_local_nthread(int nthread)
+{
+  mkfftw_local_nthread=nthread;
+}
+
+int get_local_nthread()
+{
+  return mkfftw_local_nthread;
+}
+
+//tell the planner how many threads the next plan gets.  Call with mkfftw_lock held.
+static void plan_threads(int nthread)
+{
+  if (!mkfftw_threads_ready) {
+    if (nthread<=1)
+      return;
+    fftw_init_threads();
+    fftwf_init_threads();
+    mkfftw_threads_ready=1;
+  }
+  fftw_plan_with_nthreads(nthread);
+  fftwf_plan_with_nthreads(nthread);
+}
+
+static void make_key(int *key, int op, int single, int ndim, const int *dims, int howmany, int rlen, int clen, int kind, void *in, void *out)
+{
+  memset(key,0,sizeof(int)*MKFFTW_KEYLEN);
+  key[0]=op;
+  key[1]=single;
+  key[2]=ndim;
+  key[3]=howmany;
+  key[4]=rlen;
+  key[5]=clen;
+  key[6]=kind;
+  key[7]=(in==out);
+  if (single) {
+    key[8]=fftwf_alignment_of((float *)in);
+    key[9]=fftwf_alignment_of((float *)out);
+  }
+  else {
+    key[8]=fftw_alignment_of((double *)in);
+    key[9]=fftw_alignment_of((double *)out);
+  }
+  key[10]=get_call_nthread();
+  key[11]=(int)mkfftw_flag;
+  for (int i=0;(i<ndim)&&(i<MKFFTW_MAXDIM);i++)
+    key[12+i]=dims[i];
+}
+
+//look up a plan, returning its slot or -1.  Call with mkfftw_lock held.
+static int find_plan(int *key)
+{
+  for (int i=0;i<mkfftw_nplan;i++)
+    if (memcmp(key,mkfftw_keys[i],sizeof(int)*MKFFTW_KEYLEN)==0)
+      return i;
+  return -1;
+}
+
+//store a plan, returning its slot, or -1 if the cache is full (the caller then destroys the plan after use)
+static int add_plan(int *key, void *plan, int single)
+{
+  if (mkfftw_nplan>=MKFFTW_MAXPLAN)
+    return -1;
+  memcpy(mkfftw_keys[mkfftw_nplan],key,sizeof(int)*MKFFTW_KEYLEN);
+  mkfftw_plans[mkfftw_nplan]=plan;
+  mkfftw_is_single[mkfftw_nplan]=single;
+  mkfftw_nplan++;
+  return mkfftw_nplan-1;
+}
+
+//scratch array of nbytes, with the same offset from 64-byte alignment as like, for the planner to
+//work on.  If we're only estimating, the planner doesn't touch its arrays, so we just hand back like.
+static void *plan_buffer(void **base, size_t nbytes, void *like)
+{
+  *base=NULL;
+  if (mkfftw_flag&FFTW_ESTIMATE)
+    return like;
+  *base=malloc(nbytes+128);
+  uintptr_t ptr=((uintptr_t)(*base)+63)&(~(uintptr_t)63);
+  return (void *)(ptr+((uintptr_t)like&63));
+}
+
+//bytes the planner's input buffer needs: nin, or for in-place transforms enough for the output layout too
+//(an in-place r2c writes nft complex numbers, 2*(n/2+1) doubles per row, over the n input doubles)
+static size_t plan_nbytes(size_t nin, size_t nout, int inplace)
+{
+  return (inplace && (nout>nin)) ? nout : nin;
+}
+
+//elements spanned by howmany rows of n elements, stride apart within a row and dist apart between rows.
+//Either can be negative, so *lo gets the offset of the lowest element from the first one.
+static size_t layout_extent(int n, int howmany, int stride, int dist, long *lo)
+{
+  long a=(long)(n-1)*stride;
+  long b=(long)(howmany-1)*dist;
+  long mn=(a<0 ? a : 0)+(b<0 ? b : 0);
+  long mx=(a>0 ? a : 0)+(b>0 ? b : 0);
+  *lo=mn;
+  return mx-mn+1;
+}
+
+void fft_r2c_n(double *dat, fftw_complex *datft,int ndim,int *dims);
+void fft_c2r_n(fftw_complex *datft,double *dat, int ndim,int *dims);
+
+/*--------------------------------------------------------------------------------*/
+void set_plan_flag(int level)
+//pick the planner used for plans made from now on: 0 for FFTW_ESTIMATE, 1 for FFTW_MEASURE, 2 for FFTW_PATIENT
+{
+  pthread_mutex_lock(&mkfftw_lock);
+  switch(level) {
+  case 1:
+    mkfftw_flag=FFTW_MEASURE;
+    break;
+  case 2:
+    mkfftw_flag=FFTW_PATIENT;
+    break;
+  default:
+    mkfftw_flag=FFTW_ESTIMATE;
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+}
+/*--------------------------------------------------------------------------------*/
+int get_nplan()
+{
+  return mkfftw_nplan;
+}
+/*--------------------------------------------------------------------------------*/
+void clear_plan_cache()
+{
+  pthread_mutex_lock(&mkfftw_lock);
+  for (int i=0;i<mkfftw_nplan;i++)
+    if (mkfftw_is_single[i])
+      fftwf_destroy_plan((fftwf_plan)mkfftw_plans[i]);
+    else
+      fftw_destroy_plan((fftw_plan)mkfftw_plans[i]);
+  mkfftw_nplan=0;
+  pthread_mutex_unlock(&mkfftw_lock);
+}
+
+/*--------------------------------------------------------------------------------*/
 void set_threaded(int nthread)
 {
   //int nthread;
@@ -22,52 +207,89 @@ void set_threaded(int nthread)
     nthread=omp_get_num_threads();
   }
   
-  printf("Setting FFTW to have %d threads.\n",nthread);
-  fftwf_plan_with_nthreads(nthread);
-  fftw_plan_with_nthreads(nthread);
+  pthread_mutex_lock(&mkfftw_lock);
+  plan_threads(nthread);
+  mkfftw_nthread=nthread;
+  pthread_mutex_unlock(&mkfftw_lock);
 
 }
 
 /*--------------------------------------------------------------------------------*/
 void fft_r2c_n(double *dat, fftw_complex *datft,int ndim,int *dims)
 {
-  fftw_plan plan=fftw_plan_dft_r2c(ndim,dims,dat,datft,MKFFTW_FLAG);
-  fftw_execute(plan);
+  long n=1;
+  for (int i=0;i<ndim-1;i++)
+    n*=dims[i];
+  long nft=n*(dims[ndim-1]/2+1);
+  n*=dims[ndim-1];
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_R2C_N,0,ndim,dims,1,0,0,0,dat,datft);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=(ndim<=MKFFTW_MAXDIM) ? find_plan(key) : -1;
+  fftw_plan plan;
+  if (ind>=0)
+    plan=(fftw_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    double *in=(double *)plan_buffer(&b1,plan_nbytes(sizeof(double)*n,sizeof(fftw_complex)*nft,(void *)dat==(void *)datft),dat);
+    fftw_complex *out=((void *)dat==(void *)datft) ? (fftw_complex *)in : (fftw_complex *)plan_buffer(&b2,sizeof(fftw_complex)*nft,datft);
+    plan=fftw_plan_dft_r2c(ndim,dims,in,out,mkfftw_flag);
+    free(b1);
+    free(b2);
+    if (ndim<=MKFFTW_MAXDIM)
+      ind=add_plan(key,plan,0);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftw_execute_dft_r2c(plan,dat,datft);
   //printf("first element is %12.5g\n",datft[0]);
-  fftw_destroy_plan(plan);
+  if (ind<0)
+    fftw_destroy_plan(plan);
 }
 /*--------------------------------------------------------------------------------*/
 void fft_r2c_3d(double *dat, fftw_complex *datft,long int *dims)
 {
   //printf("shapes are %d %d %d\n",dims[0],dims[1],dims[2]);
-  fftw_plan plan=fftw_plan_dft_r2c_3d(dims[0],dims[1],dims[2],dat,datft,MKFFTW_FLAG);
-  fftw_execute(plan);
-  //printf("first element is %12.5g\n",datft[0]);
-  fftw_destroy_plan(plan);
+  //same transform as fft_r2c_n, so go through there to share its plan cache
+  int mydims[3]={dims[0],dims[1],dims[2]};
+  fft_r2c_n(dat,datft,3,mydims);
 }
 /*--------------------------------------------------------------------------------*/
 void fft_c2r_3d(fftw_complex *datft,double *dat, long int *dims)
 {
-
-  fftw_plan plan=fftw_plan_dft_c2r_3d(dims[0],dims[1],dims[2],datft,dat,MKFFTW_FLAG);
-  fftw_execute(plan);
-  fftw_destroy_plan(plan);
-  //apply the normalization so the inverse of the forward gives you what you started with
-  long int n=dims[0]*dims[1]*dims[2];
-  double nn=n;
-  nn=1.0/n;
-#pragma omp parallel for
-  for (long int i=0;i<n;i++)
-    dat[i]*=nn;
-  
+  //fft_c2r_n applies the same normalization, so the inverse of the forward gives you what you started with
+  int mydims[3]={dims[0],dims[1],dims[2]};
+  fft_c2r_n(datft,dat,3,mydims);
 }
 /*--------------------------------------------------------------------------------*/
 void fft_c2r_n(fftw_complex *datft,double *dat, int ndim,int *dims)
 {
-
-  fftw_plan plan=fftw_plan_dft_c2r(ndim,dims,datft,dat,MKFFTW_FLAG);
-  fftw_execute(plan);
-  fftw_destroy_plan(plan);
+  long nft=1;
+  for (int i=0;i<ndim-1;i++)
+    nft*=dims[i];
+  nft*=(dims[ndim-1]/2+1);
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_C2R_N,0,ndim,dims,1,0,0,0,datft,dat);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=(ndim<=MKFFTW_MAXDIM) ? find_plan(key) : -1;
+  fftw_plan plan;
+  if (ind>=0)
+    plan=(fftw_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    fftw_complex *in=(fftw_complex *)plan_buffer(&b1,sizeof(fftw_complex)*nft,datft);
+    double *out=((void *)dat==(void *)datft) ? (double *)in : (double *)plan_buffer(&b2,sizeof(fftw_complex)*nft,dat);
+    plan=fftw_plan_dft_c2r(ndim,dims,in,out,mkfftw_flag);
+    free(b1);
+    free(b2);
+    if (ndim<=MKFFTW_MAXDIM)
+      ind=add_plan(key,plan,0);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftw_execute_dft_c2r(plan,datft,dat);
+  if (ind<0)
+    fftw_destroy_plan(plan);
   //apply the normalization so the inverse of the forward gives you what you started with
   long int n=1;
   for (int i=0;i<ndim;i++)
@@ -84,26 +306,80 @@ void fft_c2r_n(fftw_complex *datft,double *dat, int ndim,int *dims)
 
 void many_fft_r2c_1d(double *dat, fftw_complex *datft, int ntrans, int ndata, int rlen, int clen)
 {  
-  fftw_plan plan=fftw_plan_many_dft_r2c(1,&ndata,ntrans,dat,&ndata,1,rlen,datft,&ndata,1,clen,MKFFTW_FLAG);
-  fftw_execute(plan);
-  fftw_destroy_plan(plan);
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_R2C,0,1,&ndata,ntrans,rlen,clen,0,dat,datft);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=find_plan(key);
+  fftw_plan plan;
+  if (ind>=0)
+    plan=(fftw_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    double *in=(double *)plan_buffer(&b1,plan_nbytes(sizeof(double)*rlen*ntrans,sizeof(fftw_complex)*clen*ntrans,(void *)dat==(void *)datft),dat);
+    fftw_complex *out=((void *)dat==(void *)datft) ? (fftw_complex *)in : (fftw_complex *)plan_buffer(&b2,sizeof(fftw_complex)*clen*ntrans,datft);
+    plan=fftw_plan_many_dft_r2c(1,&ndata,ntrans,in,&ndata,1,rlen,out,&ndata,1,clen,mkfftw_flag);
+    free(b1);
+    free(b2);
+    ind=add_plan(key,plan,0);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftw_execute_dft_r2c(plan,dat,datft);
+  if (ind<0)
+    fftw_destroy_plan(plan);
 }
 /*--------------------------------------------------------------------------------*/
 
 void many_fftf_r2c_1d(float *dat, fftwf_complex *datft, int ntrans, int ndata, int rlen, int clen)
 {  
-  fftwf_plan plan=fftwf_plan_many_dft_r2c(1,&ndata,ntrans,dat,&ndata,1,rlen,datft,&ndata,1,clen,MKFFTW_FLAG);
-  fftwf_execute(plan);
-  fftwf_destroy_plan(plan);
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_R2C,1,1,&ndata,ntrans,rlen,clen,0,dat,datft);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=find_plan(key);
+  fftwf_plan plan;
+  if (ind>=0)
+    plan=(fftwf_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    float *in=(float *)plan_buffer(&b1,plan_nbytes(sizeof(float)*rlen*ntrans,sizeof(fftwf_complex)*clen*ntrans,(void *)dat==(void *)datft),dat);
+    fftwf_complex *out=((void *)dat==(void *)datft) ? (fftwf_complex *)in : (fftwf_complex *)plan_buffer(&b2,sizeof(fftwf_complex)*clen*ntrans,datft);
+    plan=fftwf_plan_many_dft_r2c(1,&ndata,ntrans,in,&ndata,1,rlen,out,&ndata,1,clen,mkfftw_flag);
+    free(b1);
+    free(b2);
+    ind=add_plan(key,plan,1);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftwf_execute_dft_r2c(plan,dat,datft);
+  if (ind<0)
+    fftwf_destroy_plan(plan);
 }
 
 /*--------------------------------------------------------------------------------*/
 
 void many_fft_c2r_1d(fftw_complex *datft, double *dat,int ntrans, int ndata, int rlen, int clen)
 {  
-  fftw_plan plan=fftw_plan_many_dft_c2r(1,&ndata,ntrans,datft,&ndata,1,rlen,dat,&ndata,1,clen,MKFFTW_FLAG);
-  fftw_execute(plan);
-  fftw_destroy_plan(plan);
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_C2R,0,1,&ndata,ntrans,rlen,clen,0,datft,dat);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=find_plan(key);
+  fftw_plan plan;
+  if (ind>=0)
+    plan=(fftw_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    fftw_complex *in=(fftw_complex *)plan_buffer(&b1,plan_nbytes(sizeof(fftw_complex)*rlen*ntrans,sizeof(double)*clen*ntrans,(void *)datft==(void *)dat),datft);
+    double *out=((void *)datft==(void *)dat) ? (double *)in : (double *)plan_buffer(&b2,sizeof(double)*clen*ntrans,dat);
+    plan=fftw_plan_many_dft_c2r(1,&ndata,ntrans,in,&ndata,1,rlen,out,&ndata,1,clen,mkfftw_flag);
+    free(b1);
+    free(b2);
+    ind=add_plan(key,plan,0);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftw_execute_dft_c2r(plan,datft,dat);
+  if (ind<0)
+    fftw_destroy_plan(plan);
 }
 
 
@@ -111,142 +387,186 @@ void many_fft_c2r_1d(fftw_complex *datft, double *dat,int ntrans, int ndata, int
 
 void many_fftf_c2r_1d(fftwf_complex *datft, float *dat,int ntrans, int ndata, int rlen, int clen)
 {  
-  fftwf_plan plan=fftwf_plan_many_dft_c2r(1,&ndata,ntrans,datft,&ndata,1,rlen,dat,&ndata,1,clen,MKFFTW_FLAG);
-  fftwf_execute(plan);
-  fftwf_destroy_plan(plan);
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_C2R,1,1,&ndata,ntrans,rlen,clen,0,datft,dat);
+  pthread_mutex_lock(&mkfftw_lock);
+  int ind=find_plan(key);
+  fftwf_plan plan;
+  if (ind>=0)
+    plan=(fftwf_plan)mkfftw_plans[ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    fftwf_complex *in=(fftwf_complex *)plan_buffer(&b1,plan_nbytes(sizeof(fftwf_complex)*rlen*ntrans,sizeof(float)*clen*ntrans,(void *)datft==(void *)dat),datft);
+    float *out=((void *)datft==(void *)dat) ? (float *)in : (float *)plan_buffer(&b2,sizeof(float)*clen*ntrans,dat);
+    plan=fftwf_plan_many_dft_c2r(1,&ndata,ntrans,in,&ndata,1,rlen,out,&ndata,1,clen,mkfftw_flag);
+    free(b1);
+    free(b2);
+    ind=add_plan(key,plan,1);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  fftwf_execute_dft_c2r(plan,datft,dat);
+  if (ind<0)
+    fftwf_destroy_plan(plan);
 }
 
 /*--------------------------------------------------------------------------------*/
-void fft_r2r_1d(double *dat, double *trans, int n, int type)
+static fftw_r2r_kind get_r2r_kind(int type)
+//map our transform numbering (1-4 for DCT-I to DCT-IV, 11-14 for DST-I to DST-IV) onto FFTW's kinds
 {
-  fftw_r2r_kind flag=FFTW_REDFT00;
   switch (type) {
-  case 1:
-    flag=FFTW_REDFT00;
-    break;
   case 2:
-    flag=FFTW_REDFT10;
-    break;
+    return FFTW_REDFT10;
   case 3:
-    flag=FFTW_REDFT01;
-    break;
+    return FFTW_REDFT01;
   case 4:
-    flag=FFTW_REDFT11;
-    break;
-
+    return FFTW_REDFT11;
   case 11:
-    flag=FFTW_RODFT00;
-    break;
+    return FFTW_RODFT00;
   case 12:
-    flag=FFTW_RODFT10;
-    break;
+    return FFTW_RODFT10;
   case 13:
-    flag=FFTW_RODFT01;
-    break;
+    return FFTW_RODFT01;
   case 14:
-    flag=FFTW_RODFT11;
-    break;
-    
+    return FFTW_RODFT11;
   }
-  //for (int i=0;i<5;i++)
-  //printf("dat %d is %14.7e\n",i,dat[i]);
-
-  fftw_plan plan=fftw_plan_r2r_1d(n,dat,trans,flag,FFTW_ESTIMATE);
-  fftw_execute(plan);
-  fftw_destroy_plan(plan);
-  //for (int i=0;i<5;i++)
-  //printf("trans %d is %g\n",i,trans[i]);
-
+  return FFTW_REDFT00;
+}
 
+/*--------------------------------------------------------------------------------*/
+static void *get_r2r_plan(void *dat, void *trans, int n, fftw_r2r_kind kind, int howmany, int istride, int idist, int ostride, int odist, int single, int unaligned, int nthread, int *ind)
+//a batch of howmany length-n r2r transforms through the advanced interface.  Set unaligned if the plan will be
+//executed on arrays that don't keep the alignment of dat/trans.  The plan gets nthread FFTW threads.
+{
+  size_t elsize=single ? sizeof(float) : sizeof(double);
+  int layout[5]={n,istride,ostride,idist,odist};
+  int key[MKFFTW_KEYLEN];
+  make_key(key,MKFFTW_R2R,single,5,layout,howmany,0,0,kind,dat,trans);
+  key[10]=nthread;
+  if (unaligned) {
+    key[8]=-1;
+    key[9]=-1;
+  }
+  unsigned flag=mkfftw_flag | (unaligned ? FFTW_UNALIGNED : 0);
+  void *plan;
+  pthread_mutex_lock(&mkfftw_lock);
+  *ind=find_plan(key);
+  if (*ind>=0)
+    plan=mkfftw_plans[*ind];
+  else {
+    void *b1,*b2=NULL;
+    plan_threads(key[10]);
+    //the buffers have to cover whatever the layout touches, which starts below the first element if a stride is negative
+    long ilo,olo;
+    size_t iext=layout_extent(n,howmany,istride,idist,&ilo);
+    size_t oext=layout_extent(n,howmany,ostride,odist,&olo);
+    if ((dat==trans)&&(oext>iext)) {
+      iext=oext;
+      ilo=olo;
+    }
+    void *in=(char *)plan_buffer(&b1,elsize*iext,(char *)dat+ilo*(long)elsize)-ilo*(long)elsize;
+    void *out=(dat==trans) ? in : (char *)plan_buffer(&b2,elsize*oext,(char *)trans+olo*(long)elsize)-olo*(long)elsize;
+    if (single)
+      plan=(void *)fftwf_plan_many_r2r(1,&n,howmany,(float *)in,NULL,istride,idist,(float *)out,NULL,ostride,odist,&kind,flag);
+    else
+      plan=(void *)fftw_plan_many_r2r(1,&n,howmany,(double *)in,NULL,istride,idist,(double *)out,NULL,ostride,odist,&kind,flag);
+    free(b1);
+    free(b2);
+    *ind=add_plan(key,plan,single);
+  }
+  pthread_mutex_unlock(&mkfftw_lock);
+  return plan;
 }
 
-//fftw_plan fftw_plan_r2r_1d(int n, double *in, double *out,
-//                           fftw_r2r_kind kind, unsigned flags);
+/*--------------------------------------------------------------------------------*/
+static void many_r2r(void *dat, void *trans, int n, int type, int ntrans, int istride, int idist, int ostride, int odist, int single)
+//ntrans r2r transforms, row i starting at dat+i*idist with elements istride apart (likewise for trans).  FFTW gets
+//whole blocks of rows, so it can vectorize across transforms.  With at least as many rows as threads, the rows are
+//split into one block per OpenMP thread, otherwise FFTW gets the threads.  If no thread count has been set
+//(set_threaded/set_local_nthread), we use however many threads OpenMP has.
+{
+  if (ntrans<=0)
+    return;
+  fftw_r2r_kind kind=get_r2r_kind(type);
+  size_t elsize=single ? sizeof(float) : sizeof(double);
+  int nthread=get_call_nthread();
+  if ((mkfftw_nthread<=0)&&(mkfftw_local_nthread<=0))
+    nthread=omp_get_max_threads();
+  long maxthread=((long)n*ntrans)/MKFFTW_MIN_PER_THREAD;
+  if (nthread>maxthread)
+    nthread=(maxthread>1) ? maxthread : 1;
+  int nblock=nthread;
+  int fftw_nthread=1;
+  if (nblock>ntrans) {
+    nblock=1;
+    fftw_nthread=nthread;
+  }
+  int nper=(ntrans+nblock-1)/nblock;
+  nblock=(ntrans+nper-1)/nper;
+  int nlast=ntrans-(nblock-1)*nper;
+  int unaligned=(nblock>1) && (((nper*(long)idist*elsize)%64!=0) || ((nper*(long)odist*elsize)%64!=0));
+  int ind,ind_last;
+  void *plan=get_r2r_plan(dat,trans,n,kind,nper,istride,idist,ostride,odist,single,unaligned,fftw_nthread,&ind);
+  void *plan_last=plan;
+  ind_last=ind;
+  if (nlast!=nper) {
+    char *dat_last=(char *)dat+(nblock-1)*nper*(long)idist*elsize;
+    char *trans_last=(char *)trans+(nblock-1)*nper*(long)odist*elsize;
+    plan_last=get_r2r_plan(dat_last,trans_last,n,kind,nlast,istride,idist,ostride,odist,single,0,fftw_nthread,&ind_last);
+  }
+#pragma omp parallel for if(nblock>1) num_threads(nblock)
+  for (int i=0;i<nblock;i++) {
+    void *myplan=(i==nblock-1) ? plan_last : plan;
+    char *mydat=(char *)dat+i*nper*(long)idist*elsize;
+    char *mytrans=(char *)trans+i*nper*(long)odist*elsize;
+    if (single)
+      fftwf_execute_r2r((fftwf_plan)myplan,(float *)mydat,(float *)mytrans);
+    else
+      fftw_execute_r2r((fftw_plan)myplan,(double *)mydat,(double *)mytrans);
+  }
+  if (single) {
+    if (ind<0)
+      fftwf_destroy_plan((fftwf_plan)plan);
+    if ((ind_last<0)&&(plan_last!=plan))
+      fftwf_destroy_plan((fftwf_plan)plan_last);
+  }
+  else {
+    if (ind<0)
+      fftw_destroy_plan((fftw_plan)plan);
+    if ((ind_last<0)&&(plan_last!=plan))
+      fftw_destroy_plan((fftw_plan)plan_last);
+  }
+}
 
+/*--------------------------------------------------------------------------------*/
+void fft_r2r_1d(double *dat, double *trans, int n, int type)
+{
+  many_r2r(dat,trans,n,type,1,1,n,1,n,0);
+}
 
 /*--------------------------------------------------------------------------------*/
 void many_fft_r2r_1d(double *dat, double *trans, int n, int type, int ntrans)
 {
-  fftw_r2r_kind flag=FFTW_REDFT00;
-  switch (type) {
-  case 1:
-    flag=FFTW_REDFT00;
-    break;
-  case 2:
-    flag=FFTW_REDFT10;
-    break;
-  case 3:
-    flag=FFTW_REDFT01;
-    break;
-  case 4:
-    flag=FFTW_REDFT11;
-    break;
-
-  case 11:
-    flag=FFTW_RODFT00;
-    break;
-  case 12:
-    flag=FFTW_RODFT10;
-    break;
-  case 13:
-    flag=FFTW_RODFT01;
-    break;
-  case 14:
-    flag=FFTW_RODFT11;
-    break;
-    
-  }
-  flag=FFTW_REDFT00;
-  fftw_plan plan=fftw_plan_r2r_1d(n,dat,trans,flag,FFTW_ESTIMATE);
-#pragma omp parallel for
-  for (int i=0;i<ntrans;i++)
-    fftw_execute_r2r(plan,dat+i*n,trans+i*n);
-  fftw_destroy_plan(plan);
-
+  many_r2r(dat,trans,n,type,ntrans,1,n,1,n,0);
 }
 
 /*--------------------------------------------------------------------------------*/
 void many_fftf_r2r_1d(float *dat, float *trans, int n, int type, int ntrans)
 {
-  fftw_r2r_kind flag=FFTW_REDFT00;
-  switch (type) {
-  case 1:
-    flag=FFTW_REDFT00;
-    break;
-  case 2:
-    flag=FFTW_REDFT10;
-    break;
-  case 3:
-    flag=FFTW_REDFT01;
-    break;
-  case 4:
-    flag=FFTW_REDFT11;
-    break;
-
-  case 11:
-    flag=FFTW_RODFT00;
-    break;
-  case 12:
-    flag=FFTW_RODFT10;
-    break;
-  case 13:
-    flag=FFTW_RODFT01;
-    break;
-  case 14:
-    flag=FFTW_RODFT11;
-    break;
-    
-  }
-  flag=FFTW_REDFT00;
-  fftwf_plan plan=fftwf_plan_r2r_1d(n,dat,trans,flag,FFTW_ESTIMATE);
-  //printf("first two elements are %12.4g %12.4g\n",dat[0],dat[1]);
-#pragma omp parallel for
-  for (int i=0;i<ntrans;i++)
-    fftwf_execute_r2r(plan,dat+i*n,trans+i*n);
-  fftwf_destroy_plan(plan);
+  many_r2r(dat,trans,n,type,ntrans,1,n,1,n,1);
+}
 
+/*--------------------------------------------------------------------------------*/
+void many_fft_r2r(double *dat, double *trans, int n, int type, int ntrans, int istride, int idist, int ostride, int odist)
+{
+  many_r2r(dat,trans,n,type,ntrans,istride,idist,ostride,odist,0);
 }
 
+/*--------------------------------------------------------------------------------*/
+void many_fftf_r2r(float *dat, float *trans, int n, int type, int ntrans, int istride, int idist, int ostride, int odist)
+{
+  many_r2r(dat,trans,n,type,ntrans,istride,idist,ostride,odist,1);
+}
 
 /*--------------------------------------------------------------------------------*/
 void read_wisdom(char *double_file, char *single_file)
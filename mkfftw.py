@@ -1,6 +1,8 @@
 import numpy 
 import ctypes
 import time
+import os
+import atexit
 
 mylib=ctypes.cdll.LoadLibrary("libmkfftw.so")
 
@@ -27,6 +29,12 @@ many_fft_r2r_1d_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.
 many_fftf_r2r_1d_c=mylib.many_fftf_r2r_1d
 many_fftf_r2r_1d_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int]
 
+many_fft_r2r_c=mylib.many_fft_r2r
+many_fft_r2r_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int]
+
+many_fftf_r2r_c=mylib.many_fftf_r2r
+many_fftf_r2r_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int,ctypes.c_int]
+
 fft_r2c_n_c=mylib.fft_r2c_n
 fft_r2c_n_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p]
 
@@ -46,6 +54,27 @@ fft_c2r_3d_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p,ctypes.c_void_p]
 set_threaded_c=mylib.set_threaded
 set_threaded_c.argtypes=[ctypes.c_int]
 
+set_local_nthread_c=mylib.set_local_nthread
+set_local_nthread_c.argtypes=[ctypes.c_int]
+
+get_local_nthread_c=mylib.get_local_nthread
+get_local_nthread_c.argtypes=[]
+get_local_nthread_c.restype=ctypes.c_int
+
+get_call_nthread_c=mylib.get_call_nthread
+get_call_nthread_c.argtypes=[]
+get_call_nthread_c.restype=ctypes.c_int
+
+set_plan_flag_c=mylib.set_plan_flag
+set_plan_flag_c.argtypes=[ctypes.c_int]
+
+get_nplan_c=mylib.get_nplan
+get_nplan_c.argtypes=[]
+get_nplan_c.restype=ctypes.c_int
+
+clear_plan_cache_c=mylib.clear_plan_cache
+clear_plan_cache_c.argtypes=[]
+
 read_wisdom_c=mylib.read_wisdom
 read_wisdom_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p]
 
@@ -54,18 +83,74 @@ write_wisdom_c.argtypes=[ctypes.c_void_p,ctypes.c_void_p]
 
 
 def set_threaded(n=-1):
+    """Set the process-wide FFTW thread count (all the OpenMP threads if n<0)."""
     set_threaded_c(n)
 
-def rfftn(dat):
+def set_local_nthread(n=0):
+    """Thread count for transforms called from the current thread only, e.g. a worker in a thread pool.
+    0 goes back to the set_threaded count."""
+    set_local_nthread_c(n)
+
+def get_nthread():
+    """Thread count transforms from the current thread will plan with."""
+    return get_call_nthread_c()
+
+def _push_nthread(nthread):
+    #per-call thread counts: set a thread-local count, handing back the old one for _pop_nthread
+    if nthread is None:
+        return None
+    old=get_local_nthread_c()
+    set_local_nthread_c(nthread)
+    return old
+
+def _pop_nthread(old):
+    if not(old is None):
+        set_local_nthread_c(old)
+
+_plan_levels={'estimate':0,'measure':1,'patient':2}
+_wisdom_files=None
+
+def set_plan_level(level='measure',wisdom=True,double_file='.fftw_wisdom',single_file='.fftwf_wisdom'):
+    """Plan new transforms with FFTW_ESTIMATE, FFTW_MEASURE or FFTW_PATIENT.  Plans are cached in the library for the
+    life of the process, so the slower planners only cost us once per transform shape.  With wisdom set, any saved
+    wisdom is read now and the accumulated wisdom is written back at exit, so later runs skip the planning too."""
+    global _wisdom_files
+    set_plan_flag_c(_plan_levels[level])
+    if wisdom and level!='estimate':
+        if os.path.isfile(double_file) or os.path.isfile(single_file):
+            read_wisdom(double_file,single_file)
+        if _wisdom_files is None:
+            atexit.register(_save_wisdom)
+        _wisdom_files=(double_file,single_file)
+
+def _save_wisdom():
+    #every MPI process may get here, so write under a private name and rename into place
+    double_file,single_file=_wisdom_files
+    tag='.'+repr(os.getpid())
+    write_wisdom(double_file+tag,single_file+tag)
+    for fname in [double_file,single_file]:
+        if os.path.isfile(fname+tag):
+            os.replace(fname+tag,fname)
+
+def get_nplan():
+    """Number of plans currently cached."""
+    return get_nplan_c()
+
+def clear_plan_cache():
+    clear_plan_cache_c()
+
+def rfftn(dat,nthread=None):
     myshape=dat.shape
     myshape=numpy.asarray(myshape,dtype='int32')
     myshape2=myshape.copy()
     myshape2[-1]=(myshape2[-1]//2+1)
     datft=numpy.zeros(myshape2,dtype='complex')
+    old=_push_nthread(nthread)
     fft_r2c_n_c(dat.ctypes.data,datft.ctypes.data,len(myshape),myshape.ctypes.data)
+    _pop_nthread(old)
     return datft
 
-def irfftn(datft,iseven=True,preserve_input=True):
+def irfftn(datft,iseven=True,preserve_input=True,nthread=None):
     #the c2r transforms destroy input.  if you want to keep the input
     #around, then we need to copy the incoming data.
     if preserve_input:
@@ -79,21 +164,25 @@ def irfftn(datft,iseven=True,preserve_input=True):
         myshape2[-1]=2*myshape2[-1]-1
     #print(myshape2)
     dat=numpy.empty(myshape2,dtype='float64')
+    old=_push_nthread(nthread)
     fft_c2r_n_c(datft.ctypes.data,dat.ctypes.data,len(myshape2),myshape2.ctypes.data)
+    _pop_nthread(old)
     return dat
 
 
-def fft_r2c_3d(dat):
+def fft_r2c_3d(dat,nthread=None):
     myshape=dat.shape
     assert(len(myshape)==3)
     myshape=numpy.asarray(myshape,dtype='int')
     myshape2=myshape.copy()
     myshape2[-1]=(myshape2[-1]//2+1)
     datft=numpy.zeros(myshape2,dtype='complex')
+    old=_push_nthread(nthread)
     fft_r2c_3d_c(dat.ctypes.data,datft.ctypes.data,myshape.ctypes.data)
+    _pop_nthread(old)
     return datft
 
-def fft_c2r_3d(datft,iseven=True,preserve_input=True):
+def fft_c2r_3d(datft,iseven=True,preserve_input=True,nthread=None):
     #the c2r transforms destroy input.  if you want to keep the input
     #around, then we need to copy the incoming data.
     if preserve_input:
@@ -108,13 +197,16 @@ def fft_c2r_3d(datft,iseven=True,preserve_input=True):
         myshape2[-1]=2*myshape2[-1]-1
     #print(myshape2)
     dat=numpy.empty(myshape2,dtype='float64')
+    old=_push_nthread(nthread)
     fft_c2r_3d_c(datft.ctypes.data,dat.ctypes.data,myshape2.ctypes.data)
+    _pop_nthread(old)
     return dat
 
 
-def fft_r2c(dat):
+def fft_r2c(dat,nthread=None):
     ndat=dat.shape[1]
     ntrans=dat.shape[0]
+    old=_push_nthread(nthread)
     
     if dat.dtype==numpy.dtype('float64'):
         #datft=numpy.zeros(dat.shape,dtype=complex)
@@ -124,12 +216,14 @@ def fft_r2c(dat):
         assert(dat.dtype==numpy.dtype('float32'))
         datft=numpy.empty(dat.shape,dtype='complex64')
         many_fftf_r2c_1d_c(dat.ctypes.data,datft.ctypes.data,ntrans,ndat,ndat,ndat)
+    _pop_nthread(old)
     return datft
 
 
-def fft_c2r(datft):
+def fft_c2r(datft,nthread=None):
     ndat=datft.shape[1]
     ntrans=datft.shape[0]
+    old=_push_nthread(nthread)
     if datft.dtype==numpy.dtype('complex128'):
         dat=numpy.zeros(datft.shape)
         many_fft_c2r_1d_c(datft.ctypes.data,dat.ctypes.data,ntrans,ndat,ndat,ndat)
@@ -139,31 +233,59 @@ def fft_c2r(datft):
         dat=numpy.zeros(datft.shape,dtype='float32')
         many_fftf_c2r_1d_c(datft.ctypes.data,dat.ctypes.data,ntrans,ndat,ndat,ndat)
         dat=dat/numpy.float32(ndat)
+    _pop_nthread(old)
     return dat
 
 
 def fft_r2r_1d(dat,kind=1):
     nn=dat.size
+    dat=numpy.ascontiguousarray(dat,dtype='float64')
     trans=numpy.zeros(nn)
     fft_r2r_1d_c(dat.ctypes.data,trans.ctypes.data,nn,kind)
     return trans
 
-def fft_r2r(dat,trans=None,kind=1):
+def _r2r_layout(arr):
+    #element strides of a 2-d array's rows and columns, or None if they aren't whole, non-negative elements
+    ss=arr.strides
+    if ss[0]%arr.itemsize or ss[1]%arr.itemsize or ss[0]<0 or ss[1]<0:
+        return None
+    return ss[1]//arr.itemsize,ss[0]//arr.itemsize
+
+def fft_r2r(dat,trans=None,kind=1,nthread=None):
+    """Real-to-real transform of each row of dat.  kind is 1-4 for DCT-I to DCT-IV, 11-14 for DST-I to DST-IV.
+    All rows go to FFTW as one batch.  trans can be dat for an in-place transform, and dat/trans may be strided
+    (e.g. a slice of a bigger array).  nthread overrides the thread count for this call."""
     if len(dat.shape)==1:
         return fft_r2r_1d(dat,kind)
     ntrans=dat.shape[0]
     n=dat.shape[1]
     #trans=numpy.zeros([ntrans,n],dtype=type(dat[0,0]))
     if trans is None:
-        trans=numpy.empty([ntrans,n],dtype=type(dat[0,0]))
-    
-
-    if type(dat[0,0])==numpy.dtype('float32'):
+        trans=numpy.empty([ntrans,n],dtype=dat.dtype)
+    assert(trans.shape==dat.shape)
+    assert(trans.dtype==dat.dtype)
+    ilayout=_r2r_layout(dat)
+    if ilayout is None:
+        dat=numpy.ascontiguousarray(dat)
+        ilayout=_r2r_layout(dat)
+    out=trans
+    olayout=_r2r_layout(trans)
+    if olayout is None:
+        #e.g. a reversed view, so transform into a fresh array and copy back
+        trans=numpy.empty([ntrans,n],dtype=dat.dtype)
+        olayout=_r2r_layout(trans)
+    old=_push_nthread(nthread)
+
+    if dat.dtype==numpy.dtype('float32'):
         #print 'first two element in python are ',dat[0,0],dat[0,1]
-        many_fftf_r2r_1d_c(dat.ctypes.data,trans.ctypes.data,n,kind,ntrans)
+        many_fftf_r2r_c(dat.ctypes.data,trans.ctypes.data,n,kind,ntrans,ilayout[0],ilayout[1],olayout[0],olayout[1])
     else:
-        many_fft_r2r_1d_c(dat.ctypes.data,trans.ctypes.data,n,kind,ntrans)
-    return trans
+        assert(dat.dtype==numpy.dtype('float64'))
+        many_fft_r2r_c(dat.ctypes.data,trans.ctypes.data,n,kind,ntrans,ilayout[0],ilayout[1],olayout[0],olayout[1])
+    _pop_nthread(old)
+    if not(out is trans):
+        out[:]=trans
+    return out
 
 
 def read_wisdom(double_file='.fftw_wisdom',single_file='.fftwf_wisdom'):
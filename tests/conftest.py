@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+#minkasi and mkfftw live at the top of the repo, and need libminkasi.so/libmkfftw.so on LD_LIBRARY_PATH
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+try:
+    import minkasi
+except OSError as e:
+    minkasi=None
+    lib_err=e
+
+def need_minkasi():
+    if minkasi is None:
+        pytest.skip('could not load the minkasi libraries: '+repr(lib_err),allow_module_level=True)
+    return minkasi
+
+def fake_todvec(ntod=3,ndet=8,nsamp=2001,seed=0):
+    """Small TodVec of synthetic TODs: a wobbling scan, white noise plus a random-walk common mode, and some sky."""
+    rng=np.random.default_rng(seed)
+    todvec=minkasi.TodVec()
+    for t in range(ntod):
+        tvec=np.arange(nsamp)*0.01
+        ra0=1.0+0.001*np.sin(tvec*0.7+t)
+        dec0=0.5+0.001*np.cos(tvec*0.37*(t+1))
+        offs=rng.normal(size=(ndet,2))*2e-4
+        dx=ra0[None,:]+offs[:,0:1]
+        dy=dec0[None,:]+offs[:,1:2]
+        cm=np.cumsum(rng.normal(size=nsamp))*0.05
+        dat=rng.normal(size=(ndet,nsamp))+cm[None,:]+np.sin(dx*3000)*np.cos(dy*3000)
+        info={'dx':dx,'dy':dy,'dat_calib':dat,'fname':'tod%d'%t,'ctime':tvec,'dt':0.01}
+        todvec.add_tod(minkasi.Tod(info))
+    return todvec
+
+def setup_problem(todvec,pixsize=2e-4):
+    """Noise models, rhs, starting guess, and hits preconditioner for a single SkyMap solve of todvec."""
+    map=minkasi.SkyMap(todvec.lims(),pixsize)
+    for tod in todvec.tods:
+        tod.set_noise(minkasi.NoiseSmoothedSVD)
+    hits=minkasi.make_hits(todvec,map)
+    mapset=minkasi.Mapset()
+    mapset.add_map(map)
+    rhs=mapset.copy()
+    todvec.make_rhs(rhs)
+    x0=rhs.copy()
+    x0.clear()
+    precon=mapset.copy()
+    tmp=hits.map.copy()
+    ii=tmp>0
+    tmp[ii]=1/tmp[ii]
+    precon.maps[0].map[:]=tmp
+    return rhs,x0,precon
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+import pytest
+from conftest import need_minkasi,fake_todvec
+minkasi=need_minkasi()
+
+def correlated_data(ndet=12,n=20001,seed=3):
+    #a few red common modes mixed into the detectors, plus white and red per-detector noise
+    rng=np.random.default_rng(seed)
+    def red(alpha,amp):
+        ft=rng.normal(size=n)*amp/np.maximum(np.arange(n),1)**alpha
+        return minkasi.mkfftw.fft_r2r(ft)/np.sqrt(n)
+    mix=rng.normal(size=(ndet,3))
+    dat=np.dot(mix,np.vstack([red(1.0,30),red(0.8,10),red(1.2,20)]))
+    dat+=rng.normal(size=(ndet,n))*rng.uniform(0.5,2,size=(ndet,1))
+    for i in range(ndet):
+        dat[i]+=red(0.5,rng.uniform(0.5,3))
+    return dat
+
+def test_low_rank_converges_to_full():
+    dat=correlated_data()
+    ndet=dat.shape[0]
+    full=minkasi.NoiseSmoothedSVD(dat)
+    ref=full.apply_noise(dat.copy())
+    errs={}
+    for nmode in [1,ndet//2,ndet-1,ndet]:
+        lr=minkasi.NoiseSmoothedSVD(dat,nmode=nmode)
+        y=lr.apply_noise(dat.copy())
+        errs[nmode]=np.sqrt(np.sum((y-ref)**2)/np.sum(ref**2))
+    assert errs[ndet]<1e-10
+    assert errs[ndet-1]<1e-3
+    assert errs[ndet-1]<errs[ndet//2]<errs[1]
+    assert np.allclose(minkasi.NoiseSmoothedSVD(dat,nmode=ndet-1).get_det_weights(),full.get_det_weights(),rtol=1e-3)
+
+def test_noise_cache_round_trip(tmp_path,monkeypatch):
+    cache=str(tmp_path/'ncache')
+    tod=fake_todvec(ntod=1,ndet=20,nsamp=5001).tods[0]
+    minkasi.set_noise_cache(cache)
+    try:
+        for noise_class,kwargs in [(minkasi.NoiseSmoothedSVD,{'fwhm':30}),(minkasi.NoiseBinnedEig,{'dt':0.01,'freqs':np.asarray([0.1,1,5])})]:
+            tod.set_noise(noise_class,**kwargs)
+            nfile=len(os.listdir(cache))
+            ref=tod.apply_noise()
+            tod.noise=None
+            with monkeypatch.context() as m:
+                #a cache hit must not refit
+                def refit(self,*args,**kwargs):
+                    raise AssertionError('noise model was refit rather than loaded from the cache')
+                m.setattr(noise_class,'__init__',refit)
+                tod.set_noise(noise_class,**kwargs)
+            assert len(os.listdir(cache))==nfile
+            assert np.array_equal(tod.apply_noise(),ref)
+        #different arguments give a different model
+        nfile=len(os.listdir(cache))
+        tod.set_noise(minkasi.NoiseSmoothedSVD,fwhm=31)
+        assert len(os.listdir(cache))==nfile+1
+    finally:
+        minkasi.set_noise_cache(None)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from conftest import need_minkasi,fake_todvec,setup_problem
+minkasi=need_minkasi()
+
+def pcg_with_copies(b,x0,tods,precon,maxiter):
+    #the original run_pcg loop, which makes new vectors every iteration
+    Ax=tods.dot(x0)
+    r=b.copy()
+    r.axpy(Ax,-1)
+    z=r.copy() if precon is None else precon*r
+    p=z.copy()
+    zr=r.dot(z)
+    x=x0.copy()
+    for iter in range(maxiter):
+        Ap=tods.dot(p)
+        alpha=zr/p.dot(Ap)
+        x_new=x.copy()
+        x_new.axpy(p,alpha)
+        r_new=r.copy()
+        r_new.axpy(Ap,-alpha)
+        z_new=r_new.copy() if precon is None else precon*r_new
+        zr_new=r_new.dot(z_new)
+        p_new=z_new.copy()
+        p_new.axpy(p,zr_new/zr)
+        x,r,z,p,zr=x_new,r_new,z_new,p_new,zr_new
+    return x
+
+@pytest.fixture(scope='module')
+def problem():
+    todvec=fake_todvec()
+    rhs,x0,precon=setup_problem(todvec)
+    return todvec,rhs,x0,precon
+
+@pytest.mark.parametrize('use_precon',[True,False])
+def test_inplace_pcg_matches_baseline(problem,use_precon):
+    todvec,rhs,x0,precon=problem
+    if not(use_precon):
+        precon=None
+    ref=pcg_with_copies(rhs,x0,todvec,precon,10)
+    x=minkasi.run_pcg(rhs,x0,todvec,precon,maxiter=10,save_iters=[])
+    assert np.allclose(x.maps[0].map,ref.maps[0].map,rtol=1e-10,atol=1e-10*np.abs(ref.maps[0].map).max())
+    x=minkasi.run_pcg_wprior(rhs,x0,todvec,None,precon,maxiter=10,save_iters=[])
+    assert np.allclose(x.maps[0].map,ref.maps[0].map,rtol=1e-10,atol=1e-10*np.abs(ref.maps[0].map).max())
+
+def test_checkpoint_resume_bit_identical(problem,tmp_path):
+    todvec,rhs,x0,precon=problem
+    ckpt=str(tmp_path/'ck')
+    ref,ref_log=minkasi.run_pcg(rhs,x0,todvec,precon,maxiter=10,save_iters=[],full_out=True)
+    #stop partway, with the last checkpoint not on a multiple of checkpoint_every, then resume
+    minkasi.run_pcg(rhs,x0,todvec,precon,maxiter=6,save_iters=[],checkpoint=ckpt,checkpoint_every=4)
+    x,log=minkasi.run_pcg(rhs,x0,todvec,precon,maxiter=10,save_iters=[],checkpoint=ckpt,full_out=True)
+    assert np.array_equal(x.maps[0].map,ref.maps[0].map)
+    assert np.array_equal(log[:,:3],ref_log[:,:3])
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from conftest import need_minkasi
+need_minkasi()
+import mkfftw
+scipy_fft=pytest.importorskip('scipy.fft')
+
+kinds={1:('dct',1),2:('dct',2),3:('dct',3),4:('dct',4),11:('dst',1),12:('dst',2),13:('dst',3),14:('dst',4)}
+
+@pytest.mark.parametrize('kind',sorted(kinds.keys()))
+@pytest.mark.parametrize('n',[2001,2048])
+def test_r2r_matches_scipy(kind,n):
+    fun,typ=kinds[kind]
+    x=np.random.default_rng(kind).normal(size=(7,n))
+    ref=getattr(scipy_fft,fun)(x,type=typ,axis=1)
+    scale=np.abs(ref).max()
+    assert np.abs(mkfftw.fft_r2r(x,kind=kind)-ref).max()<1e-12*scale
+    assert np.abs(mkfftw.fft_r2r_1d(x[3],kind)-ref[3]).max()<1e-12*scale
+    y=mkfftw.fft_r2r(np.asarray(x,dtype='float32'),kind=kind)
+    assert y.dtype==np.dtype('float32')
+    assert np.abs(y-ref).max()<1e-5*scale
+
+@pytest.mark.parametrize('kind',[1,2,12])
+def test_r2r_layouts(kind):
+    fun,typ=kinds[kind]
+    big=np.random.default_rng(0).normal(size=(40,2500))
+    x=big[::2,100:2101]
+    ref=getattr(scipy_fft,fun)(x,type=typ,axis=1)
+    tol=1e-12*np.abs(ref).max()
+    #strided input
+    assert np.abs(mkfftw.fft_r2r(x,kind=kind)-ref).max()<tol
+    #strided output, and don't touch anything outside it
+    out=np.zeros((20,3000))
+    mkfftw.fft_r2r(x,out[:,:2001],kind=kind)
+    assert np.abs(out[:,:2001]-ref).max()<tol
+    assert np.all(out[:,2001:]==0)
+    #transposed and reversed views
+    xt=np.ascontiguousarray(x.T).T
+    assert np.abs(mkfftw.fft_r2r(xt,kind=kind)-ref).max()<tol
+    assert np.abs(mkfftw.fft_r2r(x[::-1],kind=kind)-ref[::-1]).max()<tol
+    out=np.zeros(x.shape)
+    mkfftw.fft_r2r(x,out[::-1],kind=kind)
+    assert np.abs(out[::-1]-ref).max()<tol
+    #in place
+    z=x.copy()
+    mkfftw.fft_r2r(z,z,kind=kind)
+    assert np.abs(z-ref).max()<tol
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from conftest import need_minkasi,fake_todvec
+minkasi=need_minkasi()
+
+@pytest.fixture(scope='module')
+def todvec():
+    return fake_todvec(ndet=20,nsamp=5001)
+
+def make_map(todvec,tag,**kwargs):
+    return minkasi.SkyMap(todvec.lims(),1e-4,tag=tag,**kwargs)
+
+def reference_maps(todvec,dtype='float64'):
+    ref=make_map(todvec,'ipix_ref')
+    for tod in todvec.tods:
+        dat=np.asarray(tod.get_data(),dtype=dtype)
+        minkasi.tod2map_simple(ref.map,dat,ref.get_pix(tod))
+    return ref
+
+def assert_maps_agree(a,b):
+    assert np.allclose(a,b,rtol=1e-12,atol=1e-12*np.abs(b).max())
+
+@pytest.mark.parametrize('method',['simple','omp','atomic','everyone','sorted','cached'])
+def test_tod2map_methods_agree(todvec,method):
+    ref=reference_maps(todvec)
+    map=make_map(todvec,'ipix_'+method)
+    map.set_tod2map(method,todvec)
+    for tod in todvec.tods:
+        map.tod2map(tod,tod.get_data())
+    if method=='cached':
+        map.clear_caches()
+    assert_maps_agree(map.map,ref.map)
+
+@pytest.mark.parametrize('kind',['delta','onthefly'])
+@pytest.mark.parametrize('dtype',['float64','float32'])
+@pytest.mark.parametrize('do_omp',[True,False])
+def test_pixellizations_agree(todvec,kind,dtype,do_omp):
+    ref=reference_maps(todvec,dtype)
+    if kind=='delta':
+        map=make_map(todvec,'cpix',compress_pixellization=True)
+    else:
+        map=make_map(todvec,None,onthefly_pixellization=True)
+    for tod in todvec.tods:
+        map.tod2map(tod,np.asarray(tod.get_data(),dtype=dtype),do_omp=do_omp)
+    if kind=='delta':
+        assert isinstance(todvec.tods[0].info['cpix'],minkasi.DeltaPix)
+    assert_maps_agree(map.map,ref.map)
+
+    #and back the other way, from a map with a distinct value in every pixel
+    ref.map[:]=np.reshape(np.arange(ref.map.size),ref.map.shape)
+    map.map[:]=ref.map
+    for tod in todvec.tods:
+        d1=np.zeros(tod.get_data_dims(),dtype=dtype)
+        d2=np.zeros(tod.get_data_dims(),dtype=dtype)
+        minkasi.map2tod(d1,ref.map,ref.get_pix(tod),False)
+        map.map2tod(tod,d2,do_add=False)
+        assert np.array_equal(d1,d2)